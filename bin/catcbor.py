@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import cbor
+import logschema
 import pprint
 import sys
 import argparse
@@ -75,19 +76,16 @@ def run( args ):
         maxlen = args.head
     elif args.tail > 0:
         items = collections.deque( maxlen=args.tail )
-    with open( args.infile, 'rb' ) as f:
-        try:
-            while (1):
-                rec = cbor.load( f )
-                items.append( rec )
-                count += 1
-                if count == maxlen:
-                    break
-        except ( EOFError ) as e:
-            pass
-        except ( ValueError ) as e:
-            logging.warning( 'Error reading from file, input file may be corrupt. '
-                          'Using only valid data that was read up to this point.' )
+    # either record format, compact records are expanded (see logschema)
+    try:
+        for rec in logschema.read_log( args.infile ):
+            items.append( rec )
+            count += 1
+            if count == maxlen:
+                break
+    except ( ValueError ) as e:
+        logging.warning( 'Error reading from file, input file may be corrupt. '
+                      'Using only valid data that was read up to this point.' )
     do_print( items, args )
 
 if __name__ == '__main__':
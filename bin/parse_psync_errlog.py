@@ -6,7 +6,7 @@ import pprint
 import pickle
 import os
 import re
-import cbor
+import logschema
 import logging
 
 
@@ -114,13 +114,8 @@ def process_error_record( errdict, rec ):
 
 def process_file( infile ):
     errors = collections.OrderedDict()
-    with open( infile, 'rb' ) as f:
-        try:
-            while True:
-                rec = cbor.load( f )
-                process_error_record( errors, rec )
-        except ( EOFError ):
-            pass
+    for rec in logschema.read_log( infile ):
+        process_error_record( errors, rec )
     return errors
 
 
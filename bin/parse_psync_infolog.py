@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import cbor
+import logschema
 import argparse
 import datetime
 import time
@@ -23,7 +23,8 @@ default_dirdata = { 'start': 0,
 
 def process_cmdline():
     parser = argparse.ArgumentParser()
-    parser.add_argument( 'infile' )
+    parser.add_argument( 'infile',
+        help='INFO log, or log segment (.gz, .xz), in either record format' )
     parser.add_argument( '--inodes', '-i', type=int, metavar='N',
         help='Source file system has N inodes total. '
              'Used to estimate completion progress.' )
@@ -55,12 +56,30 @@ def count_sync_types( rec, sync_types ):
         mtype = rec[ 'msgtype' ]
     except ( KeyError ) as e:
         pass
+    # Records of sampled files (file_log summary, see lib/log_summary.py)
+    # are also counted in a summary record, keep them apart
+    if rec.get( 'sampled' ):
+        mtype = 'sampled_' + mtype
     if stype not in sync_types:
         sync_types[ stype ] = {}
     sdata = sync_types[ stype ]
     if mtype not in sdata:
         sdata[ mtype ] = 0
     sdata[ mtype ] += 1
+    # Files skipped by the quick check in sync_dir have no SYNCFILE records,
+    # count them from the SYNCDIR info record instead
+    if stype in ( 'SYNCDIR', 'SYNCDIRSLICE' ) and mtype == 'info':
+        fdata = sync_types.setdefault( 'SYNCFILE', {} )
+        fdata.setdefault( 'unchanged', 0 )
+        fdata[ 'unchanged' ] += rec.get( 'num_unchanged_files', 0 )
+    # One summary record stands for the end records of num_files files
+    if mtype == 'summary':
+        for k in ( 'num_files', 'num_errors', 'bytes' ):
+            sdata[ k ] = sdata.get( k, 0 ) + rec.get( k, 0 )
+    # Checksum cache use (see checksum_cache), summed per synctype
+    for k in ( 'chksum_hits', 'chksum_misses' ):
+        if k in rec:
+            sdata[ k ] = sdata.get( k, 0 ) + rec[ k ]
 
 
 def process_syncdir_stats( rec, syncdir_data ):
@@ -88,6 +107,9 @@ def process_syncdir_stats( rec, syncdir_data ):
             working[ src ] [ 'srctot' ] += rec[ k ]
         for k in [ 'num_tgt_dirs', 'num_tgt_files' ]:
             working[ src ][ k ] = rec[ k ]
+    elif msgtype == 'split':
+        # contents are handled by SYNCDIRSLICE tasks
+        working[ src ][ 'num_slices' ] = rec[ 'num_slices' ]
     elif msgtype == 'end':
         working[ src ][ 'end' ] = ts
         working[ src ][ 'elapsed' ] = ts - working[ src ][ 'start' ]
@@ -103,8 +125,16 @@ def print_psync_summary( args, time_data, sync_types, total_rec_count ):
     elapsed = end_time - start_time
     inodes_completed = 0
     for k,v in sync_types.iteritems():
+        # slices are part of a SYNCDIR and chunks part of a SYNCFILE,
+        # purge runs remove target inodes, don't count them as inodes
+        if k in ( 'SYNCDIRSLICE', 'SYNCFILECHUNK' ) or k.startswith( 'PURGE' ):
+            continue
         if 'end' in v:
             inodes_completed += v[ 'end' ]
+        if 'num_files' in v:
+            inodes_completed += v[ 'num_files' ]
+        if 'unchanged' in v:
+            inodes_completed += v[ 'unchanged' ]
     pct_complete_by_inodes = inodes_completed * 100.0 / args.inodes
     pct_rate = pct_complete_by_inodes / elapsed.total_seconds() * 3600
     eta_complete = ( 100.0 - pct_complete_by_inodes ) / pct_rate
@@ -176,25 +206,20 @@ def run( args ):
         )
     starttime = int( time.time() )
     total_records = 0
-    with open( args.infile, 'rb' ) as f:
+    for rec in logschema.read_log( args.infile ):
+        total_records += 1
+        #logr.debug( 'Processing record: {0}'.format( rec ) )
+        process_start_end_times( rec, time_data )
+        count_sync_types( rec, sync_types )
         try:
-            while (1):
-                total_records += 1
-                rec = cbor.load( f )
-                #logr.debug( 'Processing record: {0}'.format( rec ) )
-                process_start_end_times( rec, time_data )
-                count_sync_types( rec, sync_types )
-                try:
-                    process_syncdir_stats( rec, syncdir_data )
-                except ( KeyError ) as e:
-                    logr.warning( 'LogRecord={0}, Error={1}'.format(
-                        total_records, e ) )
-                if total_records % 1000000 == 0:
-                    elapsed_secs = int( time.time() ) - starttime
-                    logr.info( 'Processed {0} records in {1} secs'.format(
-                        total_records, elapsed_secs ) )
-        except ( EOFError ) as e:
-            pass
+            process_syncdir_stats( rec, syncdir_data )
+        except ( KeyError ) as e:
+            logr.warning( 'LogRecord={0}, Error={1}'.format(
+                total_records, e ) )
+        if total_records % 1000000 == 0:
+            elapsed_secs = int( time.time() ) - starttime
+            logr.info( 'Processed {0} records in {1} secs'.format(
+                total_records, elapsed_secs ) )
     print_syncdir_summary( args, syncdir_data )
     print_psync_summary( args, time_data, sync_types, total_records )
 
@@ -7,7 +7,7 @@ import io
 import csv
 import os
 import re
-import cbor
+import logschema
 import logging
 import argparse
 import pickle
@@ -208,13 +208,8 @@ def process_warning( rec, warnings ):
 
 def process_file( infile ):
     warnings = collections.OrderedDict()
-    with open( infile, 'rb' ) as f:
-        try:
-            while True:
-                rec = cbor.load( f )
-                process_warning( rec, warnings )
-        except ( EOFError ):
-            pass
+    for rec in logschema.read_log( infile ):
+        process_warning( rec, warnings )
     return warnings
 
 
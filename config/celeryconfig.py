@@ -1,6 +1,9 @@
 # Note: broker_url is loaded from a separate file that broker updates when it starts.
 
-CELERY_ACCEPT_CONTENT = ['pickle']
+# Task messages use a compact CBOR encoding (see lib/cbor_serializer.py),
+# task args are plain data (run id, relative paths, dirscan.Entry fields)
+CELERY_TASK_SERIALIZER = 'psync_cbor'
+CELERY_ACCEPT_CONTENT = ['psync_cbor']
 
 #CELERY_SEND_EVENTS = True
 
@@ -15,6 +18,7 @@ CELERYD_LOG_LEVEL = 'INFO'
 #CELERY_IMPORTS = ('psync', )
 #CELERY_CREATE_MISSING_QUEUES = True
 CELERY_ROUTES = {
-    'psync.sync_hardlink':   {'queue': 'hardlinks'},
+    'psync.purge_dir':       {'queue': 'purge'},
+    'psync.purge_files':     {'queue': 'purge'},
 }
 ##    'psync.resync_dir_meta': {'queue': 'dirmeta'},
@@ -0,0 +1,107 @@
+#!/bin/env python
+"""
+File copy benchmark: the native copy backend (copy_backend.Native_Copy,
+one run per copy method) versus one rsync process per file (the way
+pylut.syncfile copies files below PYLUTRSYNCMAXSIZE).
+
+Creates a set of source files in SRCDIR, then syncs them into a new target
+dir in each TGTDIR.  Pass TGTDIRs on different filesystems (ie: ext4, xfs,
+tmpfs) to compare them, copies within the same filesystem can use
+copy_file_range (reflink or in-kernel copy), across filesystems it falls
+back to sendfile.
+
+Page cache is not dropped, so the source is read from memory.  Dirty data
+is written back (sync) before each run, and at the end of each run inside
+the timed section, so results do not depend on how much of the previous
+run is still in writeback.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib \\
+      python extras/bench_copy.py SRCDIR TGTDIR [TGTDIR ...] [-n FILES] [-s SIZE]
+"""
+from __future__ import print_function
+import argparse
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import copy_backend
+
+OPTS = dict( synctimes=True, syncperms=True, syncowner=False, syncgroup=False,
+             pre_checksums=False, post_checksums=False, keeptmp=True )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'srcdir', metavar='SRCDIR' )
+    parser.add_argument( 'tgtdirs', metavar='TGTDIR', nargs='+' )
+    parser.add_argument( '--files', '-n', type=int,
+        help='Number of files (default: %(default)s)' )
+    parser.add_argument( '--size', '-s', type=int,
+        help='Size of each file in bytes (default: %(default)s)' )
+    parser.set_defaults( files=1000, size=65536 )
+    return parser.parse_args()
+
+
+def mk_files( srcdir, num, size ):
+    path = tempfile.mkdtemp( prefix='bench_copy_src.', dir=srcdir )
+    data = os.urandom( size )
+    for i in range( num ):
+        with open( os.path.join( path, 'f{0:06d}'.format( i ) ), 'wb' ) as f:
+            f.write( data )
+    return path
+
+
+def run_native( method, src, tgt, tmpbase ):
+    # the method falls back to the ones after it where not supported
+    methods = list( copy_backend.METHODS )
+    backend = copy_backend.Native_Copy( methods=methods[ methods.index( method ): ] )
+    for name in os.listdir( src ):
+        backend.syncfile( os.path.join( src, name ), os.path.join( tgt, name ),
+                          tmpbase, **OPTS )
+
+
+def run_rsync( rsync, src, tgt, tmpbase ):
+    for name in os.listdir( src ):
+        subprocess.check_call( [ rsync, '-t', '-p', '--inplace',
+            os.path.join( src, name ), os.path.join( tgt, name ) ] )
+
+
+def run():
+    args = process_cmdline()
+    src = mk_files( args.srcdir, args.files, args.size )
+    methods = [ ( m, run_native ) for m in copy_backend.METHODS ]
+    rsync = distutils.spawn.find_executable( 'rsync' )
+    if rsync:
+        methods.append( ( rsync, run_rsync ) )
+    else:
+        print( 'rsync not found, skipping rsync runs' )
+    print( 'Files: {0}  Size: {1}  Source: {2} ({3})'.format(
+        args.files, args.size, src, copy_backend.fstype( src ) ) )
+    print( '{0:<10} {1:<16} {2:>8} {3:>10} {4:>8}'.format(
+        'fstype', 'method', 'secs', 'files/s', 'MiB/s' ) )
+    try:
+        for tgtdir in args.tgtdirs:
+            fstype = copy_backend.fstype( tgtdir )
+            for ( method, func ) in methods:
+                tgt = tempfile.mkdtemp( prefix='bench_copy_tgt.', dir=tgtdir )
+                tmpbase = os.path.join( tgt, '.tmp' )
+                os.mkdir( tmpbase )
+                subprocess.check_call( [ 'sync' ] )
+                start = time.time()
+                func( method, src, tgt, tmpbase )
+                subprocess.check_call( [ 'sync' ] )
+                secs = time.time() - start
+                shutil.rmtree( tgt )
+                print( '{0:<10} {1:<16} {2:>8.2f} {3:>10.1f} {4:>8.1f}'.format(
+                    fstype, os.path.basename( method ), secs,
+                    args.files / secs,
+                    args.files * args.size / 1048576.0 / secs ) )
+    finally:
+        shutil.rmtree( src )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,139 @@
+#!/bin/env python
+"""
+Memory benchmark: set arithmetic over dicts of FSItem-like objects (the old
+sync_dir) versus sorted listings merge-joined by dirdiff (the current
+sync_dir), on a synthetic directory listing.
+
+Each method runs in its own child process and reports its peak RSS (and
+the tracemalloc peak when running under a python that has tracemalloc).
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib python extras/bench_dir_diff.py [-n ENTRIES]
+"""
+from __future__ import print_function
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+import dirdiff
+import dirscan
+
+try:
+    import tracemalloc
+except ( ImportError ) as e:
+    tracemalloc = None
+
+# Large prime, used to emit names in a scrambled (directory-like) order
+SCRAMBLE = 2147483647
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--entries', '-n', type=int,
+        help='Number of entries in synthetic dir (default: %(default)s)' )
+    parser.add_argument( '--changed', '-c', type=int,
+        help='One in N entries differs between src and tgt (default: %(default)s)' )
+    parser.add_argument( '--method', '-m', choices=( 'sets', 'merge' ),
+        help='Run a single method in this process (used internally)' )
+    parser.set_defaults( entries=5000000, changed=100 )
+    return parser.parse_args()
+
+
+class Fake_FSItem( object ):
+    """ Same instance data as an FSItem created by dir_scan """
+    def __init__( self, name, absname, mountpoint, st ):
+        self.name = name
+        self.absname = absname
+        self.mountpoint = mountpoint
+        self._stat = st
+
+
+def listing( n, changed, side ):
+    """
+    Synthetic directory listing in scrambled order.
+    tgt is missing every changed'th name of src and has one extra name instead.
+    """
+    for i in range( n ):
+        j = ( i * SCRAMBLE ) % n
+        name = 'f{0:09d}'.format( j )
+        if side == 'tgt' and j % changed == 0:
+            name = name + '.old'
+        st = os.stat_result( ( 0o100644, j, 42, 1, 1000, 1000, j, 0, 0, 0 ) )
+        yield ( name, 'file', st )
+
+
+def run_sets( args ):
+    """ sync_dir before dirdiff: 2 dicts + 2 sets per side """
+    mp = '/mnt/a'
+    dirs = {}
+    src_files = {}
+    for ( name, ftype, st ) in listing( args.entries, args.changed, 'src' ):
+        src_files[ name ] = Fake_FSItem( name, '/mnt/a/x/' + name, mp, st )
+    tgt_files = {}
+    for ( name, ftype, st ) in listing( args.entries, args.changed, 'tgt' ):
+        tgt_files[ name ] = Fake_FSItem( name, '/mnt/b/x/' + name, mp, st )
+    src_dir_set = set( dirs.keys() )
+    src_file_set = set( src_files.keys() )
+    tgt_dir_set = set( dirs.keys() )
+    tgt_file_set = set( tgt_files.keys() )
+    deleted = len( tgt_file_set - src_file_set )
+    synced = len( src_file_set - tgt_file_set )
+    return ( deleted, synced )
+
+
+def entries( n, changed, side ):
+    """ listing() as dirscan.Entry records, as yielded by psync.dir_scan """
+    for ( name, ftype, st ) in listing( n, changed, side ):
+        yield dirscan.Entry.from_stat( name, ftype, st )
+
+
+def run_merge( args ):
+    """ current sync_dir: external sort + merge join of Entry records """
+    src = dirdiff.external_sort( entries( args.entries, args.changed, 'src' ) )
+    tgt = dirdiff.external_sort( entries( args.entries, args.changed, 'tgt' ) )
+    deleted = 0
+    synced = 0
+    for ( name, s, t ) in dirdiff.merge_join( src, tgt ):
+        if s is None:
+            deleted += 1
+        elif t is None:
+            synced += 1
+    return ( deleted, synced )
+
+
+def run_one( args ):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    ( deleted, synced ) = { 'sets': run_sets, 'merge': run_merge }[ args.method ]( args )
+    elapsed = time.time() - start
+    tm_peak = 'n/a'
+    if tracemalloc:
+        tm_peak = '{0:.1f}'.format( tracemalloc.get_traced_memory()[1] / 1048576.0 )
+    # ru_maxrss is in KiB on Linux
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+    print( '{0:<8} {1:>12.1f} {2:>14} {3:>10.1f} {4:>9} {5:>9}'.format(
+        args.method, rss, tm_peak, elapsed, deleted, synced ) )
+    sys.stdout.flush()
+
+
+def run():
+    args = process_cmdline()
+    if args.method:
+        run_one( args )
+        return
+    print( 'Entries per side: {0}'.format( args.entries ) )
+    print( '{0:<8} {1:>12} {2:>14} {3:>10} {4:>9} {5:>9}'.format(
+        'method', 'peakRSS MiB', 'tracemalloc MiB', 'secs', 'deleted', 'synced' ) )
+    sys.stdout.flush()
+    for method in ( 'sets', 'merge' ):
+        cmd = [ sys.executable, os.path.abspath( __file__ ),
+                '-n', str( args.entries ), '-c', str( args.changed ),
+                '-m', method ]
+        subprocess.check_call( cmd )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,106 @@
+#!/bin/env python
+"""
+Compare the legacy listdir + stat-per-name directory scan with the
+scandir based dirscan.scan().
+
+Reports stat calls per directory and entries scanned per second.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib python extras/bench_dir_scan.py [-p PATH]
+Without -p, a synthetic directory is created (and removed) under TMPDIR.
+"""
+from __future__ import print_function
+import argparse
+import os
+import stat
+import shutil
+import tempfile
+import time
+import dirscan
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--path', '-p',
+        help='Scan existing directory PATH instead of a synthetic one' )
+    parser.add_argument( '--files', '-f', type=int,
+        help='Number of files in synthetic dir (default: %(default)s)' )
+    parser.add_argument( '--dirs', '-d', type=int,
+        help='Number of subdirs in synthetic dir (default: %(default)s)' )
+    parser.add_argument( '--repeat', '-r', type=int,
+        help='Number of times to scan (default: %(default)s)' )
+    parser.set_defaults( files=20000, dirs=2000, repeat=5 )
+    return parser.parse_args()
+
+
+def mk_synthetic_dir( numfiles, numdirs ):
+    path = tempfile.mkdtemp( prefix='bench_dir_scan.' )
+    for i in range( numdirs ):
+        os.mkdir( os.path.join( path, 'd{0:08d}'.format( i ) ) )
+    for i in range( numfiles ):
+        with open( os.path.join( path, 'f{0:08d}'.format( i ) ), 'wb' ) as f:
+            f.write( b'x' )
+    return path
+
+
+def legacy_scan( path, counters ):
+    """
+    Equivalent of the listdir based psync.dir_scan, where each FSItem does
+    one lstat (cached) for is_dir() / is_file()
+    """
+    dirs = {}
+    files = {}
+    for name in os.listdir( path ):
+        counters[ 'entries' ] += 1
+        counters[ 'stats' ] += 1
+        st = os.lstat( os.path.join( path, name ) )
+        if stat.S_ISDIR( st.st_mode ):
+            dirs[ name ] = st
+        elif stat.S_ISREG( st.st_mode ):
+            files[ name ] = st
+    return ( dirs, files )
+
+
+def scandir_scan( path, counters ):
+    dirs = {}
+    files = {}
+    for ( name, ftype, st ) in dirscan.scan( path, counters ):
+        if ftype == dirscan.DIR:
+            dirs[ name ] = st
+        elif ftype == dirscan.FILE:
+            files[ name ] = st
+    return ( dirs, files )
+
+
+def bench( func, path, repeat ):
+    counters = { 'entries': 0, 'stats': 0 }
+    start = time.time()
+    for i in range( repeat ):
+        func( path, counters )
+    elapsed = max( time.time() - start, 1e-9 )
+    return dict( name          = func.__name__,
+                 stats_per_dir = counters[ 'stats' ] / float( repeat ),
+                 entries_per_s = counters[ 'entries' ] / elapsed )
+
+
+def run():
+    args = process_cmdline()
+    path = args.path
+    if not path:
+        path = mk_synthetic_dir( args.files, args.dirs )
+    try:
+        fmt = '{name:<15} {stats_per_dir:>15} {entries_per_s:>15}'
+        print( fmt.format( name='scanner', stats_per_dir='stats/dir',
+                           entries_per_s='entries/s' ) )
+        for func in ( legacy_scan, scandir_scan ):
+            r = bench( func, path, args.repeat )
+            r[ 'stats_per_dir' ] = '{0:.0f}'.format( r[ 'stats_per_dir' ] )
+            r[ 'entries_per_s' ] = '{0:.0f}'.format( r[ 'entries_per_s' ] )
+            print( fmt.format( **r ) )
+    finally:
+        if not args.path:
+            shutil.rmtree( path )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,103 @@
+#!/bin/env python
+"""
+Memory and message size benchmark: per file records as FSItem-like objects
+holding a full stat_result (what dir_scan used to produce and the file tasks
+used to carry) versus compact dirscan.Entry records.
+
+Reports bytes of memory per record (tracemalloc when available, otherwise
+peak RSS of a child process) and pickled bytes per file in a
+sync_file_batch task argument.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib:$PSYNCBASEDIR/extras \\
+      python extras/bench_entry.py [-n ENTRIES]
+"""
+from __future__ import print_function
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import dirscan
+from bench_dir_diff import Fake_FSItem
+
+try:
+    import cPickle as pickle
+except ( ImportError ) as e:
+    import pickle
+
+try:
+    import tracemalloc
+except ( ImportError ) as e:
+    tracemalloc = None
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--entries', '-n', type=int,
+        help='Number of records to build (default: %(default)s)' )
+    parser.add_argument( '--batch', '-b', type=int,
+        help='Files per sync_file_batch task (default: %(default)s)' )
+    parser.add_argument( '--method', '-m', choices=( 'fsitem', 'entry' ),
+        help='Run a single method in this process (used internally)' )
+    parser.set_defaults( entries=1000000, batch=100 )
+    return parser.parse_args()
+
+
+def _stat( i ):
+    return os.stat_result(
+        ( 0o100644, 1000000 + i, 42, 1, 1000, 1000, i, 0, 1400000000, 0 ) )
+
+
+def mk_fsitem_pair( i ):
+    """ ( src, tgt ) as sent to sync_file_batch before Entry records """
+    name = 'f{0:09d}'.format( i )
+    return ( Fake_FSItem( name, '/mnt/a/x/' + name, '/mnt/a', _stat( i ) ),
+             Fake_FSItem( name, '/mnt/b/x/' + name, '/mnt/b', _stat( i ) ) )
+
+
+def mk_entry( i ):
+    return dirscan.Entry.from_stat( 'f{0:09d}'.format( i ), dirscan.FILE, _stat( i ) )
+
+
+MAKERS = { 'fsitem': mk_fsitem_pair, 'entry': mk_entry }
+
+
+def run_one( args ):
+    mk = MAKERS[ args.method ]
+    if tracemalloc:
+        tracemalloc.start()
+    records = [ mk( i ) for i in range( args.entries ) ]
+    if tracemalloc:
+        mem = tracemalloc.get_traced_memory()[0]
+        source = 'tracemalloc'
+    else:
+        # ru_maxrss is in KiB on Linux
+        mem = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+        source = 'peak RSS'
+    per_rec = float( mem ) / len( records )
+    batch = records[ :args.batch ]
+    msg = len( pickle.dumps( batch, pickle.HIGHEST_PROTOCOL ) )
+    print( '{0:<8} {1:>14.1f} {2:>12} {3:>18.1f}'.format(
+        args.method, per_rec, source, float( msg ) / len( batch ) ) )
+    sys.stdout.flush()
+
+
+def run():
+    args = process_cmdline()
+    if args.method:
+        run_one( args )
+        return
+    print( 'Records: {0}  Batch: {1}'.format( args.entries, args.batch ) )
+    print( '{0:<8} {1:>14} {2:>12} {3:>18}'.format(
+        'method', 'bytes/record', 'measured by', 'pickled bytes/file' ) )
+    sys.stdout.flush()
+    for method in ( 'fsitem', 'entry' ):
+        cmd = [ sys.executable, os.path.abspath( __file__ ),
+                '-n', str( args.entries ), '-b', str( args.batch ),
+                '-m', method ]
+        subprocess.check_call( cmd )
+
+
+if __name__ == '__main__':
+    run()
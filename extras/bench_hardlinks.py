@@ -0,0 +1,183 @@
+#!/bin/env python
+"""
+Hardlink sync benchmark: the single hardlinker (one process syncing every
+link through the shared tmp file of its inode, the way sync_hardlink used
+to run on the 'hardlinks' queue) versus N processes claiming inodes in a
+hardlink_registry.Hardlink_Registry (the current sync_hardlink).
+
+Creates a synthetic tree in SRCDIR of INODES files with LINKS links each,
+spread over DIRS directories, and syncs it into a new target dir in TGTDIR
+once per mode.  The links are shuffled before they are dealt to the
+processes, so links of one inode are synced by different processes at
+about the same time, which is the case the registry has to get right:
+after each run the targets are checked to have one inode per source inode.
+
+Needs a redis server (--redis URL), a registry key per run is created and
+deleted.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib \\
+      python extras/bench_hardlinks.py SRCDIR TGTDIR --redis URL \\
+      [-i INODES] [-l LINKS] [-s SIZE] [-p PROCS ...]
+"""
+from __future__ import print_function
+import argparse
+import collections
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+import redis
+import copy_backend
+import hardlink_registry
+
+OPTS = dict( synctimes=True, syncperms=True, syncowner=False, syncgroup=False,
+             pre_checksums=False, post_checksums=False )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'srcdir', metavar='SRCDIR' )
+    parser.add_argument( 'tgtdir', metavar='TGTDIR' )
+    parser.add_argument( '--redis', required=True, metavar='URL',
+        help='Redis URL, ie: redis://localhost:6379/0' )
+    parser.add_argument( '--inodes', '-i', type=int,
+        help='Number of source inodes (default: %(default)s)' )
+    parser.add_argument( '--links', '-l', type=int,
+        help='Links per inode (default: %(default)s)' )
+    parser.add_argument( '--dirs', '-d', type=int,
+        help='Number of directories (default: %(default)s)' )
+    parser.add_argument( '--size', '-s', type=int,
+        help='Size of each file in bytes (default: %(default)s)' )
+    parser.add_argument( '--procs', '-p', type=int, action='append',
+        help='Number of processes for a registry run (can be repeated, '
+             'default: 1, 4 and 16)' )
+    parser.set_defaults( inodes=2000, links=4, dirs=20, size=65536 )
+    args = parser.parse_args()
+    if not args.procs:
+        args.procs = [ 1, 4, 16 ]
+    return args
+
+
+def mk_tree( srcdir, args ):
+    """
+    :return: tuple ( src root, list of ( inode, relpath ) for every link )
+    """
+    root = tempfile.mkdtemp( prefix='bench_hardlinks_src.', dir=srcdir )
+    for d in range( args.dirs ):
+        os.mkdir( os.path.join( root, 'd{0:04d}'.format( d ) ) )
+    data = os.urandom( args.size )
+    links = []
+    for i in range( args.inodes ):
+        first = None
+        for j in range( args.links ):
+            rel = os.path.join( 'd{0:04d}'.format( ( i + j ) % args.dirs ),
+                                'f{0:07d}.{1}'.format( i, j ) )
+            path = os.path.join( root, rel )
+            if first is None:
+                with open( path, 'wb' ) as f:
+                    f.write( data )
+                first = path
+            else:
+                os.link( first, path )
+            links.append( ( os.lstat( path ).st_ino, rel ) )
+    return ( root, links )
+
+
+def mk_tgt( tgtdir, args ):
+    root = tempfile.mkdtemp( prefix='bench_hardlinks_tgt.', dir=tgtdir )
+    for d in range( args.dirs ):
+        os.mkdir( os.path.join( root, 'd{0:04d}'.format( d ) ) )
+    tmpbase = os.path.join( root, '.tmp' )
+    os.mkdir( tmpbase )
+    return ( root, tmpbase )
+
+
+def sync_serial( src, tgt, tmpbase, links ):
+    backend = copy_backend.Native_Copy()
+    for ( ino, rel ) in links:
+        backend.syncfile( os.path.join( src, rel ), os.path.join( tgt, rel ),
+                          tmpbase, keeptmp=True, **OPTS )
+
+
+def sync_registry( url, run_id, src, tgt, tmpbase, links ):
+    """ One worker process, same steps as psync.sync_hardlink, a link whose
+        first copy is still running goes to the back of the line
+    """
+    registry = hardlink_registry.Hardlink_Registry(
+        redis.Redis.from_url( url ), run_id )
+    backend = copy_backend.Native_Copy()
+    todo = collections.deque( links )
+    while todo:
+        ( ino, rel ) = todo.popleft()
+        ( state, first ) = registry.claim( ino, rel )
+        if state == hardlink_registry.PENDING:
+            todo.append( ( ino, rel ) )
+            if len( todo ) == 1:
+                time.sleep( 0.001 )
+        elif state == hardlink_registry.CLAIMED:
+            backend.syncfile( os.path.join( src, rel ), os.path.join( tgt, rel ),
+                              tmpbase, keeptmp=False, **OPTS )
+            registry.done( ino, rel )
+        else:
+            copy_backend.Native_Copy._replace( os.path.join( tgt, first ),
+                                               os.path.join( tgt, rel ) )
+
+
+def run_registry( url, procs, src, tgt, tmpbase, links ):
+    run_id = 'bench_hardlinks.{0}'.format( uuid.uuid4().hex )
+    workers = [ multiprocessing.Process( target=sync_registry,
+                    args=( url, run_id, src, tgt, tmpbase, links[ i::procs ] ) )
+                for i in range( procs ) ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    hardlink_registry.Hardlink_Registry( redis.Redis.from_url( url ),
+                                         run_id ).delete()
+    if any( w.exitcode != 0 for w in workers ):
+        raise UserWarning( 'Worker process failed' )
+
+
+def check( tgt, links, num_inodes ):
+    """
+    :return: True if every source inode has exactly one target inode
+    """
+    tgt_inodes = collections.defaultdict( set )
+    for ( ino, rel ) in links:
+        tgt_inodes[ ino ].add( os.lstat( os.path.join( tgt, rel ) ).st_ino )
+    return len( tgt_inodes ) == num_inodes \
+       and all( len( v ) == 1 for v in tgt_inodes.values() )
+
+
+def run():
+    args = process_cmdline()
+    ( src, links ) = mk_tree( args.srcdir, args )
+    random.shuffle( links )
+    modes = [ ( 'hardlinker', 1 ) ] + [ ( 'registry', p ) for p in args.procs ]
+    print( 'Inodes: {0}  Links: {1}  Size: {2}  Source: {3}'.format(
+        args.inodes, len( links ), args.size, src ) )
+    print( '{0:<12} {1:>6} {2:>8} {3:>10} {4:>6}'.format(
+        'mode', 'procs', 'secs', 'links/s', 'ok' ) )
+    try:
+        for ( mode, procs ) in modes:
+            ( tgt, tmpbase ) = mk_tgt( args.tgtdir, args )
+            start = time.time()
+            if mode == 'hardlinker':
+                sync_serial( src, tgt, tmpbase, links )
+            else:
+                run_registry( args.redis, procs, src, tgt, tmpbase, links )
+            secs = time.time() - start
+            ok = check( tgt, links, args.inodes )
+            shutil.rmtree( tgt )
+            print( '{0:<12} {1:>6} {2:>8.2f} {3:>10.1f} {4:>6}'.format(
+                mode, procs, secs, len( links ) / secs, ok ) )
+    finally:
+        shutil.rmtree( src )
+
+
+if __name__ == '__main__':
+    run()
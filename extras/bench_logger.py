@@ -0,0 +1,101 @@
+#!/bin/env python
+"""
+Log rate benchmark: one RPUSH per record (the old Redis_Logger) versus the
+buffered Redis_Logger, which pushes from a background thread with pipelined
+RPUSH.
+
+Each mode logs RECORDS SYNCFILE style records from PROCS processes to a
+scratch list on a redis server (default: a local redis-server), which is
+deleted afterwards.  'log' is the rate seen by the logging process (what a
+task pays), 'total' includes the final flush, so all records are in redis.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib \\
+      python extras/bench_logger.py [-n RECORDS] [-p PROCS] [--redis URL]
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import time
+import uuid
+import cbor
+import redis
+import redis_logger
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--records', '-n', type=int,
+        help='Records per process (default: %(default)s)' )
+    parser.add_argument( '--procs', '-p', type=int,
+        help='Number of logging processes (default: %(default)s)' )
+    parser.add_argument( '--redis', metavar='URL',
+        help='Redis URL (default: %(default)s)' )
+    parser.set_defaults( records=20000, procs=1,
+                         redis='redis://localhost:6379/0' )
+    return parser.parse_args()
+
+
+class Unbuffered_Logger( redis_logger.Redis_Logger ):
+    """ One RPUSH per record, same as before records were buffered
+    """
+    def _log_it( self, loglvl, *a, **k ):
+        k.update( sev  = loglvl.upper(),
+                  ts   = int( time.time() ),
+                  host = os.uname()[1],
+                  msg  = ''.join( a ) )
+        self._route( k[ 'sev' ] ).qpush( [ cbor.dumps( k ) ] )
+
+
+def log_records( cls, url, qname, num, results ):
+    logr = cls( url=url, queue_name=qname )
+    src = '/lustre/src/some/dir/file.{0:09d}'
+    start = time.time()
+    for i in range( num ):
+        logr.info( synctype = 'SYNCFILE',
+                   msgtype  = 'end',
+                   src      = src.format( i ),
+                   tgt      = src.format( i ).replace( 'src', 'tgt' ),
+                   action   = 'data_copy' )
+    logged = time.time()
+    logr.flush()
+    results.put( ( logged - start, time.time() - start ) )
+
+
+def run_mode( cls, args, qname ):
+    results = multiprocessing.Queue()
+    procs = [ multiprocessing.Process( target=log_records,
+                  args=( cls, args.redis, qname, args.records, results ) )
+              for i in range( args.procs ) ]
+    for p in procs:
+        p.start()
+    times = [ results.get() for p in procs ]
+    for p in procs:
+        p.join()
+    return ( max( t[0] for t in times ), max( t[1] for t in times ) )
+
+
+def run():
+    args = process_cmdline()
+    conn = redis.Redis.from_url( args.redis )
+    qname = 'bench_logger.{0}'.format( uuid.uuid4().hex )
+    info_qname = redis_logger.queue_name( qname, 'INFO' )
+    total = args.records * args.procs
+    print( 'Records: {0} x {1} procs  Redis: {2}'.format(
+        args.records, args.procs, args.redis ) )
+    print( '{0:<12} {1:>12} {2:>12} {3:>10}'.format(
+        'mode', 'log rec/s', 'total rec/s', 'in redis' ) )
+    try:
+        for ( mode, cls ) in ( ( 'unbuffered', Unbuffered_Logger ),
+                               ( 'buffered', redis_logger.Redis_Logger ) ):
+            conn.delete( info_qname )
+            ( logged, flushed ) = run_mode( cls, args, qname )
+            print( '{0:<12} {1:>12.0f} {2:>12.0f} {3:>10}'.format(
+                mode, total / logged, total / flushed, conn.llen( info_qname ) ) )
+    finally:
+        conn.delete( info_qname )
+
+
+if __name__ == '__main__':
+    run()
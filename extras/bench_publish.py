@@ -0,0 +1,91 @@
+#!/bin/env python
+"""
+Publish rate benchmark: one apply_async per child task (the old sync_dir)
+versus bulk publishing through task_publisher.Task_Publisher (the current
+sync_dir), for the child tasks of one synthetic directory.
+
+By default the broker is kombu's in-process memory transport, which stands
+in for a local broker and measures the client side cost only (routing,
+serialization, producer acquire).  Pass --broker amqp://... to measure
+against a real RabbitMQ, including publisher confirms.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib:$PSYNCBASEDIR/extras \\
+      python extras/bench_publish.py [-n MESSAGES] [--broker URL]
+"""
+from __future__ import print_function
+import argparse
+import time
+import uuid
+import celery
+import cbor_serializer
+import dirscan
+import task_publisher
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--messages', '-n', type=int,
+        help='Number of child tasks to publish (default: %(default)s)' )
+    parser.add_argument( '--batch', '-b', type=int,
+        help='Task_Publisher batch size (default: %(default)s)' )
+    parser.add_argument( '--broker',
+        help='Broker URL (default: %(default)s)' )
+    parser.add_argument( '--no_confirms', action='store_false', dest='confirms',
+        help='Do not use publisher confirms in bulk mode' )
+    parser.set_defaults( messages=50000, batch=task_publisher.BATCH_SIZE,
+                         broker='memory://' )
+    return parser.parse_args()
+
+
+def mk_app( broker ):
+    app = celery.Celery( 'bench_publish', broker=broker )
+    app.conf.update( CELERY_TASK_SERIALIZER=cbor_serializer.NAME,
+                     CELERY_ACCEPT_CONTENT=[ cbor_serializer.NAME ] )
+
+    @app.task
+    def sync_file( run_id, relpath, entry ):
+        pass
+    return ( app, sync_file )
+
+
+def child_args( n ):
+    """ Args of the sync_file tasks of one directory with n files """
+    run_id = uuid.uuid4().hex
+    for i in range( n ):
+        entry = dirscan.Entry( 'f{0:09d}'.format( i ), dirscan.FILE,
+                               i, 1400000000, 0o100644, 1000, 1000, 1, i )
+        yield ( run_id, 'x', entry )
+
+
+def run_single( app, task, args ):
+    for a in child_args( args.messages ):
+        task.apply_async( a )
+
+
+def run_bulk( app, task, args ):
+    with task_publisher.Task_Publisher( app, batch_size=args.batch,
+                                        confirms=args.confirms ) as publisher:
+        for a in child_args( args.messages ):
+            publisher.add( task, a )
+
+
+def run():
+    args = process_cmdline()
+    cbor_serializer.register()
+    print( 'Broker: {0}  Messages: {1}  Batch: {2}'.format(
+        args.broker, args.messages, args.batch ) )
+    print( '{0:<8} {1:>10} {2:>12}'.format( 'method', 'secs', 'messages/s' ) )
+    for ( name, method ) in ( ( 'single', run_single ), ( 'bulk', run_bulk ) ):
+        ( app, task ) = mk_app( args.broker )
+        # connect (and declare queues) outside the timed section
+        task.apply_async( next( child_args( 1 ) ) )
+        start = time.time()
+        method( app, task, args )
+        elapsed = time.time() - start
+        print( '{0:<8} {1:>10.2f} {2:>12.0f}'.format(
+            name, elapsed, args.messages / elapsed ) )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,165 @@
+#!/bin/env python
+"""
+Task message size benchmark: pickled FSItem arguments (sync_dir with src and
+tgt FSItems, sync_file_batch with parent dir FSItems) versus the CBOR wire
+format (run id plus path relative to the run roots, Entry fields as lists).
+
+Replays the sync_dir fan-out of a real directory tree: for every directory
+under PATH, the sync_dir tasks for its subdirs and the sync_file_batch /
+sync_file tasks for its files are built in both formats.
+
+Reports message count, bytes per message (celery message body) and the
+memory held by an in-process broker (kombu memory:// transport, measured as
+RSS growth of a child process) after publishing all of them.
+
+Usage:
+  PYTHONPATH=$PSYNCBASEDIR/lib:$PSYNCBASEDIR/extras \\
+      python extras/bench_wire.py PATH
+"""
+from __future__ import print_function
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import uuid
+import celery
+import kombu.serialization
+import cbor_serializer
+import dirscan
+import task_publisher
+from bench_dir_diff import Fake_FSItem
+
+FORMATS = { 'pickle': 'pickle', 'cbor': cbor_serializer.NAME }
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'path', metavar='PATH' )
+    parser.add_argument( '--batch_count', type=int,
+        help='Files per sync_file_batch task (default: %(default)s)' )
+    parser.add_argument( '--format', '-f', choices=sorted( FORMATS ),
+        help='Run a single format in this process (used internally)' )
+    parser.set_defaults( batch_count=100 )
+    return parser.parse_args()
+
+
+def fanouts( root, batch_count ):
+    """
+    Walk root, yield tuples ( relpath, subdir names, file Entries ) for each
+    directory, as seen by sync_dir
+    """
+    todo = [ '' ]
+    while len( todo ) > 0:
+        relpath = todo.pop()
+        dirs = []
+        files = []
+        for ( name, ftype, st ) in dirscan.scan( os.path.join( root, relpath ) ):
+            if ftype == dirscan.DIR:
+                dirs.append( name )
+            elif ftype == dirscan.FILE:
+                files.append( dirscan.Entry.from_stat( name, ftype, st ) )
+        todo.extend( os.path.join( relpath, d ) for d in dirs )
+        yield ( relpath, dirs, files )
+
+
+def _batches( files, batch_count ):
+    for i in range( 0, len( files ), batch_count ):
+        yield files[ i:i + batch_count ]
+
+
+def messages( fmt, root, batch_count ):
+    """
+    Yield ( task name, args ) for every task sent while syncing root
+    """
+    run_id = uuid.uuid4().hex
+    for ( relpath, dirs, files ) in fanouts( root, batch_count ):
+        if fmt == 'pickle':
+            src = Fake_FSItem( os.path.basename( relpath ),
+                os.path.join( root, relpath ), root,
+                os.lstat( os.path.join( root, relpath ) ) )
+            tgt = Fake_FSItem( src.name, '/mnt/tgt/' + relpath, '/mnt/tgt',
+                               src._stat )
+            for d in dirs:
+                st = os.lstat( os.path.join( root, relpath, d ) )
+                yield ( 'sync_dir', ( run_id,
+                    Fake_FSItem( d, os.path.join( src.absname, d ), root, st ),
+                    Fake_FSItem( d, os.path.join( tgt.absname, d ), '/mnt/tgt', st ) ) )
+            for batch in _batches( files, batch_count ):
+                yield ( 'sync_file_batch', ( run_id, src, tgt, batch ) )
+        else:
+            for d in dirs:
+                yield ( 'sync_dir', ( run_id, os.path.join( relpath, d ) ) )
+            for batch in _batches( files, batch_count ):
+                yield ( 'sync_file_batch', ( run_id, relpath, batch ) )
+
+
+def body( name, args ):
+    """ Celery (protocol 1) message body, as built by TaskProducer """
+    return { 'task': 'psync.' + name, 'id': str( uuid.uuid4() ),
+             'args': args, 'kwargs': {}, 'retries': 0, 'eta': None,
+             'expires': None, 'utc': True, 'callbacks': None,
+             'errbacks': None, 'timelimit': ( None, None ),
+             'taskset': None, 'chord': None }
+
+
+def mk_app( fmt ):
+    app = celery.Celery( 'bench_wire', broker='memory://' )
+    app.conf.update( CELERY_TASK_SERIALIZER=FORMATS[ fmt ],
+                     CELERY_ACCEPT_CONTENT=[ FORMATS[ fmt ] ] )
+    tasks = {}
+
+    @app.task( name='psync.sync_dir' )
+    def sync_dir( *a ):
+        pass
+
+    @app.task( name='psync.sync_file_batch' )
+    def sync_file_batch( *a ):
+        pass
+    tasks[ 'sync_dir' ] = sync_dir
+    tasks[ 'sync_file_batch' ] = sync_file_batch
+    return ( app, tasks )
+
+
+def run_one( args ):
+    count = 0
+    nbytes = 0
+    for ( name, targs ) in messages( args.format, args.path, args.batch_count ):
+        ( ctype, cenc, data ) = kombu.serialization.dumps(
+            body( name, targs ), serializer=FORMATS[ args.format ] )
+        count += 1
+        nbytes += len( data )
+    ( app, tasks ) = mk_app( args.format )
+    # connect outside of the measured section
+    with task_publisher.Task_Publisher( app ) as publisher:
+        pass
+    # ru_maxrss is in KiB on Linux
+    rss_before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    with task_publisher.Task_Publisher( app ) as publisher:
+        for ( name, targs ) in messages( args.format, args.path, args.batch_count ):
+            publisher.add( tasks[ name ], targs )
+    rss_after = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    print( '{0:<8} {1:>10} {2:>12.1f} {3:>14.1f} {4:>16.1f}'.format(
+        args.format, count, float( nbytes ) / max( count, 1 ),
+        nbytes / 1048576.0, ( rss_after - rss_before ) / 1024.0 ) )
+    sys.stdout.flush()
+
+
+def run():
+    args = process_cmdline()
+    cbor_serializer.register()
+    if args.format:
+        run_one( args )
+        return
+    print( 'Tree: {0}  Batch: {1}'.format( args.path, args.batch_count ) )
+    print( '{0:<8} {1:>10} {2:>12} {3:>14} {4:>16}'.format(
+        'format', 'messages', 'bytes/msg', 'total MiB', 'broker RSS MiB' ) )
+    sys.stdout.flush()
+    for fmt in ( 'pickle', 'cbor' ):
+        cmd = [ sys.executable, os.path.abspath( __file__ ), args.path,
+                '--batch_count', str( args.batch_count ), '-f', fmt ]
+        subprocess.check_call( cmd )
+
+
+if __name__ == '__main__':
+    run()
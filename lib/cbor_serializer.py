@@ -0,0 +1,25 @@
+import cbor
+import kombu.serialization
+
+# Name to use in CELERY_TASK_SERIALIZER and CELERY_ACCEPT_CONTENT
+NAME = 'psync_cbor'
+CONTENT_TYPE = 'application/x-psync-cbor'
+
+
+def register():
+    """
+    Register the CBOR serializer with kombu.
+    Must be called in every process that sends or receives psync tasks,
+    before the first message is sent or received.
+
+    Only plain data can be encoded: tuples (and namedtuples, like
+    dirscan.Entry) arrive as lists, str is encoded as a CBOR byte string
+    so names that are not valid in any encoding survive unchanged.
+    """
+    kombu.serialization.register( NAME, cbor.dumps, cbor.loads,
+                                  content_type=CONTENT_TYPE,
+                                  content_encoding='binary' )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,143 @@
+import os
+import time
+import struct
+import binascii
+import copy_backend
+
+# Number of inodes per redis hash, small enough for the hashes to stay
+# ziplist encoded (see redis hash-max-ziplist-entries)
+BUCKET_BITS = 7
+
+# Files changed less than this many seconds ago are hashed but not cached,
+# a write in the same timestamp tick would not change their identity
+RACY_SECS = 2
+
+_IDENTITY = struct.Struct( '<Qdd' )
+
+_mount_table = None
+
+
+def identity( st ):
+    """
+    :param st os.stat_result: stat data of a file
+    :return: str, packed ( size, mtime, ctime ) of st
+    """
+    return _IDENTITY.pack( st.st_size, st.st_mtime, st.st_ctime )
+
+
+def pack( st, digest ):
+    """
+    :param digest str: hex digest of the file with stat data st
+    :return: str, cache value (identity followed by the raw digest)
+    """
+    return identity( st ) + binascii.unhexlify( digest )
+
+
+def unpack( value, st ):
+    """
+    :param value str: cache value (see pack)
+    :param st os.stat_result: current stat data of the file
+    :return: hex digest if value is for the file as it is now, None otherwise
+    """
+    if value is None or value[ :_IDENTITY.size ] != identity( st ):
+        return None
+    return binascii.hexlify( value[ _IDENTITY.size: ] )
+
+
+def _mountpoint( path ):
+    global _mount_table
+    if _mount_table is None:
+        _mount_table = copy_backend.mounts()
+    return copy_backend.mountpoint( path, _mount_table )
+
+
+class Checksum_Cache( object ):
+    """ Checksums of files, reused while the file does not change
+
+    Digests are stored in redis, so they are shared by all workers and kept
+    from one run to the next.  A file is identified by the mountpoint of its
+    filesystem (the same on every worker, unlike st_dev) and its inode, a
+    digest is only used if the size, mtime and ctime of the file are the same
+    as when it was computed.
+    Inodes are grouped in redis hashes 'psync_chksum:<algo>:<mountpoint>:<n>'
+    of 2**BUCKET_BITS inodes each, the field is the inode.
+    Hits and misses are counted per Checksum_Cache.
+    """
+
+    key_prefix = 'psync_chksum:'
+
+    def __init__( self, conn, algo='md5' ):
+        """
+        :param conn redis.Redis: redis connection
+        :param algo str: checksum algorithm (see copy_backend.ALGORITHMS)
+        """
+        self.conn = conn
+        self.algo = algo
+        self.hits = 0
+        self.misses = 0
+
+
+    def _key( self, path, st ):
+        """
+        :return: tuple ( redis key, field ) for path, None if its mountpoint
+                 is unknown (not cached then)
+        """
+        mountpoint = _mountpoint( path )
+        if mountpoint is None:
+            return None
+        return ( '{0}{1}:{2}:{3}'.format( self.key_prefix, self.algo,
+                     mountpoint, st.st_ino >> BUCKET_BITS ),
+                 st.st_ino )
+
+
+    def get( self, path, st ):
+        """
+        :param st os.stat_result: current stat data of path
+        :return: cached hex digest of path, None if there is none for the
+                 file as it is now
+        """
+        key = self._key( path, st )
+        if key is None:
+            return None
+        return unpack( self.conn.hget( *key ), st )
+
+
+    def put( self, path, st, digest, written=False ):
+        """
+        Save digest as the checksum of path, as of stat data st
+        Concurrent puts for the same inode are harmless, the last one wins
+        and get checks the identity anyway.
+        :param written bool: digest is of the data the caller just wrote to
+                             path, cached even if path changed less than
+                             RACY_SECS ago (nobody else writes to it)
+        """
+        if not written and time.time() - st.st_ctime < RACY_SECS:
+            return
+        key = self._key( path, st )
+        if key is None:
+            return
+        self.conn.hset( key[0], key[1], pack( st, digest ) )
+
+
+    def checksum( self, path ):
+        """
+        :param path str: file
+        :return: hex digest of path, from the cache if it is current,
+                 otherwise computed (and cached if the file did not change
+                 while it was read)
+        """
+        st = os.lstat( path )
+        digest = self.get( path, st )
+        if digest is not None:
+            self.hits += 1
+            return digest
+        self.misses += 1
+        digest = copy_backend.checksum( path, self.algo )
+        after = os.lstat( path )
+        if os.path.samestat( after, st ) and identity( after ) == identity( st ):
+            self.put( path, st, digest )
+        return digest
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,200 @@
+import os
+import errno
+import hashlib
+import ctypes
+import ctypes.util
+import copy_backend
+
+# Number of times a failed chunk is retried (on its own) before the whole
+# file is given up on
+CHUNK_RETRIES = 3
+
+
+def chunk_ranges( size, chunk_bytes ):
+    """
+    :param size int: file size
+    :param chunk_bytes int: max size of a chunk
+    :return: list of tuples ( offset, length ) covering size bytes
+    """
+    return [ ( offset, min( chunk_bytes, size - offset ) )
+             for offset in range( 0, size, chunk_bytes ) ]
+
+
+def _fallocate():
+    libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+    func = getattr( libc, 'fallocate', None )
+    if func is not None:
+        func.argtypes = [ ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64, ctypes.c_int64 ]
+    return func
+
+_fallocate_func = _fallocate()
+
+
+def create( path, size ):
+    """
+    Create (or reuse) file path of size bytes, for chunks to be written into
+    at their offsets.  Space is preallocated where the filesystem supports
+    fallocate, otherwise the file is extended sparse (never by writing zeros,
+    as posix_fallocate would).  The file is private (0600) until finish.
+    """
+    fd = os.open( path, os.O_WRONLY | os.O_CREAT, 0o600 )
+    try:
+        if _fallocate_func is not None \
+        and _fallocate_func( fd, 0, 0, size ) != 0:
+            err = ctypes.get_errno()
+            if err not in ( errno.EOPNOTSUPP, errno.ENOSYS ):
+                raise OSError( err, os.strerror( err ) )
+        os.ftruncate( fd, size )
+    finally:
+        os.close( fd )
+
+
+def copy_chunk( src_path, tmp_path, offset, length, checksum=None,
+                reread=False ):
+    """
+    Copy bytes offset to offset + length of src_path into the same range
+    of tmp_path (see create).
+    Both files are opened privately, so the positioned copy is done by
+    seeking, which works with every copy_backend method.
+    :param checksum str: (optional) algorithm to hash the chunk with, while
+                         it is copied (see copy_backend.ALGORITHMS)
+    :param reread bool: with checksum, hash the chunk in tmp_path by reading
+                        it back instead of hashing the data written
+    :return: tuple ( src checksum, tgt checksum ) of the chunk with
+             checksum set, None otherwise
+    :raises IOError: src_path is shorter than the chunk
+    """
+    hasher = hashlib.new( checksum ) if checksum else None
+    src_fd = os.open( src_path, os.O_RDONLY )
+    try:
+        tgt_fd = os.open( tmp_path, os.O_WRONLY )
+        try:
+            os.lseek( src_fd, offset, os.SEEK_SET )
+            os.lseek( tgt_fd, offset, os.SEEK_SET )
+            copy_backend.copy_fd( src_fd, tgt_fd, length=length, hasher=hasher )
+            copied = os.lseek( tgt_fd, 0, os.SEEK_CUR ) - offset
+        finally:
+            os.close( tgt_fd )
+    finally:
+        os.close( src_fd )
+    if copied != length:
+        raise IOError( errno.EIO, 'Short copy of chunk at offset {0}: '
+            '{1} of {2} bytes'.format( offset, copied, length ) )
+    if hasher is None:
+        return None
+    if reread:
+        return ( hasher.hexdigest(),
+                 copy_backend.checksum( tmp_path, checksum, offset, length ) )
+    return ( hasher.hexdigest(), hasher.hexdigest() )
+
+
+def finish( src_path, tmp_path, tgt_path, entry, syncopts ):
+    """
+    Verify that all chunks of tmp_path are in and src_path did not change
+    during the copy, set metadata and rename tmp_path to tgt_path.
+    :param entry dirscan.Entry: src file, as scanned when the copy started
+    :param syncopts dict: rsync options (synctimes, syncperms, syncowner,
+                          syncgroup)
+    :return: action_type dict, same as copy_backend.Native_Copy.syncfile
+    :raises copy_backend.Copy_Error:
+    """
+    try:
+        src_st = os.lstat( src_path )
+        if ( src_st.st_size, src_st.st_mtime ) != ( entry.size, entry.mtime ):
+            raise copy_backend.Copy_Error( 'Source changed during chunked copy' )
+        tmp_st = os.lstat( tmp_path )
+        if tmp_st.st_size != entry.size:
+            raise copy_backend.Copy_Error( 'Size mismatch {0} != {1}'.format(
+                tmp_st.st_size, entry.size ) )
+        if not syncopts[ 'syncperms' ]:
+            # created 0600, see create
+            os.chmod( tmp_path, copy_backend.new_file_mode( src_st ) )
+        copy_backend.set_meta( tmp_path, tmp_st, src_st,
+                               syncopts[ 'synctimes' ], syncopts[ 'syncperms' ],
+                               syncopts[ 'syncowner' ], syncopts[ 'syncgroup' ] )
+        os.rename( tmp_path, tgt_path )
+    except ( OSError, IOError ) as e:
+        raise copy_backend.Copy_Error( '{0}: {1}'.format( type( e ).__name__, e ) )
+    return { 'data_copy': True, 'meta_update': False }
+
+
+class Chunk_Tracker( object ):
+    """ Per chunk progress and failures of one chunked file, in redis
+
+    'psync_chunks:<run_id>:<inode>' is a hash with the number of chunks,
+    retry counts ('retries:<index>') and errors ('failed:<index>') per chunk.
+    'psync_chunks:<run_id>:<inode>:finished' is the set of chunk indexes that
+    are finished (done or failed for good), so a chunk that runs twice
+    (ie: redelivered) is counted once.
+    """
+
+    key_prefix = 'psync_chunks:'
+
+    def __init__( self, conn, run_id, inode ):
+        """
+        :param conn redis.Redis: redis connection
+        :param run_id str: psync run (see run_registry)
+        :param inode int: inode of the src file
+        """
+        self.conn = conn
+        self.key = '{0}{1}:{2}'.format( self.key_prefix, run_id, inode )
+        self.finished_key = self.key + ':finished'
+
+
+    def start( self, num_chunks ):
+        pipe = self.conn.pipeline()
+        pipe.delete( self.key, self.finished_key )
+        pipe.hset( self.key, 'num_chunks', num_chunks )
+        pipe.execute()
+
+
+    def _finish( self, index, *fields ):
+        """
+        Mark chunk index as finished
+        :return: True if this was the last chunk to finish, False otherwise
+        """
+        pipe = self.conn.pipeline()
+        if fields:
+            pipe.hset( self.key, *fields )
+        pipe.sadd( self.finished_key, index )
+        pipe.scard( self.finished_key )
+        pipe.hget( self.key, 'num_chunks' )
+        ( added, num_finished, num_chunks ) = pipe.execute()[-3:]
+        return bool( added ) and num_finished == int( num_chunks )
+
+
+    def done( self, index ):
+        """ Chunk index is copied, see _finish for return value
+        """
+        return self._finish( index )
+
+
+    def failed( self, index, error ):
+        """ Chunk index failed for good, see _finish for return value
+        """
+        return self._finish( index, 'failed:{0}'.format( index ), error )
+
+
+    def retried( self, index ):
+        """
+        :return: int, number of retries of chunk index so far
+        """
+        return self.conn.hincrby( self.key, 'retries:{0}'.format( index ), 1 )
+
+
+    def failures( self ):
+        """
+        :return: dict mapping chunk index to error, for failed chunks
+        """
+        return { int( k.split( ':', 1 )[1] ): v
+                 for ( k, v ) in self.conn.hgetall( self.key ).iteritems()
+                 if k.startswith( 'failed:' ) }
+
+
+    def delete( self ):
+        self.conn.delete( self.key, self.finished_key )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,451 @@
+import os
+import errno
+import stat
+import time
+import hashlib
+import tempfile
+import collections
+import functools
+import ctypes
+import ctypes.util
+
+# pylut (and with it Lustre support) is optional, the native backend works
+# on any POSIX filesystem
+try:
+    import pylut
+except ( ImportError ) as e:
+    pylut = None
+
+# Bytes per copy_file_range / sendfile / read call
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# errno values that mean a copy method is not supported for this pair of
+# files (or on this kernel), the next method is tried from the same offset
+FALLBACK_ERRNOS = ( errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                    errno.EOPNOTSUPP, errno.ENOTSUP )
+
+# Checksum algorithms that can be computed during a copy
+ALGORITHMS = getattr( hashlib, 'algorithms_guaranteed', hashlib.algorithms )
+
+# Tmp file, as returned by syncfile (nlink is that of the tmp file after sync)
+Tmp_File = collections.namedtuple( 'Tmp_File', 'absname nlink' )
+
+
+class Copy_Error( Exception ):
+    pass
+
+
+def _libc_copy_func( name, argtypes, call ):
+    """
+    Wrap libc function name (for pythons without os.copy_file_range /
+    os.sendfile)
+    :param call function: ( func, src_fd, tgt_fd, count ) -> func result
+    :return: function ( src_fd, tgt_fd, count ) -> bytes copied, None if
+             libc does not have the function
+    """
+    libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+    func = getattr( libc, name, None )
+    if func is None:
+        return None
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = argtypes
+    def copy( src_fd, tgt_fd, count ):
+        rv = call( func, src_fd, tgt_fd, count )
+        if rv < 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ) )
+        return rv
+    return copy
+
+
+def _copy_file_range():
+    if hasattr( os, 'copy_file_range' ):
+        return os.copy_file_range
+    return _libc_copy_func( 'copy_file_range',
+        [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+          ctypes.c_size_t, ctypes.c_uint ],
+        lambda f, s, t, n: f( s, None, t, None, n, 0 ) )
+
+
+def _sendfile():
+    if hasattr( os, 'sendfile' ):
+        return lambda s, t, n: os.sendfile( t, s, None, n )
+    return _libc_copy_func( 'sendfile',
+        [ ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t ],
+        lambda f, s, t, n: f( t, s, None, n ) )
+
+
+def _read_write( src_fd, tgt_fd, count, hasher=None ):
+    data = os.read( src_fd, count )
+    if hasher is not None:
+        hasher.update( data )
+    view = memoryview( data )
+    while len( view ) > 0:
+        view = view[ os.write( tgt_fd, view ): ]
+    return len( data )
+
+
+# Copy methods in order of preference, each is a function
+# ( src_fd, tgt_fd, count ) -> bytes copied (0 at end of file) that copies
+# from and advances the current file offsets
+METHODS = collections.OrderedDict( ( k, v ) for ( k, v ) in (
+    ( 'copy_file_range', _copy_file_range() ),
+    ( 'sendfile', _sendfile() ),
+    ( 'read', _read_write ) ) if v is not None )
+
+
+def copy_fd( src_fd, tgt_fd, methods=None, length=None, hasher=None ):
+    """
+    Copy data from the current offset of src_fd to the current offset of
+    tgt_fd, up to end of file (or length bytes).
+    Methods are tried in order, if one is not supported the next one takes
+    over at the current offset.
+    :param methods list: names of METHODS to try (default: all)
+    :param length int: (optional) max number of bytes to copy
+    :param hasher hashlib hash: (optional) updated with the data as it is
+                                copied, only the 'read' method can do that
+    :return: name of the method that finished the copy
+    """
+    if methods is None:
+        methods = METHODS.keys()
+    if hasher is not None:
+        methods = [ 'read' ]
+    left = length
+    for name in methods:
+        func = METHODS[ name ]
+        if hasher is not None:
+            func = functools.partial( func, hasher=hasher )
+        try:
+            while left is None or left > 0:
+                count = CHUNK_SIZE if left is None else min( left, CHUNK_SIZE )
+                copied = func( src_fd, tgt_fd, count )
+                if copied == 0:
+                    break
+                if left is not None:
+                    left -= copied
+            return name
+        except ( OSError ) as e:
+            if e.errno not in FALLBACK_ERRNOS or name == methods[-1]:
+                raise e
+    raise UserWarning( 'No copy methods in {0}'.format( methods ) )
+
+
+def checksum( path, algo='md5', offset=0, length=None ):
+    """
+    Read and hash path (or length bytes of it from offset)
+    :param algo str: one of ALGORITHMS
+    :return: hex digest
+    """
+    h = hashlib.new( algo )
+    with open( path, 'rb' ) as f:
+        f.seek( offset )
+        left = length
+        while left is None or left > 0:
+            data = f.read( CHUNK_SIZE if left is None else min( left, CHUNK_SIZE ) )
+            if not data:
+                break
+            h.update( data )
+            if left is not None:
+                left -= len( data )
+    return h.hexdigest()
+
+
+def lstat_or_none( path ):
+    """ lstat, None if path does not exist """
+    try:
+        return os.lstat( path )
+    except ( OSError ) as e:
+        if e.errno != errno.ENOENT:
+            raise e
+    return None
+
+
+_umask = None
+
+
+def new_file_mode( src_st ):
+    """
+    Permissions of a new copy of a file when permissions are not synced,
+    same as rsync without --perms gives it: the source permissions masked
+    by the umask, without setuid, setgid and sticky bits
+    :param src_st stat_result: stat of the source file
+    :return: int, mode bits
+    """
+    global _umask
+    if _umask is None:
+        # no way to read the umask without setting it
+        _umask = os.umask( 0 )
+        os.umask( _umask )
+    return stat.S_IMODE( src_st.st_mode ) & 0o777 & ~_umask
+
+
+def set_meta( path, st, src_st, synctimes, syncperms, syncowner,
+              syncgroup ):
+    """
+    Set the requested metadata of path (stat st) from src_st
+    :return: True if anything was changed, False otherwise
+    """
+    changed = False
+    uid = src_st.st_uid if syncowner and st.st_uid != src_st.st_uid else -1
+    gid = src_st.st_gid if syncgroup and st.st_gid != src_st.st_gid else -1
+    if uid != -1 or gid != -1:
+        os.lchown( path, uid, gid )
+        changed = True
+    if syncperms and stat.S_IMODE( st.st_mode ) != stat.S_IMODE( src_st.st_mode ):
+        os.chmod( path, stat.S_IMODE( src_st.st_mode ) )
+        changed = True
+    if synctimes and int( st.st_mtime ) != int( src_st.st_mtime ):
+        os.utime( path, ( time.time(), src_st.st_mtime ) )
+        changed = True
+    return changed
+
+
+def replace_link( existing, path ):
+    """
+    Make path a hardlink to existing, replacing path atomically
+    if it exists
+    """
+    link_path = '{0}.{1}.psynclink'.format( path, os.getpid() )
+    os.link( existing, link_path )
+    try:
+        os.rename( link_path, path )
+    except:
+        os.unlink( link_path )
+        raise
+
+
+def is_current( path, st, src_path, src_st, pre_checksums, synctimes,
+                checksummer=None ):
+    """
+    Does the data of path already match src_path (same rules as rsync)
+    :param st stat_result: lstat of path, None if it does not exist
+    :param src_st stat_result: lstat of src_path
+    :param pre_checksums bool: compare data by checksum instead of by size
+                               and mtime
+    :param synctimes bool: mtimes are synced, so they must be equal
+    :param checksummer function: ( path ) -> hex digest (default: md5 of
+                                 the file)
+    :return: True if it does, False otherwise
+    """
+    if st is None or st.st_size != src_st.st_size:
+        return False
+    if pre_checksums:
+        if checksummer is None:
+            checksummer = checksum
+        return checksummer( path ) == checksummer( src_path )
+    if synctimes:
+        return int( st.st_mtime ) == int( src_st.st_mtime )
+    return st.st_mtime >= src_st.st_mtime
+
+
+class Native_Copy( object ):
+    """ Copy files in process, for any pair of POSIX filesystems
+
+    Same sync semantics as pylut.syncfile, without rsync or dd:
+    data is copied to a temporary file in tmpbase which is renamed to the
+    tmp file for the source inode, metadata is set on that and the target is
+    made a hardlink to it (hardlinks to the same source inode share the tmp
+    file).  A tmp file (or target) whose data already matches is reused.
+    """
+
+    name = 'native'
+
+    def __init__( self, methods=None ):
+        """
+        :param methods list: names of METHODS to try, in order (default: all)
+        """
+        self.methods = methods
+
+
+    def syncfile( self, src, tgt, tmpbase, keeptmp=False, synctimes=False,
+                  syncperms=False, syncowner=False, syncgroup=False,
+                  pre_checksums=False, post_checksums=False, checksum=None,
+                  reread=False, checksummer=None ):
+        """
+        Sync file src to tgt
+        :param src FSItem: src file (or path)
+        :param tgt FSItem: tgt file (or path)
+        :param tmpbase str: dir for tmp files, on the target filesystem
+        :param keeptmp bool: leave the tmp file (for later hardlinks)
+        :param pre_checksums bool: compare data by checksum instead of by
+                                   size and mtime
+        :param post_checksums bool: not used (see checksum)
+        :param checksum str: (optional) algorithm (see ALGORITHMS) to hash
+                             copied data with, while it is copied
+        :param reread bool: with checksum, hash the target by reading it
+                            back instead of hashing the data written to it
+        :param checksummer function: ( path ) -> hex digest, used to compare
+                                     data with pre_checksums (default:
+                                     md5 of the file, see checksum_cache)
+        :return: tuple ( Tmp_File, action_type ) where action_type is a dict
+                 with bool values for 'data_copy' and 'meta_update', plus
+                 'src_chksum' and 'tgt_chksum' if data was copied with
+                 checksum set
+        """
+        try:
+            return self._syncfile( str( src ), str( tgt ), tmpbase, keeptmp,
+                                   synctimes, syncperms, syncowner, syncgroup,
+                                   pre_checksums, checksum, reread,
+                                   checksummer )
+        except ( OSError, IOError ) as e:
+            raise Copy_Error( '{0}: {1}'.format( type( e ).__name__, e ) )
+
+
+    def _syncfile( self, src_path, tgt_path, tmpbase, keeptmp, synctimes,
+                   syncperms, syncowner, syncgroup, pre_checksums, algo,
+                   reread, checksummer ):
+        action_type = { 'data_copy': False, 'meta_update': False }
+        if checksummer is None:
+            checksummer = checksum
+        src_st = os.lstat( src_path )
+        tmp_path = os.path.join( tmpbase, str( src_st.st_ino ) )
+        tmp_st = lstat_or_none( tmp_path )
+        tgt_st = lstat_or_none( tgt_path )
+        def current( path, st ):
+            return is_current( path, st, src_path, src_st, pre_checksums,
+                               synctimes, checksummer )
+        if not current( tmp_path, tmp_st ):
+            if current( tgt_path, tgt_st ):
+                replace_link( tgt_path, tmp_path )
+            else:
+                hasher = hashlib.new( algo ) if algo else None
+                # with syncperms the mode is set by set_meta (after chown)
+                mode = None if syncperms else new_file_mode( src_st )
+                self._copy( src_path, tmp_path, hasher, mode )
+                action_type[ 'data_copy' ] = True
+                if hasher is not None:
+                    action_type[ 'src_chksum' ] = hasher.hexdigest()
+                    action_type[ 'tgt_chksum' ] = hasher.hexdigest()
+                    if reread:
+                        action_type[ 'tgt_chksum' ] = checksum( tmp_path, algo )
+            tmp_st = os.lstat( tmp_path )
+        if set_meta( tmp_path, tmp_st, src_st, synctimes, syncperms,
+                     syncowner, syncgroup ):
+            action_type[ 'meta_update' ] = True
+        if tgt_st is None or not os.path.samestat( tgt_st, tmp_st ):
+            replace_link( tmp_path, tgt_path )
+        nlink = os.lstat( tmp_path ).st_nlink
+        if not keeptmp:
+            os.unlink( tmp_path )
+        return ( Tmp_File( tmp_path, nlink ), action_type )
+
+
+    def _copy( self, src_path, tmp_path, hasher=None, mode=None ):
+        """
+        Copy data of src_path to a new file, renamed to tmp_path when
+        complete (so tmp_path never holds partial data)
+        :param hasher hashlib hash: (optional) see copy_fd
+        :param mode int: (optional) permissions of the new file (mkstemp
+                         creates it 0600)
+        """
+        ( fd, part_path ) = tempfile.mkstemp( dir=os.path.dirname( tmp_path ),
+            prefix='{0}.'.format( os.path.basename( tmp_path ) ) )
+        try:
+            src_fd = os.open( src_path, os.O_RDONLY )
+            try:
+                copy_fd( src_fd, fd, self.methods, hasher=hasher )
+            finally:
+                os.close( src_fd )
+            if mode is not None:
+                os.fchmod( fd, mode )
+            os.close( fd )
+            fd = None
+            os.rename( part_path, tmp_path )
+        except:
+            if fd is not None:
+                os.close( fd )
+            os.unlink( part_path )
+            raise
+
+
+class Pylut_Copy( object ):
+    """ Lustre stripe aware copy (rsync or dd per file), see pylut.syncfile
+    """
+
+    name = 'pylut'
+
+    def syncfile( self, src, tgt, checksum=None, reread=False,
+                  checksummer=None, **rsyncopts ):
+        """
+        Same parameters and return value as Native_Copy.syncfile, except
+        that checksums are never computed during the copy (the caller has to
+        read the files again)
+        """
+        try:
+            return pylut.syncfile( src, tgt, **rsyncopts )
+        except ( pylut.PylutError ) as e:
+            raise Copy_Error( str( e ) )
+
+
+def _unescape( field ):
+    """ Undo the octal escapes (ie: space is \\040) of /proc/mounts fields
+    """
+    return field.decode( 'string_escape' ) if '\\' in field else field
+
+
+def mounts( path='/proc/mounts' ):
+    """
+    :return: dict mapping mountpoint to filesystem type (the last mount
+             wins for mountpoints mounted over)
+    """
+    rv = {}
+    with open( path ) as f:
+        for line in f:
+            parts = line.split()
+            rv[ _unescape( parts[1] ) ] = parts[2]
+    return rv
+
+
+def mountpoint( path, mount_table ):
+    """
+    :param path str: absolute path (symlinks are not resolved)
+    :param mount_table dict: as returned by mounts()
+    :return: mountpoint of the filesystem holding path, None if not found
+    """
+    while True:
+        if path in mount_table:
+            return path
+        if path == '/':
+            return None
+        path = os.path.dirname( path )
+
+
+def fstype( path, mount_table=None ):
+    """
+    :param path str: any path
+    :param mount_table dict: (optional) as returned by mounts()
+    :return: type of the filesystem holding path (ie: 'lustre', 'ext4')
+    """
+    if mount_table is None:
+        mount_table = mounts()
+    return mount_table.get( mountpoint( os.path.realpath( path ), mount_table ) )
+
+
+def for_fstypes( src_fstype, tgt_fstype ):
+    """
+    :return: copy backend for this pair of filesystem types, pylut if both
+             are Lustre (and pylut is installed), native otherwise
+    """
+    if src_fstype == tgt_fstype == 'lustre' and pylut is not None:
+        return Pylut_Copy()
+    return Native_Copy()
+
+
+_backends = {}
+
+
+def for_mountpoints( src_mountpoint, tgt_mountpoint ):
+    """
+    Copy backend for syncing from src_mountpoint to tgt_mountpoint, looked up
+    once per pair (per process)
+    """
+    key = ( src_mountpoint, tgt_mountpoint )
+    if key not in _backends:
+        mount_table = mounts()
+        _backends[ key ] = for_fstypes( fstype( src_mountpoint, mount_table ),
+                                        fstype( tgt_mountpoint, mount_table ) )
+    return _backends[ key ]
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
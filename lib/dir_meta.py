@@ -0,0 +1,125 @@
+import os
+import stat
+import time
+import cbor
+import dirscan
+
+# rsync options that ask for directory metadata to be set
+SYNC_KEYS = ( 'syncowner', 'syncgroup', 'syncperms', 'synctimes' )
+
+# Number of entries per redis command when saving or reading entries
+BATCH_SIZE = 1000
+
+
+def wanted( syncopts ):
+    """
+    :param syncopts dict: rsync options (see SYNC_KEYS)
+    :return: True if any directory metadata is to be set, False otherwise
+    """
+    return any( syncopts[ k ] for k in SYNC_KEYS )
+
+
+def apply( path, entry, syncopts, atime=None ):
+    """
+    Set owner, group, permissions and times of directory path from the
+    stat data in entry, in process (no rsync).
+    Owner and group are set first, since chown can clear setuid/setgid bits,
+    times are set last.
+    :param path str: target directory
+    :param entry dirscan.Entry: stat data of the source directory
+    :param syncopts dict: rsync options, only SYNC_KEYS are consulted
+    :param atime float: access time to set with synctimes (default: now,
+                        same as rsync without --atimes)
+    :return: None
+    """
+    uid = entry.uid if syncopts[ 'syncowner' ] else -1
+    gid = entry.gid if syncopts[ 'syncgroup' ] else -1
+    if uid != -1 or gid != -1:
+        os.lchown( path, uid, gid )
+    if syncopts[ 'syncperms' ]:
+        os.chmod( path, stat.S_IMODE( entry.mode ) )
+    if syncopts[ 'synctimes' ]:
+        if atime is None:
+            atime = time.time()
+        os.utime( path, ( atime, entry.mtime ) )
+
+
+class Dir_Meta( object ):
+    """ Stat data of the subdirs of one directory of a psync run, in redis
+
+    The Entries of source subdirs are saved while the directory is scanned
+    and read back once everything below the directory is done.  They are
+    kept in the redis list 'psync_dirmeta:<run_id>:<relpath>', one CBOR
+    encoded Entry per item.
+    Used as a context manager, added entries are saved on a clean exit.
+    """
+
+    key_prefix = 'psync_dirmeta:'
+
+    def __init__( self, conn, run_id, relpath, batch_size=None ):
+        """
+        :param conn redis.Redis: redis connection
+        :param run_id str: psync run (see run_registry)
+        :param relpath str: dir, relative to the run's src and tgt roots
+        :param batch_size int: entries per redis command (default BATCH_SIZE)
+        """
+        self.conn = conn
+        self.key = '{0}{1}:{2}'.format( self.key_prefix, run_id, relpath )
+        self.batch_size = batch_size if batch_size else BATCH_SIZE
+        self.pending = []
+
+
+    def add( self, entry ):
+        """
+        Buffer entry, a full buffer is saved to redis
+        :param entry dirscan.Entry: source subdir, stat'd
+        """
+        self.pending.append( cbor.dumps( list( entry ) ) )
+        if len( self.pending ) >= self.batch_size:
+            self.flush()
+
+
+    def flush( self ):
+        if len( self.pending ) > 0:
+            self.conn.rpush( self.key, *self.pending )
+        self.pending = []
+
+
+    def exists( self ):
+        """
+        :return: True if any entries were saved, False otherwise
+        """
+        return bool( self.conn.exists( self.key ) )
+
+
+    def entries( self ):
+        """
+        Generator over the saved entries, read batch_size at a time
+        :return: generator of dirscan.Entry
+        """
+        start = 0
+        while True:
+            items = self.conn.lrange( self.key, start, start + self.batch_size - 1 )
+            for item in items:
+                yield dirscan.Entry._make( cbor.loads( item ) )
+            if len( items ) < self.batch_size:
+                return
+            start += len( items )
+
+
+    def delete( self ):
+        self.conn.delete( self.key )
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,95 @@
+import heapq
+import tempfile
+import itertools
+
+try:
+    import cPickle as pickle
+except ( ImportError ) as e:
+    import pickle
+
+# Max number of records to hold in memory while sorting a directory listing.
+# Larger listings are sorted in runs of this size that are spilled to
+# temporary files and then merged.
+RUN_SIZE = 100000
+
+
+def _spill( run, tmpdir ):
+    """
+    Write a sorted run to an anonymous temporary file
+    :return: file object, positioned at the start of the run
+    """
+    f = tempfile.TemporaryFile( dir=tmpdir )
+    # One pickle per record, a shared (un)pickler would keep a reference to
+    # every record in its memo
+    for rec in run:
+        pickle.dump( rec, f, pickle.HIGHEST_PROTOCOL )
+    f.seek( 0 )
+    return f
+
+
+def _read_run( f ):
+    """
+    Generator over records written by _spill, closes f when done
+    """
+    try:
+        while True:
+            try:
+                yield pickle.load( f )
+            except ( EOFError ) as e:
+                break
+    finally:
+        f.close()
+
+
+def external_sort( records, run_size=None, tmpdir=None ):
+    """
+    Sort records by their first element (the name) using bounded memory.
+    :param records iterable: records ( name, ... ), must be picklable
+    :param run_size int: max number of records held in memory
+                         (default: RUN_SIZE)
+    :param tmpdir str: where to spill sorted runs (default: tempfile default)
+    :return: iterator over records in sorted order
+    """
+    if run_size is None:
+        run_size = RUN_SIZE
+    runs = []
+    records = iter( records )
+    while True:
+        run = list( itertools.islice( records, run_size ) )
+        run.sort()
+        if len( run ) < run_size and len( runs ) < 1:
+            # everything fits in memory
+            return iter( run )
+        runs.append( _read_run( _spill( run, tmpdir ) ) )
+        if len( run ) < run_size:
+            break
+    return heapq.merge( *runs )
+
+
+def merge_join( src, tgt ):
+    """
+    Full outer join of two sorted listings on name.
+    :param src iterable: records ( name, ... ) sorted by name, unique names
+    :param tgt iterable: records ( name, ... ) sorted by name, unique names
+    :return: generator of tuples ( name, src_record, tgt_record ) where
+             src_record or tgt_record is None if name is missing on that side
+    """
+    src = iter( src )
+    tgt = iter( tgt )
+    s = next( src, None )
+    t = next( tgt, None )
+    while s is not None or t is not None:
+        if t is None or ( s is not None and s[0] < t[0] ):
+            yield ( s[0], s, None )
+            s = next( src, None )
+        elif s is None or t[0] < s[0]:
+            yield ( t[0], None, t )
+            t = next( tgt, None )
+        else:
+            yield ( s[0], s, t )
+            s = next( src, None )
+            t = next( tgt, None )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
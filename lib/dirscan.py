@@ -0,0 +1,154 @@
+import os
+import errno
+import stat
+import zlib
+import collections
+
+# os.scandir is only in python >= 3.5, use the scandir module otherwise
+try:
+    from os import scandir
+except ( ImportError ) as e:
+    from scandir import scandir
+
+# Entry types returned by scan()
+# (small ints, so they pack into one byte in task messages)
+DIR = 1
+FILE = 2
+OTHER = 3
+VANISHED = 4
+
+# Smallest number of bytes any supported filesystem accounts for in the size
+# of a directory, per entry (btrfs uses 2 * len(name)).  Used to rule out
+# large directories without reading them.
+MIN_DIRENT_SIZE = 2
+
+
+class Entry( collections.namedtuple( 'Entry',
+    'name ftype size mtime mode uid gid nlink inode' ) ):
+    """
+    Compact directory entry, holds only the stat data psync uses.
+    Being a tuple, it has no per instance __dict__, sorts by name and
+    is sent in task messages as a plain list of its fields
+    (use Entry._make to rebuild it).
+    mtime is the float st_mtime, sub-second precision is kept for setting
+    times (the quick check compares whole seconds).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_stat( cls, name, ftype, st=None ):
+        """
+        :param name str: entry name
+        :param ftype str: one of DIR, FILE, OTHER
+        :param st stat_result: lstat of entry (None if not stat'd)
+        """
+        if st is None:
+            return cls( name, ftype, 0, 0, 0, 0, 0, 0, 0 )
+        return cls( name, ftype, st.st_size, st.st_mtime, st.st_mode,
+                    st.st_uid, st.st_gid, st.st_nlink, st.st_ino )
+
+
+def in_slice( name, dirslice ):
+    """
+    Stable mapping of names to slices, same result for any host or process
+    :param name str: entry name
+    :param dirslice tuple: ( slice index, number of slices )
+    :return: True if name belongs in dirslice, False otherwise
+    """
+    ( index, count ) = dirslice
+    return ( zlib.crc32( name ) & 0xffffffff ) % count == index
+
+
+def count( path ):
+    """
+    Count entries in directory 'path' (readdir only, no stat)
+    """
+    return sum( 1 for entry in scandir( path ) )
+
+
+def scan( path, counters=None, dirslice=None, stat_dirs=False,
+          stat_files=True ):
+    """
+    Generator over the contents of directory 'path'.
+    Entries are classified using d_type (from readdir) so that directories
+    and other non-regular files never need a stat.  Only regular files are
+    stat'd, since that stat data is needed later (ie: quick check, minsecs),
+    and directories if stat_dirs is set (ie: to set their metadata later).
+    :param path str: directory to scan
+    :param counters dict: (optional) updated in place with keys
+                          'entries' and 'stats'
+    :param dirslice tuple: (optional) ( slice index, number of slices ),
+                           only names in this slice (see in_slice) are
+                           returned, without stat'ing any others
+    :param stat_dirs bool: (optional) stat DIR entries too
+    :param stat_files bool: (optional) stat FILE entries (default), if False
+                            entries are classified from d_type only
+    :return: generator of tuples ( name, type, stat_result ) where type is one
+             of DIR, FILE, OTHER, VANISHED and stat_result is the lstat of
+             FILE entries with stat_files (and DIR entries with stat_dirs),
+             the OSError for
+             VANISHED entries, None otherwise
+    """
+    if counters is None:
+        counters = {}
+    counters.setdefault( 'entries', 0 )
+    counters.setdefault( 'stats', 0 )
+    # Note: pass path as a byte string (str in py2) so that names are returned
+    # as byte strings too, this avoids unicode decode errors for names that
+    # are not valid in the filesystem encoding
+    # Note: stat with os.lstat, not entry.stat(), the C extension of older
+    # scandir modules returns int times (entry.stat() does an lstat on posix
+    # anyway, nothing is cached from readdir)
+    for entry in scandir( path ):
+        if dirslice is not None and not in_slice( entry.name, dirslice ):
+            continue
+        counters[ 'entries' ] += 1
+        try:
+            if entry.is_dir( follow_symlinks=False ):
+                st = None
+                if stat_dirs:
+                    counters[ 'stats' ] += 1
+                    st = os.lstat( os.path.join( path, entry.name ) )
+                yield ( entry.name, DIR, st )
+            elif entry.is_file( follow_symlinks=False ):
+                st = None
+                if stat_files:
+                    counters[ 'stats' ] += 1
+                    st = os.lstat( os.path.join( path, entry.name ) )
+                yield ( entry.name, FILE, st )
+            else:
+                yield ( entry.name, OTHER, None )
+        except ( OSError ) as e:
+            # OSError: [Errno 2] No such file or directory
+            # have to ignore these, since no way to tell if FS is live or quiesced
+            if e.errno != errno.ENOENT:
+                raise e
+            yield ( entry.name, VANISHED, e )
+
+
+def quick_check( src, tgt, syncopts ):
+    """
+    Rsync style quick check (ie: without --checksum) of a file that exists on
+    both source and target.
+    :param src Entry: source file
+    :param tgt Entry: target file
+    :param syncopts dict: rsync options, only syncperms, syncowner, syncgroup
+                          are consulted
+    :return: True if tgt already matches src (no sync needed), False otherwise
+    """
+    if src.size != tgt.size:
+        return False
+    if int( src.mtime ) != int( tgt.mtime ):
+        return False
+    if syncopts[ 'syncperms' ] \
+    and stat.S_IMODE( src.mode ) != stat.S_IMODE( tgt.mode ):
+        return False
+    if syncopts[ 'syncowner' ] and src.uid != tgt.uid:
+        return False
+    if syncopts[ 'syncgroup' ] and src.gid != tgt.gid:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,100 @@
+import time
+import redis
+import cbor
+
+# States of a source inode in the registry (see Hardlink_Registry.claim)
+CLAIMED = 'claimed'
+PENDING = 'pending'
+DONE = 'done'
+
+# Seconds after which a claim whose copy never finished (ie: the worker
+# died) can be taken over, no task runs longer than the worker hard time
+# limit (PSYNCHARDTIMEOUT)
+STALE_SECS = 14700
+
+
+class Hardlink_Registry( object ):
+    """ First target path of each multiply linked source inode of a run
+
+    The first worker to claim a source inode copies it, the other links of
+    the inode wait until that copy is done and then hardlink their target to
+    the first target path.  Any number of workers can sync hardlinks at the
+    same time.
+    The registry is the redis hash 'psync_links:<run_id>', the field is the
+    source inode (a run's source is one filesystem) and the value is a CBOR
+    encoded list [ state, target path, time of the claim ], where state is
+    PENDING while the first copy runs and DONE after.  Claims are made with
+    HSETNX, so exactly one worker wins each inode.
+    """
+
+    key_prefix = 'psync_links:'
+
+    def __init__( self, conn, run_id, stale_secs=None ):
+        """
+        :param conn redis.Redis: redis connection
+        :param run_id str: psync run (see run_registry)
+        :param stale_secs int: age of an unfinished claim after which it can
+                               be taken over (default STALE_SECS)
+        """
+        self.conn = conn
+        self.key = '{0}{1}'.format( self.key_prefix, run_id )
+        self.stale_secs = stale_secs if stale_secs else STALE_SECS
+
+
+    def claim( self, inode, path ):
+        """
+        Claim source inode, with path as its first target path
+        :param inode int: source inode
+        :param path str: target path of this link
+        :return: tuple ( state, target path ), where state is
+                 CLAIMED - the caller is the first, copy the file to path
+                           and call done (or release on failure)
+                 PENDING - another worker is copying it, try again later
+                 DONE - target path is the first link, link path to it
+        """
+        value = cbor.dumps( [ PENDING, path, time.time() ] )
+        while True:
+            if self.conn.hsetnx( self.key, inode, value ):
+                return ( CLAIMED, path )
+            with self.conn.pipeline() as pipe:
+                try:
+                    pipe.watch( self.key )
+                    current = pipe.hget( self.key, inode )
+                    if current is None:
+                        # released since the hsetnx, claim it again
+                        continue
+                    ( state, first, claimed ) = cbor.loads( current )
+                    if state == DONE:
+                        return ( DONE, first )
+                    if time.time() - claimed < self.stale_secs:
+                        return ( PENDING, first )
+                    # take over a stale claim, unless someone else just did
+                    pipe.multi()
+                    pipe.hset( self.key, inode, value )
+                    pipe.execute()
+                    return ( CLAIMED, path )
+                except ( redis.WatchError ) as e:
+                    continue
+
+
+    def done( self, inode, path ):
+        """
+        The first target path of inode is complete, later links can use it
+        """
+        self.conn.hset( self.key, inode, cbor.dumps( [ DONE, path, time.time() ] ) )
+
+
+    def release( self, inode ):
+        """
+        Drop the claim on inode (ie: the copy failed), the next link to try
+        claims it again
+        """
+        self.conn.hdel( self.key, inode )
+
+
+    def delete( self ):
+        self.conn.delete( self.key )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,578 @@
+import os
+import glob
+import time
+import socket
+import threading
+import logging
+import zlib
+import redis
+import cbor
+import logschema
+try:
+    import lzma
+except ( ImportError ) as e:
+    lzma = None
+
+logr = logging.getLogger( __name__ )
+
+# Segment rotation defaults
+MAX_BYTES = 1024 * 1024 * 1024
+MAX_SECS = 3600
+
+# Records removed from redis (and fsync'd) per batch
+BATCH_SIZE = 10000
+
+# Seconds to wait for new records once the queue is empty
+POLL_SECS = 1.0
+
+# Seconds between updates of the published lag (see Log_Collector.status)
+STATUS_SECS = 10
+
+# Redis hash with the lag of the collector of a queue, expires if the
+# collector stops updating it
+STATUS_PREFIX = 'psync_log_collector:'
+
+# Suffix of a segment that is still being written
+PART_SUFFIX = '.part'
+
+# Bytes read at a time when a leftover segment is recovered
+RECOVER_CHUNK = 1024 * 1024
+
+
+class _Gzip( object ):
+    """ gzip stream, sync() flushes so all data written so far can be read
+    """
+    ext = '.gz'
+
+    def __init__( self ):
+        # wbits 16 + 15 writes a gzip header and trailer
+        self.c = zlib.compressobj( 6, zlib.DEFLATED, 31 )
+
+    def compress( self, data ):
+        return self.c.compress( data )
+
+    def sync( self ):
+        return self.c.flush( zlib.Z_SYNC_FLUSH )
+
+    def finish( self ):
+        return self.c.flush()
+
+    @staticmethod
+    def decompressor():
+        """
+        :return: function ( data ) -> decompressed data, for the successive
+                 parts of a segment
+        """
+        return zlib.decompressobj( 31 ).decompress
+
+
+class _Xz( object ):
+    """ xz stream, sync() ends the current xz stream and starts a new one
+        (a segment is a series of xz streams, which xz and lzma read as one)
+    """
+    ext = '.xz'
+
+    def __init__( self ):
+        self.c = lzma.LZMACompressor()
+
+    def compress( self, data ):
+        return self.c.compress( data )
+
+    def sync( self ):
+        data = self.c.flush()
+        self.c = lzma.LZMACompressor()
+        return data
+
+    def finish( self ):
+        return self.c.flush()
+
+    @staticmethod
+    def decompressor():
+        """
+        :return: function ( data ) -> decompressed data, for the successive
+                 parts of a segment (a series of xz streams)
+        """
+        state = [ lzma.LZMADecompressor() ]
+        def decompress( data ):
+            out = []
+            while data:
+                out.append( state[0].decompress( data ) )
+                if not state[0].eof:
+                    break
+                data = state[0].unused_data
+                state[0] = lzma.LZMADecompressor()
+            return ''.join( out )
+        return decompress
+
+
+COMPRESSORS = { 'gzip': _Gzip }
+if lzma:
+    COMPRESSORS[ 'xz' ] = _Xz
+
+
+class Segment_Writer( object ):
+    """ Append the raw (CBOR encoded) records of one severity to segment
+        files, rotated by size or age
+
+    A segment is written as '<name>.part' and renamed to its final name
+    '<logbase>.<sev>.<YYYYmmddTHHMMSS>.<seq>.cbor[.gz|.xz]' when it is
+    rotated or closed, so complete segments are the files without the
+    '.part' suffix.  CBOR records (and gzip / xz streams) concatenate, so
+    'cat' (or 'zcat', 'xzcat') of a series of segments is a log file in the
+    format the bin/parse_* tools read.  Each segment has the logschema
+    tables its records need.
+    A '.part' segment left by a collector that died is finished by
+    recover(), so is a segment abort()ed after a write error.
+    """
+
+    def __init__( self, logbase, sev, max_bytes=MAX_BYTES, max_secs=MAX_SECS,
+                  compress=None ):
+        """
+        :param logbase str: path prefix of the segment files
+        :param sev str: severity (part of the file names)
+        :param max_bytes int: rotate once a segment has max_bytes (on disk)
+        :param max_secs int: rotate once a segment is max_secs old
+        :param compress str: one of COMPRESSORS, None for no compression
+        """
+        self.logbase = logbase
+        self.sev = sev
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+        self.compressor_cls = COMPRESSORS[ compress ] if compress else None
+        self.seq = 0
+        self.f = None
+        # table entries in the current segment (see logschema.Tables)
+        self.written = {}
+
+
+    def _open( self ):
+        self.seq += 1
+        self.opened = time.time()
+        ext = '.cbor'
+        self.compressor = None
+        if self.compressor_cls:
+            self.compressor = self.compressor_cls()
+            ext += self.compressor.ext
+        stamp = time.strftime( '%Y%m%dT%H%M%S', time.localtime( self.opened ) )
+        while True:
+            self.path = '{0}.{1}.{2}.{3:04d}{4}'.format(
+                self.logbase, self.sev, stamp, self.seq, ext )
+            # a segment of a previous collector started in the same second
+            if not os.path.exists( self.path ) \
+                    and not os.path.exists( self.path + PART_SUFFIX ):
+                break
+            self.seq += 1
+        # unbuffered, so abort() has no buffered data left to write
+        self.f = open( self.path + PART_SUFFIX, 'ab', 0 )
+        self.size = 0
+        # size as of the last sync(), everything before it is complete
+        self.synced = 0
+        self.dirty = False
+        self.written = {}
+
+
+    def _write( self, data ):
+        if data:
+            self.f.write( data )
+            self.size += len( data )
+
+
+    def write( self, records, tables=None ):
+        """
+        Append records, not on disk before sync()
+        :param records list: CBOR encoded records
+        :param tables logschema.Tables: write the table entries the segment
+                                        does not have yet first
+        """
+        if len( records ) < 1:
+            return
+        if self.f is None:
+            self._open()
+        if tables:
+            head = tables.new_entries( self.written )
+            if head:
+                records = [ head ] + records
+        data = ''.join( records )
+        if self.compressor:
+            data = self.compressor.compress( data )
+        self._write( data )
+        self.dirty = True
+
+
+    def sync( self ):
+        """
+        Make everything written so far durable (one fsync)
+        """
+        if self.f is None or not self.dirty:
+            return
+        if self.compressor:
+            self._write( self.compressor.sync() )
+        self.f.flush()
+        os.fsync( self.f.fileno() )
+        self.synced = self.size
+        self.dirty = False
+
+
+    def rotate_due( self ):
+        if self.f is None:
+            return False
+        return self.size >= self.max_bytes \
+            or time.time() - self.opened >= self.max_secs
+
+
+    def close( self ):
+        """
+        Finish the current segment (if any) and give it its final name
+        A segment that can not be finished is abort()ed.
+        :return: path of the finished segment, None if there was none
+        """
+        if self.f is None:
+            return None
+        try:
+            if self.compressor:
+                self._write( self.compressor.finish() )
+            self.f.flush()
+            os.fsync( self.f.fileno() )
+        except:
+            self.abort()
+            raise
+        self.f.close()
+        self.f = None
+        os.rename( self.path + PART_SUFFIX, self.path )
+        return self.path
+
+
+    def abort( self ):
+        """
+        Drop what was written after the last sync() (ie: part of a batch,
+        when a write failed) and close the segment, leaving it as '.part'
+        for recover().  The next write() starts a new segment.
+        """
+        if self.f is None:
+            return
+        try:
+            os.ftruncate( self.f.fileno(), self.synced )
+            os.fsync( self.f.fileno() )
+        except ( EnvironmentError ) as e:
+            # recover() cuts it back to the last complete record
+            logr.warning( 'Truncating {0}: {1}'.format(
+                self.path + PART_SUFFIX, e ) )
+        finally:
+            self.f.close()
+            self.f = None
+
+
+def _complete_records( path ):
+    """
+    :return: int, length of the leading complete CBOR records of file path
+    """
+    end = 0
+    with open( path, 'rb' ) as f:
+        try:
+            while True:
+                cbor.load( f )
+                end = f.tell()
+        except ( EOFError, ValueError ) as e:
+            # end of file, or a record cut short by a crash
+            pass
+    return end
+
+
+def _decompress_part( part, path, compressor_cls ):
+    """
+    Decompress segment part to file path, up to the end of the part or the
+    first data that does not decompress (written when the collector died)
+    """
+    decompress = compressor_cls.decompressor()
+    with open( part, 'rb' ) as f:
+        with open( path, 'wb' ) as out:
+            for data in iter( lambda: f.read( RECOVER_CHUNK ), '' ):
+                try:
+                    out.write( decompress( data ) )
+                except ( Exception ) as e:
+                    logr.warning( 'Recovering {0}: {1}'.format( part, e ) )
+                    break
+
+
+def recover( logbase ):
+    """
+    Finish the segments a collector that died left with the '.part' suffix
+    (see Segment_Writer).  Everything up to the last sync of a segment was
+    acknowledged and is kept.  Records cut short by the crash are left out,
+    they were not acknowledged and are collected again from redis.
+    Only one collector may write segments of logbase.
+    :param logbase str: path prefix of the segment files
+    :return: list of finished segment paths
+    """
+    done = []
+    for part in sorted( glob.glob( logbase + '.*' + PART_SUFFIX ) ):
+        path = part[ :-len( PART_SUFFIX ) ]
+        compressor_cls = None
+        for cls in COMPRESSORS.itervalues():
+            if path.endswith( '.cbor' + cls.ext ):
+                compressor_cls = cls
+        if compressor_cls is None and not path.endswith( '.cbor' ):
+            logr.warning( 'Can not recover {0}'.format( part ) )
+            continue
+        raw = part
+        if compressor_cls:
+            raw = path + '.raw'
+            _decompress_part( part, raw, compressor_cls )
+        end = _complete_records( raw )
+        compressor = compressor_cls() if compressor_cls else None
+        with open( raw, 'rb' ) as f:
+            with open( path, 'wb' ) as out:
+                while f.tell() < end:
+                    data = f.read( min( RECOVER_CHUNK, end - f.tell() ) )
+                    out.write( compressor.compress( data ) if compressor
+                               else data )
+                if compressor:
+                    out.write( compressor.finish() )
+                out.flush()
+                os.fsync( out.fileno() )
+        if raw != part:
+            os.unlink( raw )
+        os.unlink( part )
+        done.append( path )
+    return done
+
+
+class Log_Collector( object ):
+    """ Stream records from the Redis_Logger queues into segment files
+
+    Each queue is drained by its own thread with Redis_Queue.qdrain, in
+    batches of up to batch_size.  The records of a severity queue are
+    appended as they are (raw bytes, not decoded) to the Segment_Writer of
+    that severity and fsync'd once per batch before the batch is
+    acknowledged.  So nothing is lost if the collector dies, a batch in
+    flight is collected again by the next collector.  Records of a queue
+    without a severity (the single queue of older Redis_Loggers) are
+    decoded to find their severity.  When its queue is empty a thread waits
+    poll_secs, so a slow trickle of records is still written with few
+    fsyncs.
+    If writing a batch fails (ie: the disk is full) the collector stops,
+    the batch stays in redis.
+    The lag is published every STATUS_SECS in the redis hash
+    STATUS_PREFIX + name (see status()).
+    """
+
+    def __init__( self, name, queues, logbase, batch_size=BATCH_SIZE,
+                  poll_secs=POLL_SECS, status_conn=None, tables=None, **k ):
+        """
+        :param name str: name the lag is published under (the base queue
+                         name, see Redis_Logger)
+        :param queues list: tuples ( severity, redis_queue.Redis_Queue ),
+                            severity None for a queue of mixed severities
+                            (see Redis_Logger.queues)
+        :param logbase str: path prefix of the segment files
+        :param batch_size int: max records per drained batch
+        :param poll_secs float: wait when a queue is empty
+        :param status_conn redis.Redis: where to publish the lag (default:
+                                        the redis of the first queue)
+        :param tables logschema.Tables: tables of the compact records
+        Remaining keyword args are passed to Segment_Writer()
+        """
+        self.queues = queues
+        self.logbase = logbase
+        self.batch_size = batch_size
+        self.poll_secs = poll_secs
+        self.writer_args = k
+        self.writers = {}
+        self.lock = threading.Lock()
+        self.status_key = STATUS_PREFIX + name
+        self.status_conn = status_conn if status_conn else queues[0][1].conn
+        self.tables = tables
+        self.num_records = 0
+        self.last_status = ( time.time(), 0 )
+        self.stopped = False
+        # exception that stopped a drain thread
+        self.error = None
+
+
+    def stop( self ):
+        """ Stop after the current batches (ie: from a signal handler)
+        """
+        self.stopped = True
+
+
+    def _writer( self, sev ):
+        """
+        :return: tuple ( Segment_Writer, threading.Lock ) of severity sev
+        """
+        with self.lock:
+            if sev not in self.writers:
+                self.writers[ sev ] = ( Segment_Writer(
+                    self.logbase, sev, **self.writer_args ), threading.Lock() )
+            return self.writers[ sev ]
+
+
+    def process_batch( self, sev, records ):
+        """
+        Write records to the segment of severity sev and sync them
+        :param sev str: severity of the records, None to decode each record
+                        for its severity
+        """
+        if sev is None:
+            by_sev = {}
+            for rec in records:
+                sev = logschema.severity( cbor.loads( rec ) )
+                by_sev.setdefault( sev, [] ).append( rec )
+        else:
+            by_sev = { sev: records }
+        for sev, recs in by_sev.iteritems():
+            ( w, lock ) = self._writer( sev )
+            with lock:
+                try:
+                    w.write( recs, self.tables )
+                    w.sync()
+                except:
+                    # do not finish a segment with part of the batch
+                    w.abort()
+                    raise
+        with self.lock:
+            self.num_records += len( records )
+
+
+    def drain( self, sev, rq ):
+        """
+        Drain rq until stop() is called (one thread per queue)
+        """
+        # drain a few batches at a time, to see stop() in between (the drain
+        # must not be left mid batch, that would leave the last batch
+        # unacknowledged)
+        max_count = self.batch_size * 10
+        while not self.stopped:
+            count = 0
+            try:
+                for batch in rq.qdrain( self.batch_size, max_count ):
+                    self.process_batch( sev, batch )
+                    count += len( batch )
+            except ( redis.RedisError ) as e:
+                logr.warning( 'Draining {0}: {1}'.format(
+                    rq.get_queue_name(), e ) )
+            except ( Exception ) as e:
+                # the batch was not acknowledged, the next collector gets it
+                logr.exception( 'Draining {0}, stopping'.format(
+                    rq.get_queue_name() ) )
+                self.error = e
+                self.stop()
+                return
+            if count < max_count and not self.stopped:
+                time.sleep( self.poll_secs )
+
+
+    def rotate( self, force=False ):
+        """
+        Close the segments that are due (all of them if force), a segment
+        that fails to close is left as '.part' (see Segment_Writer.close)
+        :return: list of finished segment paths
+        :raises EnvironmentError: a segment failed to close (after trying
+                                  the others)
+        """
+        done = []
+        error = None
+        with self.lock:
+            writers = self.writers.values()
+        for ( w, lock ) in writers:
+            with lock:
+                if force or w.rotate_due():
+                    try:
+                        path = w.close()
+                    except ( EnvironmentError ) as e:
+                        logr.warning( 'Closing {0}: {1}'.format( w.path, e ) )
+                        error = error or e
+                        continue
+                    if path:
+                        done.append( path )
+        if error is not None:
+            raise error
+        return done
+
+
+    def status( self ):
+        """
+        Current lag, also published in redis as hash self.status_key
+        :return: dict with keys
+            qlen     - records waiting in redis (all queues)
+            rate     - records collected per second since the last status
+            eta      - seconds to catch up at that rate (-1 if rate is 0)
+            records  - records collected since start
+            host, pid, ts
+        """
+        now = time.time()
+        ( then, num ) = self.last_status
+        with self.lock:
+            num_records = self.num_records
+        rate = ( num_records - num ) / max( now - then, 0.001 )
+        self.last_status = ( now, num_records )
+        qlen = sum( rq.qlen() for ( sev, rq ) in self.queues )
+        data = dict( qlen    = qlen,
+                     rate    = round( rate, 1 ),
+                     eta     = round( qlen / rate, 1 ) if rate > 0 else -1,
+                     records = num_records,
+                     host    = socket.gethostname(),
+                     pid     = os.getpid(),
+                     ts      = int( now ) )
+        pipe = self.status_conn.pipeline()
+        pipe.hmset( self.status_key, data )
+        pipe.expire( self.status_key, STATUS_SECS * 6 )
+        pipe.execute()
+        return data
+
+
+    def run( self, report=None ):
+        """
+        Finish the segments a previous collector left (see recover()),
+        collect until stop() is called, then finish all segments
+        :param report function: called with the status dict every STATUS_SECS
+        :raises UserWarning: a drain thread failed (see drain())
+        """
+        for path in recover( self.logbase ):
+            logr.info( 'Recovered {0}'.format( path ) )
+        threads = [ threading.Thread( target=self.drain, args=( sev, rq ),
+                        name='drain_{0}'.format( rq.get_queue_name() ) )
+                    for ( sev, rq ) in self.queues ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        next_status = time.time()
+        try:
+            while not self.stopped:
+                self.rotate()
+                if time.time() >= next_status:
+                    try:
+                        data = self.status()
+                        if report:
+                            report( data )
+                    except ( redis.RedisError ) as e:
+                        logr.warning( 'Status: {0}'.format( e ) )
+                    next_status = time.time() + STATUS_SECS
+                time.sleep( self.poll_secs )
+        finally:
+            self.stopped = True
+            for t in threads:
+                t.join()
+            try:
+                self.rotate( force=True )
+            except ( EnvironmentError ) as e:
+                # report the error that stopped the drain instead
+                if self.error is None:
+                    raise
+        if self.error is not None:
+            raise UserWarning( 'Collector stopped: {0}'.format( self.error ) )
+
+
+def collector_status( conn ):
+    """
+    :param conn redis.Redis: redis connection
+    :return: dict, queue name -> status dict (see Log_Collector.status) of
+             every running collector
+    """
+    data = {}
+    for key in conn.scan_iter( match=STATUS_PREFIX + '*' ):
+        data[ key[ len( STATUS_PREFIX ): ] ] = conn.hgetall( key )
+    return data
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,164 @@
+import os
+import glob
+import errno
+import cbor
+import logschema
+
+# Suffix of spool file names
+SPOOL_SUFFIX = '.spool'
+
+
+def _pid_alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ( OSError ) as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def orphans( spool_dir, name ):
+    """
+    :return: list of paths of the spool files of dead processes on this host
+    """
+    prefix = os.path.join( spool_dir, '{0}.{1}.'.format( name, os.uname()[1] ) )
+    paths = []
+    for path in glob.glob( prefix + '*' + SPOOL_SUFFIX ):
+        pid = path[ len( prefix ):-len( SPOOL_SUFFIX ) ]
+        if pid.isdigit() and not _pid_alive( int( pid ) ):
+            paths.append( path )
+    return paths
+
+
+class Log_Spool( object ):
+    """ Append-only local file of log records that could not be pushed to
+        redis, read back in order by the replayer (see Redis_Logger)
+
+    The file is '<spool_dir>/<name>.<host>.<pid>.spool' and holds the CBOR
+    encoded records as they are pushed to redis.  Records are read from the
+    replay position, ack() moves
+    the position and truncates the file once everything is replayed.  The
+    position is kept in memory only: records of a process that dies while
+    replaying are replayed again by the process that adopts its spool, so
+    records are delivered at least once.
+    Used by one thread at a time (the Redis_Logger flusher).
+    """
+
+    def __init__( self, spool_dir, name ):
+        """
+        :param spool_dir str: local directory for spool files (created if
+                              missing)
+        :param name str: first part of the file name (ie: the queue name)
+        """
+        self.spool_dir = spool_dir
+        self.name = name
+        self.path = os.path.join( spool_dir, '{0}.{1}.{2}{3}'.format(
+            name, os.uname()[1], os.getpid(), SPOOL_SUFFIX ) )
+        try:
+            os.makedirs( spool_dir )
+        except ( OSError ) as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.f = open( self.path, 'ab+' )
+        self.pos = 0
+        self.count = self._count()
+
+
+    def _count( self ):
+        """ Records in the file after the replay position (read them all)
+        """
+        num = 0
+        self.f.seek( self.pos )
+        try:
+            while True:
+                cbor.load( self.f )
+                num += 1
+        except ( EOFError, ValueError ) as e:
+            pass
+        return num
+
+
+    def adopt( self ):
+        """
+        Append the spool files of dead processes on this host (same name) to
+        this one and remove them
+        :return: int, number of files adopted
+        """
+        num = 0
+        for path in orphans( self.spool_dir, self.name ):
+            # only one process gets to adopt each file
+            taken = '{0}.{1}'.format( self.path, num )
+            try:
+                os.rename( path, taken )
+            except ( OSError ) as e:
+                continue
+            path = taken
+            with open( path, 'rb' ) as f:
+                data = f.read()
+            self.f.seek( 0, os.SEEK_END )
+            self.f.write( data )
+            self.f.flush()
+            os.unlink( path )
+            num += 1
+        if num > 0:
+            self.count = self._count()
+        return num
+
+
+    def write( self, records ):
+        """
+        :param records list: CBOR encoded records
+        """
+        self.f.seek( 0, os.SEEK_END )
+        self.f.write( ''.join( records ) )
+        self.f.flush()
+        self.count += len( records )
+
+
+    def read( self, max_records ):
+        """
+        :return: tuple ( list of up to max_records tuples ( severity, CBOR
+                 encoded record ) from the replay position, position after
+                 them, for ack() )
+        """
+        bounds = []
+        self.f.seek( self.pos )
+        try:
+            while len( bounds ) < max_records:
+                start = self.f.tell()
+                sev = logschema.severity( cbor.load( self.f ) )
+                bounds.append( ( sev, start, self.f.tell() ) )
+        except ( EOFError, ValueError ) as e:
+            # end of file, or a record cut short by a crash
+            pass
+        if len( bounds ) < 1:
+            return ( [], self.pos )
+        end = bounds[-1][2]
+        self.f.seek( self.pos )
+        data = self.f.read( end - self.pos )
+        records = [ ( sev, data[ start - self.pos:stop - self.pos ] )
+                    for ( sev, start, stop ) in bounds ]
+        return ( records, end )
+
+
+    def ack( self, pos, num ):
+        """
+        Records up to pos (num of them) are in redis
+        """
+        self.pos = pos
+        self.count = max( self.count - num, 0 )
+        self.f.seek( 0, os.SEEK_END )
+        if self.pos >= self.f.tell():
+            self.f.truncate( 0 )
+            self.pos = 0
+            self.count = 0
+
+
+    def pending( self ):
+        """
+        :return: int, number of records waiting to be replayed
+        """
+        return self.count
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
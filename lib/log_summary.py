@@ -0,0 +1,134 @@
+import zlib
+
+# Values of psyncopts[ 'file_log' ]
+ALL = 'all'          # start and end record for every file
+SUMMARY = 'summary'  # one summary record per directory and task, plus the
+                     # records of 1 in psyncopts[ 'file_log_sample' ] files
+
+MODES = ( ALL, SUMMARY )
+
+
+class Log_Summary( object ):
+    """ Counts, bytes and durations of the file syncs of one directory
+
+    In SUMMARY mode, psync logs the start and end records only of the
+    files for which per_file() is True and adds every file to the summary.
+    Used as a context manager, log() is called on exit.  log() writes one
+    record with msgtype 'summary' and fields:
+        num_files    - files synced (end records it stands for)
+        num_errors   - files that failed (each also logged as a warning)
+        actions      - dict, number of files per action (ie: data_copy)
+        bytes        - total size of the files whose data was copied
+        secs         - total seconds spent syncing files
+        max_secs     - longest single file sync
+        chksum_hits, chksum_misses - checksum cache use (see checksum_cache)
+    The records that are logged in SUMMARY mode (sampled files) have the
+    extra field sampled=True, so they are not counted twice.
+    In ALL mode every file has its own records and nothing is summarized.
+    """
+
+    def __init__( self, logr, synctype, src, tgt, mode=ALL, sample=0 ):
+        """
+        :param logr Redis_Logger: where to log the summary
+        :param synctype str: synctype of the summary (and of the file records)
+        :param src str: source dir
+        :param tgt str: target dir
+        :param mode str: one of MODES
+        :param sample int: in SUMMARY mode, log the records of 1 in sample
+                           files too, 0 for none
+        """
+        self.logr = logr
+        self.synctype = synctype
+        self.src = src
+        self.tgt = tgt
+        self.mode = mode
+        self.sample = sample
+        self.num_files = 0
+        self.num_errors = 0
+        self.actions = {}
+        self.bytes = 0
+        self.secs = 0.0
+        self.max_secs = 0.0
+        self.chksum_hits = 0
+        self.chksum_misses = 0
+
+
+    def per_file( self, path ):
+        """
+        Stable choice of the files that keep their own records, the same
+        for the start and end record of a file
+        :param path str: src path of the file
+        :return: True if the records of path are to be logged
+        """
+        if self.mode == ALL:
+            return True
+        if self.sample < 1:
+            return False
+        return ( zlib.crc32( path ) & 0xffffffff ) % self.sample == 0
+
+
+    def fields( self ):
+        """
+        :return: dict, extra fields for the records of a file that is logged
+        """
+        if self.mode == ALL:
+            return {}
+        return { 'sampled': True }
+
+
+    def add( self, action, size, secs, chksum_hits=0, chksum_misses=0 ):
+        """
+        Count a finished file sync
+        :param action str: sync action of the end record (ie: data_copy)
+        :param size int: file size
+        :param secs float: duration of the sync
+        """
+        self.num_files += 1
+        self.actions[ action ] = self.actions.get( action, 0 ) + 1
+        if action == 'data_copy':
+            self.bytes += size
+        self.secs += secs
+        self.max_secs = max( self.max_secs, secs )
+        self.chksum_hits += chksum_hits
+        self.chksum_misses += chksum_misses
+
+
+    def error( self ):
+        """ Count a failed file sync
+        """
+        self.num_errors += 1
+
+
+    def log( self ):
+        """
+        Log the summary record, in SUMMARY mode if anything was counted
+        """
+        if self.mode == ALL or self.num_files + self.num_errors < 1:
+            return
+        msg_parts = dict( synctype   = self.synctype,
+                          msgtype    = 'summary',
+                          src        = self.src,
+                          tgt        = self.tgt,
+                          num_files  = self.num_files,
+                          num_errors = self.num_errors,
+                          actions    = self.actions,
+                          bytes      = self.bytes,
+                          secs       = round( self.secs, 3 ),
+                          max_secs   = round( self.max_secs, 3 ) )
+        if self.chksum_hits or self.chksum_misses:
+            msg_parts.update( chksum_hits = self.chksum_hits,
+                              chksum_misses = self.chksum_misses )
+        self.logr.info( **msg_parts )
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.log()
+        return False
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
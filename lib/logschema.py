@@ -0,0 +1,381 @@
+import os
+import time
+import gzip
+import threading
+import cbor
+try:
+    import lzma
+except ( ImportError ) as e:
+    lzma = None
+
+# Compact log record format
+#
+# A compact record is a CBOR map whose key 0 is the format VERSION.  Known
+# field names are replaced by the integer codes in FIELDS, and the values of
+# the fields in ENUMS by their integer codes.  Unknown fields and values stay
+# as they are, so any record can be encoded.
+#   host     - an id from the host table
+#   src, tgt - [ prefix id, rest of the path ] if the path starts with a
+#              prefix from the prefix table (the roots and mountpoints of the
+#              runs), else the path
+# The tables are global, interned in redis by the loggers (see Encoder), and
+# are written to the log files by the collectors (see Tables) as table
+# records, a map { 0: VERSION, TABLES: { 'hosts': { id: name },
+# 'prefixes': { id: path } } }, ahead of the first record that uses them.
+# Each segment file starts with the tables it needs, so it can be read on
+# its own.
+# Records without key 0 are in the original format: a map of field names to
+# values.  read_log() reads both.
+
+VERSION = 1
+
+FIELD_VERSION = 0
+TABLES = 99
+
+FIELDS = ( ( 1, 'sev' ),
+           ( 2, 'ts' ),
+           ( 3, 'host' ),
+           ( 4, 'msg' ),
+           ( 5, 'synctype' ),
+           ( 6, 'msgtype' ),
+           ( 7, 'src' ),
+           ( 8, 'tgt' ),
+           ( 9, 'action' ),
+           ( 10, 'error' ),
+           ( 11, 'size' ),
+           ( 12, 'secs' ),
+           ( 13, 'run_id' ),
+           ( 14, 'num_files' ),
+           ( 15, 'num_errors' ),
+           ( 16, 'bytes' ),
+           ( 17, 'chksum_hits' ),
+           ( 18, 'chksum_misses' ),
+           ( 19, 'src_chksum' ),
+           ( 20, 'tgt_chksum' ),
+           ( 21, 'sampled' ),
+           ( 22, 'exception' ),
+           ( 23, 'exception_type' ),
+           ( 24, 'traceback' ),
+         )
+
+ENUMS = {
+    'sev': ( 'DEBUG', 'INFO', 'WARNING', 'ERROR' ),
+    'synctype': ( 'SYNCDIR', 'SYNCDIRSLICE', 'SYNCDIRMETA', 'SYNCFILE',
+                  'SYNCFILECHUNK', 'SYNCHARDLINK', 'SYNCSYMLINK', 'RMDIR',
+                  'RMFILE', 'PURGEDIR', 'PURGEFILES', 'PURGEFILE', 'RUN',
+                  'dir_scan' ),
+    'msgtype': ( 'start', 'end', 'info', 'split', 'error', 'warning', 'retry',
+                 'skipentry', 'summary', 'done' ),
+    'action': ( 'None', 'data_copy', 'meta_update', 'link', 'rename' ),
+}
+
+PATH_FIELDS = ( 'src', 'tgt' )
+
+# Seconds an Encoder does not try to intern new entries after redis failed
+RETRY_SECS = 10
+
+_field_code = { name: code for ( code, name ) in FIELDS }
+_field_name = { code: name for ( code, name ) in FIELDS }
+_enum_code = { f: { v: i for ( i, v ) in enumerate( vals ) }
+               for ( f, vals ) in ENUMS.iteritems() }
+
+
+class Intern_Table( object ):
+    """ Small integer ids for strings (host names, path prefixes), shared by
+        all processes through redis
+
+    '<key>:ids' is the hash id -> value (what readers need), '<key>' the
+    hash value -> id and '<key>:seq' the last id.  An id -> value entry is
+    written before the value -> id entry that makes it visible to other
+    processes, so any id a record uses is in '<key>:ids'.
+    """
+
+    def __init__( self, conn, key ):
+        self.conn = conn
+        self.key = key
+        self.ids_key = key + ':ids'
+        self._ids = {}
+
+
+    def id_for( self, value ):
+        """
+        :return: int, id of value (created if new)
+        :raises redis.RedisError:
+        """
+        if value not in self._ids:
+            vid = self.conn.hget( self.key, value )
+            if vid is None:
+                new = self.conn.incr( self.key + ':seq' )
+                self.conn.hset( self.ids_key, new, value )
+                if self.conn.hsetnx( self.key, value, new ):
+                    vid = new
+                else:
+                    # someone else interned it first
+                    vid = self.conn.hget( self.key, value )
+            self._ids[ value ] = int( vid )
+        return self._ids[ value ]
+
+
+    def values( self ):
+        """
+        :return: dict, id -> value of every entry
+        """
+        return { int( k ): v
+                 for ( k, v ) in self.conn.hgetall( self.ids_key ).iteritems() }
+
+
+    def size( self ):
+        return self.conn.hlen( self.ids_key )
+
+
+class Encoder( object ):
+    """ Turns log records into compact records (see Redis_Logger encoder)
+
+    Tables are interned in redis under '<name>:hosts' and '<name>:prefixes'.
+    encode() and add_prefixes() never wait for redis: encode() only uses
+    the ids interned so far, new values are kept as they are in the record
+    (which is valid too) and queued, and intern_new() interns them (the
+    Redis_Logger flusher calls it before each flush).  If redis can not be
+    reached new entries are not tried again for RETRY_SECS.
+    """
+
+    def __init__( self, conn, name ):
+        """
+        :param conn redis.Redis: where the tables are interned
+        :param name str: log queue (base) name
+        """
+        self.hosts = Intern_Table( conn, name + ':hosts' )
+        self.prefix_table = Intern_Table( conn, name + ':prefixes' )
+        # ( prefix, id ), longest first, replaced (not changed) by
+        # intern_new, so encode() can use it without the lock
+        self.prefixes = []
+        # ( table, value ) waiting for intern_new
+        self._new = []
+        self._lock = threading.Lock()
+        self._retry_at = 0
+
+
+    def _queue( self, table, value ):
+        with self._lock:
+            if ( table, value ) not in self._new:
+                self._new.append( ( table, value ) )
+
+
+    def _intern( self, table, value ):
+        """
+        :return: int, id of value in table, None if it is not interned yet
+                 (it is queued for intern_new)
+        """
+        vid = table._ids.get( value )
+        if vid is None:
+            self._queue( table, value )
+        return vid
+
+
+    def intern_new( self ):
+        """
+        Intern the values encode() and add_prefixes() queued
+        :return: int, number of values still waiting (redis failed)
+        """
+        with self._lock:
+            new = list( self._new )
+        if len( new ) < 1 or time.time() < self._retry_at:
+            return len( new )
+        prefixes = list( self.prefixes )
+        done = 0
+        try:
+            for ( table, value ) in new:
+                vid = table.id_for( value )
+                if table is self.prefix_table:
+                    prefixes.append( ( value, vid ) )
+                done += 1
+        except ( Exception ) as e:
+            self._retry_at = time.time() + RETRY_SECS
+        prefixes.sort( key=lambda x: len( x[0] ), reverse=True )
+        self.prefixes = prefixes
+        with self._lock:
+            del self._new[ :done ]
+            return len( self._new )
+
+
+    def add_prefixes( self, *paths ):
+        """
+        Store paths under paths as relative to them (ie: run roots), once
+        intern_new() interned them.  Cheap for paths that were added before.
+        :return: True if there are new paths (for intern_new)
+        """
+        new = False
+        for p in paths:
+            p = p.rstrip( os.sep ) if p else p
+            if p and p not in self.prefix_table._ids:
+                self._queue( self.prefix_table, p )
+                new = True
+        return new
+
+
+    def _path( self, path ):
+        for ( p, pid ) in self.prefixes:
+            rest = path[ len( p ): ]
+            if path.startswith( p ) and rest[ :1 ] in ( '', os.sep ):
+                return [ pid, rest ]
+        return path
+
+
+    def encode( self, rec ):
+        """
+        :param rec dict: log record
+        :return: dict, compact record
+        """
+        out = { FIELD_VERSION: VERSION }
+        for ( k, v ) in rec.iteritems():
+            if k in _enum_code:
+                v = _enum_code[ k ].get( v, v )
+            elif k in PATH_FIELDS and isinstance( v, basestring ):
+                v = self._path( v )
+            elif k == 'host':
+                hid = self._intern( self.hosts, v )
+                if hid is not None:
+                    v = hid
+            out[ _field_code.get( k, k ) ] = v
+        return out
+
+
+def table_record( hosts, prefixes ):
+    """
+    :return: dict, a table record (see module comment)
+    """
+    return { FIELD_VERSION: VERSION,
+             TABLES: { 'hosts': hosts, 'prefixes': prefixes } }
+
+
+class Tables( object ):
+    """ Reader side of the tables in redis, for collectors: adds the table
+        entries a log file does not have yet ahead of the records
+    """
+
+    def __init__( self, conn, name ):
+        self.hosts = Intern_Table( conn, name + ':hosts' )
+        self.prefixes = Intern_Table( conn, name + ':prefixes' )
+        self.lock = threading.Lock()
+        self.sizes = ( 0, 0 )
+        self.data = ( {}, {} )
+
+
+    def current( self ):
+        """
+        :return: tuple ( hosts, prefixes ), dicts id -> value, refetched
+                 only if entries were added
+        """
+        with self.lock:
+            sizes = ( self.hosts.size(), self.prefixes.size() )
+            if sizes != self.sizes:
+                self.data = ( self.hosts.values(), self.prefixes.values() )
+                self.sizes = sizes
+            return self.data
+
+
+    def new_entries( self, written ):
+        """
+        Call after the records are taken from redis and before they are
+        written, then the tables have every id they use
+        :param written dict: ids written to a file so far, { 'hosts': set,
+                             'prefixes': set }, updated
+        :return: str, CBOR encoded table record with the entries not
+                 written yet, '' if there are none
+        """
+        ( hosts, prefixes ) = self.current()
+        new = {}
+        for ( name, table ) in ( ( 'hosts', hosts ), ( 'prefixes', prefixes ) ):
+            done = written.setdefault( name, set() )
+            new[ name ] = { k: v for ( k, v ) in table.iteritems()
+                            if k not in done }
+            done.update( new[ name ] )
+        if not new[ 'hosts' ] and not new[ 'prefixes' ]:
+            return ''
+        return cbor.dumps( table_record( new[ 'hosts' ], new[ 'prefixes' ] ) )
+
+
+class Decoder( object ):
+    """ Turns records of either format back into dicts of field names
+    """
+
+    def __init__( self ):
+        self.hosts = {}
+        self.prefixes = {}
+
+
+    def decode( self, rec ):
+        """
+        :param rec dict: record as read from the log
+        :return: dict, the record with field names, None for a table record
+        """
+        if FIELD_VERSION not in rec:
+            return rec
+        if rec[ FIELD_VERSION ] > VERSION:
+            raise UserWarning( 'Unknown log record version {0}'.format(
+                rec[ FIELD_VERSION ] ) )
+        if TABLES in rec:
+            self.hosts.update( rec[ TABLES ].get( 'hosts', {} ) )
+            self.prefixes.update( rec[ TABLES ].get( 'prefixes', {} ) )
+            return None
+        out = {}
+        for ( k, v ) in rec.iteritems():
+            if k == FIELD_VERSION:
+                continue
+            k = _field_name.get( k, k )
+            if k in ENUMS and isinstance( v, ( int, long ) ):
+                v = ENUMS[ k ][ v ]
+            elif k in PATH_FIELDS and isinstance( v, list ):
+                v = self.prefixes[ v[0] ] + v[1]
+            elif k == 'host' and isinstance( v, ( int, long ) ):
+                v = self.hosts[ v ]
+            out[ k ] = v
+        return out
+
+
+def severity( rec ):
+    """
+    :param rec dict: record as read from the log, either format
+    :return: str, its severity (ie: INFO)
+    """
+    if FIELD_VERSION in rec:
+        sev = rec[ _field_code[ 'sev' ] ]
+        if isinstance( sev, ( int, long ) ):
+            sev = ENUMS[ 'sev' ][ sev ]
+        return sev
+    return rec[ 'sev' ]
+
+
+def open_log( path ):
+    """
+    :return: file object for a log file or segment, plain, .gz or .xz
+    """
+    if path.endswith( '.gz' ):
+        return gzip.open( path, 'rb' )
+    if path.endswith( '.xz' ):
+        if lzma is None:
+            raise UserWarning( 'No lzma module to read {0}'.format( path ) )
+        return lzma.open( path, 'rb' )
+    return open( path, 'rb' )
+
+
+def read_log( path ):
+    """
+    Generator, the records of a log file in either format, as dicts of
+    field names
+    :raises ValueError: the file is corrupt (records up to it are yielded)
+    """
+    decoder = Decoder()
+    with open_log( path ) as f:
+        while True:
+            try:
+                rec = cbor.load( f )
+            except ( EOFError ) as e:
+                return
+            rec = decoder.decode( rec )
+            if rec is not None:
+                yield rec
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
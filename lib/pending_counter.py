@@ -0,0 +1,207 @@
+import os
+import time
+import cbor
+
+# Uncount one task (see Pending_Counter.decr)
+# KEYS: pending key, dirpending key, running key
+# ARGV: task id ('' for any), task field, 1 if a dir is given, dir
+# Returns nil if the task id is not running (ie: it was released already),
+# else { work left, children of the dir left (if a dir is given) }
+DECR_SCRIPT = """
+if ARGV[1] ~= '' and redis.call( 'HDEL', KEYS[3], ARGV[1] ) == 0 then
+    return nil
+end
+redis.call( 'HINCRBY', KEYS[1], ARGV[2], -1 )
+local work = redis.call( 'HINCRBY', KEYS[1], 'work', -1 )
+if ARGV[3] ~= '1' then
+    return { work }
+end
+local dir_left = redis.call( 'HINCRBY', KEYS[2], ARGV[4], -1 )
+if dir_left == 0 then
+    redis.call( 'HDEL', KEYS[2], ARGV[4] )
+end
+return { work, dir_left }
+"""
+
+
+class Pending_Counter( object ):
+    """ Outstanding (enqueued or running) tasks of a psync run, in redis
+
+    Two redis hashes are kept per run:
+
+    'psync_pending:<run_id>' has one field per task name plus the field
+    'work', the total over all tasks.  A task is counted before it is sent
+    and uncounted when it returns (success or failure).  Reading counts is a
+    single HGETALL of a small hash.
+
+    'psync_dirpending:<run_id>' has one field per directory (path relative
+    to the run roots) that is still being worked on, the value is the number
+    of its outstanding children: tasks sent on behalf of the directory (file
+    tasks, slices, subdir sync_dir tasks, where a subdir counts until the
+    metadata of its own subdirs is set) plus one while its sync_dir is
+    running.  When it drops
+    to zero the whole subtree is done and the field is removed.
+
+    'psync_running:<run_id>' has one field per running task (task id), the
+    value is the CBOR encoded list [ task name, start time, host, pid, task
+    args ].  A task is uncounted only if it is still in there, so a task
+    that was killed (hard time limit, lost worker process) and never
+    returned can be released (see stuck, forget) without being uncounted
+    twice.
+    """
+
+    key_prefix = 'psync_pending:'
+    dir_key_prefix = 'psync_dirpending:'
+    running_key_prefix = 'psync_running:'
+
+    def __init__( self, conn, run_id, parent=None ):
+        """
+        :param conn redis.Redis: redis connection
+        :param run_id str: psync run (see run_registry)
+        :param parent str: (optional) directory on whose behalf tasks are
+                           counted by incr
+        """
+        self.conn = conn
+        self.run_id = run_id
+        self.parent = parent
+        self.key = '{0}{1}'.format( self.key_prefix, run_id )
+        self.dir_key = '{0}{1}'.format( self.dir_key_prefix, run_id )
+        self.running_key = '{0}{1}'.format( self.running_key_prefix, run_id )
+        self._decr = conn.register_script( DECR_SCRIPT )
+
+
+    @staticmethod
+    def task_key( task_name ):
+        """ Counter field for task_name (ie: 'psync.sync_file' -> 'sync_file')
+        """
+        return task_name.rsplit( '.', 1 )[-1]
+
+
+    def incr( self, counts ):
+        """
+        Count new tasks (and add them to the children of self.parent),
+        call before the tasks are sent
+        :param counts dict: keys are task names, values are number of tasks
+        :return: None
+        """
+        work = 0
+        pipe = self.conn.pipeline()
+        for ( name, num ) in counts.iteritems():
+            pipe.hincrby( self.key, self.task_key( name ), num )
+            work += num
+        pipe.hincrby( self.key, 'work', work )
+        if self.parent is not None:
+            pipe.hincrby( self.dir_key, self.parent, work )
+        pipe.execute()
+
+
+    def hold_dir( self, dirpath ):
+        """
+        Keep directory dirpath from completing until release by decr
+        (used while its sync_dir task is running)
+        """
+        self.conn.hincrby( self.dir_key, dirpath, 1 )
+
+
+    def start( self, task_id, task_name, args, queued=False ):
+        """
+        A counted task started running (call from the worker process)
+        :param task_id str: celery task id
+        :param task_name str: task name
+        :param args list: task args
+        :param queued bool: the task is queued again instead (ie: a retry),
+                            it is not stuck however long it waits
+        """
+        started = None if queued else time.time()
+        self.conn.hset( self.running_key, task_id, cbor.dumps(
+            [ task_name, started, os.uname()[1], os.getpid(), args ] ) )
+
+
+    def decr( self, task_name, dirpath=None, task_id=None ):
+        """
+        Uncount one finished task
+        :param task_name str: name of the finished task
+        :param dirpath str: (optional) directory to remove one child from
+        :param task_id str: (optional) id of the task, it is uncounted only
+                            if it is still running (see start, forget)
+        :return: tuple ( remaining 'work' count, remaining children of
+                 dirpath ), the latter is None if dirpath is None.
+                 None if the task is not running.
+        """
+        results = self._decr(
+            keys=[ self.key, self.dir_key, self.running_key ],
+            args=[ task_id or '', self.task_key( task_name ),
+                   0 if dirpath is None else 1, dirpath or '' ] )
+        if results is None:
+            return None
+        dir_left = results[1] if dirpath is not None else None
+        return ( results[0], dir_left )
+
+
+    def running( self ):
+        """
+        :return: dict, task id -> dict with keys name, started (None for a
+                 task that is queued again), host, pid, args of every
+                 running task
+        """
+        tasks = {}
+        for ( task_id, data ) in self.conn.hgetall( self.running_key ).iteritems():
+            tasks[ task_id ] = dict( zip(
+                ( 'name', 'started', 'host', 'pid', 'args' ), cbor.loads( data ) ) )
+        return tasks
+
+
+    def stuck( self, max_secs ):
+        """
+        :param max_secs int: longest time a task can run (ie: the hard time
+                             limit of the workers)
+        :return: dict, the running tasks (see running) that started more
+                 than max_secs ago, they were killed
+        """
+        oldest = time.time() - max_secs
+        return { task_id: t for ( task_id, t ) in self.running().iteritems()
+                 if t[ 'started' ] is not None and t[ 'started' ] < oldest }
+
+
+    def forget( self, task_id ):
+        """
+        Take a task that never returned out of the running tasks, the caller
+        then uncounts it (decr without task_id)
+        :return: True if the task was running, False if it returned or was
+                 forgotten already
+        """
+        return self.conn.hdel( self.running_key, task_id ) == 1
+
+
+    def release_dir( self, dirpath ):
+        """
+        Remove one child from dirpath without a task finishing (ie: a subdir
+        that needed no further work)
+        :return: int, remaining children of dirpath
+        """
+        dir_left = self.conn.hincrby( self.dir_key, dirpath, -1 )
+        if dir_left == 0:
+            self.conn.hdel( self.dir_key, dirpath )
+        return dir_left
+
+
+    def counts( self ):
+        """
+        :return: dict, keys are task names and 'work', values are int
+        """
+        return { k: int( v ) for ( k, v ) in self.conn.hgetall( self.key ).iteritems() }
+
+
+    def num_dirs( self ):
+        """
+        :return: int, number of directories whose subtree is not done yet
+        """
+        return self.conn.hlen( self.dir_key )
+
+
+    def delete( self ):
+        self.conn.delete( self.key, self.dir_key, self.running_key )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
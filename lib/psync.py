@@ -1,14 +1,32 @@
 from __future__ import absolute_import
 from runcmd import runcmd, Run_Cmd_Error
 import celery
+import celery.signals
 import celery.utils.log
+from celery.exceptions import SoftTimeLimitExceeded
 import os
 import stat
 import pprint
-import pylut
+import errno
+import uuid
 import redis_logger
 import fsitem
+import dirscan
+import dirdiff
+import task_publisher
+import run_registry
+import cbor_serializer
+import pending_counter
+import dir_meta
+import copy_backend
+import chunked_copy
+import checksum_cache
+import hardlink_registry
+import throttle
+import log_summary
 import time
+import math
+import redis
 import celeryconfig
 import broker_url
 
@@ -17,6 +35,8 @@ import broker_url
 # *_sync = local (normal) function
 
 logger = celery.utils.log.get_task_logger(__name__)
+# Task messages are CBOR encoded (see celeryconfig.CELERY_TASK_SERIALIZER)
+cbor_serializer.register()
 app = celery.Celery( 'psync' )
 # Collect config settings from config modules
 app.conf.update( **{ k:getattr( celeryconfig,k ) 
@@ -27,15 +47,59 @@ redisconf_fn = os.environ[ 'PSYNCREDISURLFILE' ]
 redisconf_name = os.path.basename( redisconf_fn ).split( '.py' )[0]
 redisconf = __import__( redisconf_name )
 # TODO Get log queue_name from config file (or cmdline?)
-logr = redis_logger.Redis_Logger( url=redisconf.BROKER_URL, queue_name='psync_log' )
+# Per severity log queues, optionally sharded over PSYNCLOGSHARDS lists per
+# severity on the redis servers in PSYNCLOGURLS, records are spooled to
+# PSYNCLOGSPOOLDIR while redis is slow or down (see redis_logger)
+logr = redis_logger.Redis_Logger( url=redisconf.BROKER_URL, queue_name='psync_log',
+    shards=int( os.environ.get( 'PSYNCLOGSHARDS', 1 ) ),
+    urls=os.environ.get( 'PSYNCLOGURLS', '' ).split(),
+    spool_dir=os.environ.get( 'PSYNCLOGSPOOLDIR' ) or None,
+    compact=True )
+# Shared state between tasks (ie: counters)
+rdb = redis.Redis.from_url( redisconf.BROKER_URL )
+# Options, roots and tmp/rm dirs of each run, tasks carry only the run id
+# and paths relative to the roots
+runs = run_registry.Run_Registry.from_url( redisconf.BROKER_URL )
 #logr.info( 'CELERY_ROUTES: {0}'.format( app.conf.CELERY_ROUTES ) )
 
-psynctmpdir = os.environ[ 'PSYNCTMPDIR' ]
-psyncrmdir = os.environ[ 'PSYNCRMDIR' ]
-
 localhostname = os.uname()[1]
 
 
+# Log records are buffered per process (see redis_logger), push them when a
+# task ends (without waiting for it) and before a worker process exits
+# (pool processes end without running atexit)
+@celery.signals.task_postrun.connect
+def flush_log_after_task( **k ):
+    logr.request_flush()
+
+
+@celery.signals.worker_process_shutdown.connect
+@celery.signals.worker_shutdown.connect
+def flush_log_at_shutdown( **k ):
+    logr.flush()
+
+
+# Paths in log records are stored relative to the roots and mountpoints of
+# the run (args[0] of every psync task), see logschema
+@celery.signals.task_prerun.connect
+def log_paths_of_run( args=None, **k ):
+    try:
+        run = runs.get( args[0] )
+        logr.add_prefixes( run[ 'src_root' ], run[ 'tgt_root' ],
+                           run[ 'src_mountpoint' ], run[ 'tgt_mountpoint' ] )
+    except ( Exception ) as e:
+        # not a psync task, or an unknown run (the task will say so)
+        pass
+
+
+# Tasks that were killed (hard time limit, lost worker process) never
+# return, they are released by release_stuck
+@celery.signals.task_prerun.connect
+def count_running( task_id=None, task=None, args=None, **k ):
+    if isinstance( task, Psync_Task ):
+        pending( args[0] ).start( task_id, task.name, args )
+
+
 class Psync_Task( celery.Task ):
     abstract = True
     max_retries = 0
@@ -48,114 +112,417 @@ class Psync_Task( celery.Task ):
                     kwargs         = str( kwargs ),
                     traceback      = str( einfo.traceback ) )
 
+    def on_retry( self, exc, task_id, args, kwargs, einfo ):
+        # queued again, not stuck however long it waits for a worker
+        pending( args[0] ).start( task_id, self.name, args, queued=True )
+
+    def after_return( self, status, retval, task_id, args, kwargs, einfo ):
+        self.uncount( args, task_id )
+
+    def uncount( self, args, task_id=None ):
+        """
+        Uncount the task (success or failure) from the pending counts of its
+        run (args[0]) and from the children of its directory (args[1]).
+        The task that finishes the last child of a directory finishes the
+        directory (see dir_done), sync_dir_meta_batch in turn finishes a
+        child of the parent directory, so directory metadata is set bottom-up
+        as soon as each subtree is done.
+        Nothing is done if task_id is not running (it was released).
+        """
+        ( run_id, relpath ) = args[:2]
+        if self.name == sync_dir_meta_batch.name:
+            if relpath == '':
+                if pending( run_id ).decr( self.name, task_id=task_id ):
+                    run_done( run_id )
+                return
+            relpath = os.path.dirname( relpath )
+        left = pending( run_id ).decr( self.name, relpath, task_id )
+        if left and left[1] == 0:
+            dir_done( run_id, relpath )
+
+    def release( self, task_id, args ):
+        """
+        Uncount a task that was killed and never returned (see release_stuck)
+        :return: True if released, False if the task returned after all
+        """
+        if not pending( args[0] ).forget( task_id ):
+            return False
+        logr.error( 'Task killed',
+                    exception_type = 'killed',
+                    task           = self.name,
+                    args           = str( args ) )
+        self.on_killed( args )
+        self.uncount( args )
+        return True
+
+    def on_killed( self, args ):
+        """ Clean up after a killed task, before it is uncounted
+        """
+        pass
+
+
+class Chunk_Task( Psync_Task ):
+    """ sync_file_chunk, a killed chunk is a failed chunk (see
+    sync_file_chunk)
+    """
+    abstract = True
+    def on_killed( self, args ):
+        ( run_id, relpath, entry, chunk ) = args
+        entry = dirscan.Entry._make( entry )
+        if _chunk_tracker( run_id, entry ).failed( chunk[0], 'Task killed' ):
+            apply_counted( sync_file_chunked_done, ( run_id, relpath, entry ),
+                           parent=relpath )
+
+
+class Purge_Task( Psync_Task ):
+    """ Tasks of a purge run (see purge_dir), same accounting as Psync_Task,
+    except that a directory whose subtree is done is removed (purge_dir_done)
+    """
+    abstract = True
+    def uncount( self, args, task_id=None ):
+        ( run_id, relpath ) = args[:2]
+        left = pending( run_id ).decr( self.name, relpath, task_id )
+        if left and left[1] == 0:
+            purge_dir_done( run_id, relpath )
+
+
+def release_stuck( run_id, max_secs ):
+    """
+    Release the tasks of a run that have been running for more than
+    max_secs, they were killed (hard time limit, lost worker process) and
+    will never return.  Without this their directories, and the run, are
+    never done.
+    :param run_id str: psync run (see run_registry)
+    :param max_secs int: longer than any task can run (ie: the hard time
+                         limit of the workers)
+    :return: list of dicts of the released tasks (see
+             Pending_Counter.running)
+    """
+    released = []
+    for ( task_id, t ) in pending( run_id ).stuck( max_secs ).iteritems():
+        if app.tasks[ t[ 'name' ] ].release( task_id, t[ 'args' ] ):
+            released.append( t )
+    return released
+
+
+def pending( run_id ):
+    """
+    :param run_id str: psync run (see run_registry)
+    :return: Pending_Counter for the run
+    """
+    return pending_counter.Pending_Counter( rdb, run_id )
+
+
+def apply_counted( task, args, parent=None ):
+    """
+    Count task as pending for its run (args[0]) and send it
+    Use this (or a Task_Publisher with a counter) for every psync task sent,
+    so that the run's pending counts stay exact.
+    :param task celery.Task: task to send
+    :param args tuple: task args, the first must be the run id
+    :param parent str: (optional) dir to count the task as a child of
+    :return: None
+    """
+    pending_counter.Pending_Counter( rdb, args[0], parent=parent ).incr(
+        { task.name: 1 } )
+    task.apply_async( args )
+
+
+def dir_done( run_id, relpath ):
+    """
+    Everything below relpath is done, except for the metadata of its subdirs.
+    Send sync_dir_meta_batch to set it, a directory without saved subdirs
+    (ie: a leaf) needs no task and is finished as a child of its parent
+    right away, and so on up the tree.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
+    :return: None
+    """
+    while relpath != '' and not _dir_meta( run_id, relpath ).exists():
+        relpath = os.path.dirname( relpath )
+        if pending( run_id ).release_dir( relpath ) != 0:
+            return
+    apply_counted( sync_dir_meta_batch, ( run_id, relpath ) )
+
+
+def _dir_meta( run_id, relpath ):
+    """
+    :return: Dir_Meta for the subdirs of relpath
+    """
+    return dir_meta.Dir_Meta( rdb, run_id, relpath )
+
+
+def _publisher( run_id, relpath ):
+    """
+    :param relpath str: dir on whose behalf the tasks are sent
+    :return: Task_Publisher that counts the tasks it sends as pending,
+             and as children of relpath
+    """
+    counter = pending_counter.Pending_Counter( rdb, run_id, parent=relpath )
+    return task_publisher.Task_Publisher( app, counter=counter )
+
 
 @app.task( base=Psync_Task )
-def sync_dir( src, tgt, psyncopts, rsyncopts ):
+def sync_dir( run_id, relpath ):
     """
     Celery task; read contents of dir, 
     create target dir if needed,
     delete contents from target as needed,
     enqueue subdirs and files as new sync tasks
-    :param src FSItem: source dir
-    :param src FSItem: target dir
-    :param psyncopts dict: options for adjusting psync behavior
-    :param rsyncopts dict: options passed to pylut.syncdir & pylut.syncfile
+    Directories with more than psyncopts[ 'slice_entries' ] entries are split
+    into sync_dir_slice tasks instead.
+    Directory metadata is set by sync_dir_meta_batch of the parent, once all
+    tasks sent for the directory (recursively) are done
+    (see Psync_Task.uncount).
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
     :return: None
     """
+    # the directory is not done before this task is, released in after_return
+    pending( run_id ).hold_dir( relpath )
+    run = runs.get( run_id )
+    ( src, tgt ) = _run_fsitems( run, relpath )
     logr.info( synctype = 'SYNCDIR',
                msgtype  = 'start',
                src      = str( src ),
                tgt      = str( tgt ) )
-    ( src_dirs, src_files ) = dir_scan( src, psyncopts )
-    tgt_dirs, tgt_files = [ {} ] * 2
-    if os.path.exists( str( tgt ) ):
-        ( tgt_dirs, tgt_files ) = dir_scan( tgt, psyncopts )
-    # Create sets of names of each filetype from both src and tgt
-    src_dir_set = set( src_dirs.keys() )
-    src_file_set = set( src_files.keys() )
-    tgt_dir_set = set( tgt_dirs.keys() )
-    tgt_file_set = set( tgt_files.keys() )
-    logr.info( synctype = 'SYNCDIR',
-               msgtype  = 'info',
-               src      = str( src ),
-               tgt      = str( tgt ),
-               num_src_dirs    = len( src_dir_set ), 
-               num_src_files   = len( src_file_set ), 
-               num_tgt_dirs    = len( tgt_dir_set ), 
-               num_tgt_files   = len( tgt_file_set ) )
-    # Delete entries in tgt that no longer exist in src
-    # To be accurate, these processes must all finish before proceeding
-    #   (use case: previous directory was removed and new file exists by the same name
-    #    as the old directory)
-    tmpbase=os.path.join( tgt.mountpoint, psyncrmdir )
-    for d in tgt_dir_set - src_dir_set:
-        try:
-            rm_dir( tgt_dirs[ d ].absname, tmpbase=tmpbase )
-        except ( Exception ) as e:
-            logr.error( synctype = 'RMDIR',
-                        msgtype = 'error',
-                        src = tgt_dirs[ d ].absname,
-                        tgt = tmpbase )
-    for f in tgt_file_set - src_file_set:
-        try:
-            rm_file( tgt_files[ f ].absname )
-        except ( Exception ) as e:
-            logr.error( synctype = 'RMFILE',
-                        msgtype = 'error',
-                        src = tgt_files[ f ].absname,
-                        tgt = tmpbase )
-    # iterate over dirs
-    for dname in src_dir_set:
-        newsrc = src_dirs[ dname ]
-        if dname not in tgt_dirs:
-            tgt_dirs[ dname ] = _mk_new_fsitem( tgt, dname )
-        newtgt = tgt_dirs[ dname ]
-        try:
-            os.mkdir( str( newtgt ) )
-        except ( OSError ) as e:
-            # Can ignore ... OSError: [Errno 17] File exists
-            if e.errno != 17:
-                raise e
-        sync_dir.apply_async( ( newsrc, newtgt, psyncopts, rsyncopts ) )
-    # iterate over files
-    for fname in src_file_set:
-        newsrc = src_files[ fname ]
-        if fname not in tgt_files:
-            tgt_files[ fname ] = _mk_new_fsitem( tgt, fname )
-        newtgt = tgt_files[ fname ]
-        file_sync( newsrc, newtgt, psyncopts, rsyncopts )
-    # sync the (local) dir to set metadata
-    sync_dir_meta.apply_async( ( src, tgt, psyncopts, rsyncopts ) )
+    if relpath == '' and dir_meta.wanted( run[ 'rsyncopts' ] ):
+        # the root is not in any parent's scan, save its own stat data
+        # for the root's sync_dir_meta_batch
+        with _dir_meta( run_id, relpath ) as store:
+            store.add( dirscan.Entry.from_stat( '', dirscan.DIR,
+                                                os.lstat( src.absname ) ) )
+    num_slices = _num_dir_slices( src, run[ 'psyncopts' ] )
+    if num_slices > 1:
+        logr.info( synctype   = 'SYNCDIR',
+                   msgtype    = 'split',
+                   src        = str( src ),
+                   tgt        = str( tgt ),
+                   num_slices = num_slices )
+        with _publisher( run_id, relpath ) as publisher:
+            for i in range( num_slices ):
+                publisher.add( sync_dir_slice,
+                    ( run_id, relpath, ( i, num_slices ) ) )
+    else:
+        _sync_dir_contents( run_id, relpath, 'SYNCDIR' )
     logr.info( synctype = 'SYNCDIR',
                msgtype  = 'end',
                src      = str( src ),
                tgt      = str( tgt ) )
 
 
-@app.task( base=Psync_Task, queue='directories' )
-def sync_dir_meta( src, tgt, psyncopts, rsyncopts ):
+@app.task( base=Psync_Task )
+def sync_dir_slice( run_id, relpath, dirslice ):
     """
-    Sync metadata only of a directory
-    :param src FSItem: src directory
-    :param tgt FSItem: tgt directory
-    :param psyncopts dict: options for adjusting psync behavior
-    :param rsyncopts dict: options passed to pylut.syncdir
+    Celery task; same as sync_dir, but only for the names in one slice of a
+    (very large) directory.  Since a name is in the same slice for both src
+    and tgt, each slice can safely delete its own target-only entries.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
+    :param dirslice tuple: ( slice index, number of slices )
     :return: None
     """
-    logr.info( synctype = 'SYNCDIRMETA',
+    ( src, tgt ) = _run_fsitems( runs.get( run_id ), relpath )
+    logr.info( synctype = 'SYNCDIRSLICE',
                msgtype  = 'start',
                src      = str( src ),
-               tgt      = str( tgt ) )
-    dirsyncopts = {}
-    for k in ( 'syncowner', 'syncgroup', 'syncperms', 'synctimes' ):
-        dirsyncopts[ k ] = rsyncopts[ k ]
-    #TODO - add error handling for pylut.syncdir
-    ( output, errput ) = pylut.syncdir( src, tgt, **dirsyncopts )
-    logr.info( synctype = 'SYNCDIRMETA',
+               tgt      = str( tgt ),
+               dirslice = '{0}/{1}'.format( *dirslice ) )
+    _sync_dir_contents( run_id, relpath, 'SYNCDIRSLICE', dirslice )
+    logr.info( synctype = 'SYNCDIRSLICE',
                msgtype  = 'end',
                src      = str( src ),
-               tgt      = str( tgt ) )
-    
+               tgt      = str( tgt ),
+               dirslice = '{0}/{1}'.format( *dirslice ) )
+
+
+def _num_dir_slices( src, psyncopts ):
+    """
+    Number of slices to split directory src into
+    The directory size is used as a cheap hint, only directories that might
+    hold more than slice_entries entries get their entries counted.
+    :param src FSItem: source dir
+    :param psyncopts dict: options for adjusting psync behavior
+    :return: int
+    """
+    max_entries = psyncopts[ 'slice_entries' ]
+    if max_entries < 1:
+        return 1
+    if os.lstat( src.absname ).st_size < max_entries * dirscan.MIN_DIRENT_SIZE:
+        return 1
+    num_entries = dirscan.count( src.absname )
+    return int( math.ceil( num_entries / float( max_entries ) ) )
+
+
+def _sync_dir_contents( run_id, relpath, synctype, dirslice=None ):
+    """
+    Body of sync_dir / sync_dir_slice.
+    Delete contents from target as needed, create subdirs and
+    enqueue subdirs and files as new sync tasks.
+    New tasks are published in bulk over one connection held for the whole
+    directory (see task_publisher).
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
+    :param synctype str: synctype for log records
+    :param dirslice tuple: ( slice index, number of slices ), None means all
+    :return: None
+    """
+    counts = dict.fromkeys( ( 'num_src_dirs', 'num_src_files',
+                              'num_tgt_dirs', 'num_tgt_files',
+                              'num_unchanged_files' ), 0 )
+    run = runs.get( run_id )
+    ( src, tgt ) = _run_fsitems( run, relpath )
+    psyncopts = run[ 'psyncopts' ]
+    # stat data of src subdirs is saved to set their metadata later
+    stat_dirs = dir_meta.wanted( run[ 'rsyncopts' ] )
+    src_listing = dir_scan( src, psyncopts, dirslice, stat_dirs )
+    tgt_listing = []
+    if os.path.exists( str( tgt ) ):
+        tgt_listing = dir_scan( tgt, psyncopts, dirslice )
+    with _publisher( run_id, relpath ) as publisher, \
+         _dir_meta( run_id, relpath ) as subdirs:
+        file_entries = _merge_dir_listings( run_id, run, relpath, tgt,
+                                            src_listing, tgt_listing,
+                                            counts, publisher, subdirs )
+        files_sync( run_id, run, relpath, file_entries, publisher )
+    logr.info( synctype = synctype,
+               msgtype  = 'info',
+               src      = str( src ),
+               tgt      = str( tgt ),
+               **counts )
+
+
+def _merge_dir_listings( run_id, run, relpath, tgt, src_listing, tgt_listing,
+                         counts, publisher, subdirs ):
+    """
+    Merge-join the sorted listings of src and tgt (see dir_scan).
+    As the merge goes, entries in tgt that no longer exist in src are deleted
+    and subdirs are created and enqueued as new sync_dir tasks.
+    A tgt entry is always deleted before a src entry with the same name is
+    created
+      (use case: previous directory was removed and new file exists by the same name
+       as the old directory)
+    :param run_id str: psync run (see run_registry)
+    :param run dict: run options and paths (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
+    :param tgt FSItem: target dir
+    :param src_listing iterable: sorted listing of src
+    :param tgt_listing iterable: sorted listing of tgt
+    :param counts dict: entry counts, updated in place
+    :param publisher Task_Publisher: where to send new sync_dir tasks
+    :param subdirs Dir_Meta: where to save src subdirs that have stat data
+    :return: generator of Entry for each src file that needs to be sync'd
+    """
+    rsyncopts = run[ 'rsyncopts' ]
+    tmpbase=os.path.join( tgt.mountpoint, run[ 'rmdir' ] )
+    quick_check = not rsyncopts[ 'pre_checksums' ]
+    for ( name, s, t ) in dirdiff.merge_join( src_listing, tgt_listing ):
+        if s is not None:
+            counts[ 'num_src_dirs' if s.ftype == dirscan.DIR else 'num_src_files' ] += 1
+        if t is not None:
+            counts[ 'num_tgt_dirs' if t.ftype == dirscan.DIR else 'num_tgt_files' ] += 1
+        # Delete tgt entry that no longer exists in src (or changed type)
+        if t is not None and ( s is None or s.ftype != t.ftype ):
+            path = os.path.join( tgt.absname, name )
+            if t.ftype == dirscan.DIR:
+                try:
+                    rm_dir( path, tmpbase=tmpbase )
+                except ( Exception ) as e:
+                    logr.error( synctype = 'RMDIR',
+                                msgtype = 'error',
+                                src = path,
+                                tgt = tmpbase )
+            else:
+                try:
+                    rm_file( path )
+                except ( Exception ) as e:
+                    logr.error( synctype = 'RMFILE',
+                                msgtype = 'error',
+                                src = path,
+                                tgt = tmpbase )
+            t = None
+        if s is None:
+            continue
+        if s.ftype == dirscan.DIR:
+            try:
+                os.mkdir( os.path.join( tgt.absname, name ) )
+            except ( OSError ) as e:
+                # Can ignore ... OSError: [Errno 17] File exists
+                if e.errno != 17:
+                    raise e
+            # only stat'd dirs (see dir_scan) have metadata to set
+            if s.mode:
+                subdirs.add( s )
+            publisher.add( sync_dir, ( run_id, os.path.join( relpath, name ) ) )
+            continue
+        # Files that already match need no sync task
+        if t is not None and quick_check \
+        and _file_is_current( s, t, rsyncopts ):
+            counts[ 'num_unchanged_files' ] += 1
+            continue
+        yield s
+
+
+@app.task( base=Psync_Task )
+def sync_dir_meta_batch( run_id, relpath ):
+    """
+    Celery task; set metadata (owner, group, perms, times) of all subdirs
+    of relpath (and of relpath itself, for the run's root) in process, from
+    the stat data saved when relpath was scanned (see dir_meta).
+    A failure for any one directory is logged as a warning for that
+    directory only and the rest of the batch continues.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: dir, relative to the run's src and tgt roots
+    :return: None
+    """
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    rsyncopts = run[ 'rsyncopts' ]
+    atime = time.time()
+    store = _dir_meta( run_id, relpath )
+    try:
+        for entry in store.entries():
+            src = os.path.normpath( os.path.join( src_dir.absname, entry.name ) )
+            tgt = os.path.normpath( os.path.join( tgt_dir.absname, entry.name ) )
+            logr.info( synctype = 'SYNCDIRMETA',
+                       msgtype  = 'start',
+                       src      = src,
+                       tgt      = tgt )
+            try:
+                dir_meta.apply( tgt, entry, rsyncopts, atime )
+            except ( SoftTimeLimitExceeded ) as e:
+                raise e
+            except ( Exception ) as e:
+                logr.warning( synctype = 'SYNCDIRMETA',
+                              msgtype  = 'error',
+                              src      = src,
+                              tgt      = tgt,
+                              error    = '{0}: {1}'.format( type( e ).__name__, e ) )
+                continue
+            logr.info( synctype = 'SYNCDIRMETA',
+                       msgtype  = 'end',
+                       src      = src,
+                       tgt      = tgt )
+    finally:
+        store.delete()
+
+
+def _run_fsitems( run, relpath ):
+    """
+    :param run dict: run options and paths (see run_registry)
+    :param relpath str: path relative to the run's src and tgt roots
+    :return: tuple ( src FSItem, tgt FSItem )
+    """
+    items = []
+    for side in ( 'src', 'tgt' ):
+        absname = os.path.normpath(
+            os.path.join( run[ side + '_root' ], relpath ) )
+        items.append( fsitem.FSItem(
+            os.path.basename( absname ),
+            absname=absname,
+            mountpoint=run[ side + '_mountpoint' ] ) )
+    return tuple( items )
+
 
 def _mk_new_fsitem( parent, name ):
     return fsitem.FSItem( 
@@ -165,125 +532,565 @@ def _mk_new_fsitem( parent, name ):
 
 
 @app.task( base=Psync_Task )
-def sync_file( src, tgt, rsyncopts ):
+def sync_file( run_id, relpath, entry ):
     """
     Celery task, sync a file
-    :param src FSItem: src file
-    :param tgt FSItem: tgt file
-    :param rsyncopts dict: options passed to pylut.syncdir & pylut.syncfile
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry list: src file, fields of dirscan.Entry
+    :return: None
+    """
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    entry = dirscan.Entry._make( entry )
+    with _log_summary( run, 'SYNCFILE', src_dir, tgt_dir ) as summary:
+        _sync_a_file( _mk_new_fsitem( src_dir, entry.name ),
+                      _mk_new_fsitem( tgt_dir, entry.name ),
+                      run, 'FILE', summary=summary )
+
+
+@app.task( base=Psync_Task )
+def sync_file_batch( run_id, relpath, entries ):
+    """
+    Celery task, sync a batch of (small) files from the same directory
+    Each file is sync'd exactly as sync_file would, a failure of any one file
+    is logged as a warning for that file only and the rest of the batch
+    continues.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entries list: src files, each a list of the fields of dirscan.Entry
+    :return: None
+    """
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    with _log_summary( run, 'SYNCFILE', src_dir, tgt_dir ) as summary:
+        for entry in map( dirscan.Entry._make, entries ):
+            src = _mk_new_fsitem( src_dir, entry.name )
+            tgt = _mk_new_fsitem( tgt_dir, entry.name )
+            try:
+                _sync_a_file( src, tgt, run, 'FILE', summary=summary )
+            except ( SoftTimeLimitExceeded ) as e:
+                raise e
+            except ( Exception ) as e:
+                summary.error()
+                logr.warning( synctype = 'SYNCFILE',
+                              msgtype  = 'error',
+                              src      = str( src ),
+                              tgt      = str( tgt ),
+                              error    = '{0}: {1}'.format( type( e ).__name__, e ) )
+
+
+@app.task( base=Psync_Task )
+def sync_file_chunked( run_id, relpath, entry ):
+    """
+    Celery task, start the copy of a (very large) file in chunks
+    Create the preallocated tmp file and send one sync_file_chunk task per
+    psyncopts[ 'chunk_bytes' ] of data, any worker can copy any chunk.
+    The last chunk to finish sends sync_file_chunked_done.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry list: src file, fields of dirscan.Entry
+    :return: None
+    """
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    entry = dirscan.Entry._make( entry )
+    if _chunked_target_is_current( run, _mk_new_fsitem( src_dir, entry.name ),
+                                   _mk_new_fsitem( tgt_dir, entry.name ) ):
+        return
+    ranges = chunked_copy.chunk_ranges( entry.size,
+                                        run[ 'psyncopts' ][ 'chunk_bytes' ] )
+    logr.info( synctype = 'SYNCFILE',
+               msgtype  = 'start',
+               src      = os.path.join( src_dir.absname, entry.name ),
+               tgt      = os.path.join( tgt_dir.absname, entry.name ),
+               size     = entry.size,
+               chunks   = len( ranges ) )
+    chunked_copy.create( _chunked_tmp_path( run_id, run, entry ), entry.size )
+    _chunk_tracker( run_id, entry ).start( len( ranges ) )
+    with _publisher( run_id, relpath ) as publisher:
+        for ( i, ( offset, length ) ) in enumerate( ranges ):
+            publisher.add( sync_file_chunk,
+                           ( run_id, relpath, entry, ( i, offset, length ) ) )
+
+
+@app.task( base=Chunk_Task, bind=True, max_retries=chunked_copy.CHUNK_RETRIES )
+def sync_file_chunk( self, run_id, relpath, entry, chunk ):
+    """
+    Celery task, copy one chunk of a file into the tmp file
+    A failed chunk is retried on its own (the retry is the same pending
+    task, after_return is not called for it), after CHUNK_RETRIES it is
+    marked failed.  The last chunk to finish, either way, sends
+    sync_file_chunked_done.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry list: src file, fields of dirscan.Entry
+    :param chunk tuple: ( chunk index, offset, length )
+    :return: None
+    """
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    entry = dirscan.Entry._make( entry )
+    ( index, offset, length ) = chunk
+    src = os.path.join( src_dir.absname, entry.name )
+    tmp_path = _chunked_tmp_path( run_id, run, entry )
+    tracker = _chunk_tracker( run_id, entry )
+    logr.info( synctype = 'SYNCFILECHUNK',
+               msgtype  = 'start',
+               src      = src,
+               tgt      = tmp_path,
+               chunk    = index,
+               offset   = offset,
+               length   = length )
+    # SoftTimeLimitExceeded is handled like any other error, so the chunk
+    # is retried (and counted as finished if it keeps failing)
+    try:
+        checksums = chunked_copy.copy_chunk( src, tmp_path, offset, length,
+            checksum=_inline_checksum( run ),
+            reread=run[ 'psyncopts' ][ 'verify_reread' ] )
+    except ( Exception ) as e:
+        error = '{0}: {1}'.format( type( e ).__name__, e )
+        if self.request.retries < self.max_retries:
+            logr.warning( synctype = 'SYNCFILECHUNK',
+                          msgtype  = 'retry',
+                          src      = src,
+                          tgt      = tmp_path,
+                          chunk    = index,
+                          retries  = tracker.retried( index ),
+                          error    = error )
+            raise self.retry( exc=e )
+        logr.warning( synctype = 'SYNCFILECHUNK',
+                      msgtype  = 'error',
+                      src      = src,
+                      tgt      = tmp_path,
+                      chunk    = index,
+                      error    = error )
+        last = tracker.failed( index, error )
+    else:
+        msg_parts = {}
+        if checksums is not None:
+            ( msg_parts[ 'src_chksum' ], msg_parts[ 'tgt_chksum' ] ) = checksums
+        logr.info( synctype = 'SYNCFILECHUNK',
+                   msgtype  = 'end',
+                   src      = src,
+                   tgt      = tmp_path,
+                   chunk    = index,
+                   **msg_parts )
+        last = tracker.done( index )
+    if last:
+        apply_counted( sync_file_chunked_done, ( run_id, relpath, entry ),
+                       parent=relpath )
+
+
+@app.task( base=Psync_Task )
+def sync_file_chunked_done( run_id, relpath, entry ):
+    """
+    Celery task, finish a chunked file copy (see sync_file_chunked)
+    Verify the tmp file, set metadata and rename it to the target.  If any
+    chunk failed, the tmp file is removed and the file is logged as failed.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry list: src file, fields of dirscan.Entry
     :return: None
     """
-    _sync_a_file( src, tgt, rsyncopts, 'FILE' )
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    entry = dirscan.Entry._make( entry )
+    src = _mk_new_fsitem( src_dir, entry.name )
+    tgt = _mk_new_fsitem( tgt_dir, entry.name )
+    tmp_path = _chunked_tmp_path( run_id, run, entry )
+    tracker = _chunk_tracker( run_id, entry )
+    rsyncopts = run[ 'rsyncopts' ]
+    try:
+        failures = tracker.failures()
+        if len( failures ) > 0:
+            raise copy_backend.Copy_Error( 'Failed chunks: {0}'.format(
+                ', '.join( str( i ) for i in sorted( failures ) ) ) )
+        action_type = chunked_copy.finish( src.absname, tmp_path, tgt.absname,
+                                           entry, rsyncopts )
+    except ( copy_backend.Copy_Error ) as e:
+        logr.warning( synctype = 'SYNCFILE',
+                      msgtype  = 'error',
+                      src      = str( src ),
+                      tgt      = str( tgt ),
+                      error    = str( e ) )
+        if os.path.exists( tmp_path ):
+            os.unlink( tmp_path )
+        return
+    finally:
+        tracker.delete()
+    # data was verified per chunk (see sync_file_chunk), rather than by
+    # reading the whole file again
+    _log_sync_end( 'SYNCFILE', src, tgt, dict( rsyncopts, post_checksums=False ),
+                   action_type, 1, _checksum_cache( run ) )
+
+
+def _can_chunk( run ):
+    """
+    :return: True if files of the run can be copied in chunks, False if the
+             run uses the pylut backend (Lustre to Lustre), which sets the
+             stripe layout of the target and copies files whole
+    """
+    backend = copy_backend.for_mountpoints( run[ 'src_mountpoint' ],
+                                            run[ 'tgt_mountpoint' ] )
+    return backend.name == copy_backend.Native_Copy.name
+
+
+def _chunked_target_is_current( run, src, tgt ):
+    """
+    Check a file for sync_file_chunked the way the copy backend would
+    (see copy_backend.is_current): if the target data is current only its
+    metadata is synced and the sync is logged.
+    :return: True if tgt is current, False if it needs a copy
+    """
+    rsyncopts = run[ 'rsyncopts' ]
+    cache = _checksum_cache( run )
+    start = time.time()
+    try:
+        src_st = os.lstat( src.absname )
+        tgt_st = copy_backend.lstat_or_none( tgt.absname )
+        if not copy_backend.is_current( tgt.absname, tgt_st, src.absname,
+                src_st, rsyncopts[ 'pre_checksums' ], rsyncopts[ 'synctimes' ],
+                cache.checksum ):
+            return False
+        meta_update = copy_backend.set_meta( tgt.absname, tgt_st, src_st,
+            rsyncopts[ 'synctimes' ], rsyncopts[ 'syncperms' ],
+            rsyncopts[ 'syncowner' ], rsyncopts[ 'syncgroup' ] )
+    except ( OSError, IOError ) as e:
+        # let the chunked copy run into (and log) the error
+        return False
+    _log_sync_end( 'SYNCFILE', src, tgt, rsyncopts,
+                   { 'data_copy': False, 'meta_update': meta_update }, 1,
+                   cache, secs=time.time() - start )
+    return True
+
+
+def _chunked_tmp_path( run_id, run, entry ):
+    """
+    :return: path of the tmp file a chunked copy of src file entry is
+             written to (in the run's tmpdir on the target)
+    """
+    return os.path.join( run[ 'tgt_mountpoint' ], run[ 'tmpdir' ],
+                         '{0}.{1}.chunked'.format( run_id, entry.inode ) )
+
 
+def _chunk_tracker( run_id, entry ):
+    return chunked_copy.Chunk_Tracker( rdb, run_id, entry.inode )
 
-@app.task( base=Psync_Task, queue='hardlinks' )
-def sync_hardlink( src, tgt, rsyncopts ):
+
+# Max seconds between retries of a link waiting for the first copy of its
+# inode (see sync_hardlink)
+HARDLINK_MAX_WAIT = 60
+
+
+@app.task( base=Psync_Task, bind=True, max_retries=None )
+def sync_hardlink( self, run_id, relpath, entry ):
     """
     Celery task, sync a file with multiple hardlinks
-    This is identical to sync_file, but has to be a separate function so tasks
-    can be assigned on a special named queue.
-    :param src FSItem: src file
-    :param tgt FSItem: tgt file
-    :param rsyncopts dict: options passed to pylut.syncdir & pylut.syncfile
+    The first link of a source inode to get here claims it in the run's
+    Hardlink_Registry and is synced like any file, later links of the inode
+    are made hardlinks to that first target path once it is done.  A link
+    whose first copy is still running is retried later (the task stays
+    pending, see Psync_Task.on_retry), so links of the same inode are
+    never copied twice and links of different inodes are synced by any
+    number of workers in parallel.  A claim whose sync fails is released,
+    the next link of the inode claims it.
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry list: src file, fields of dirscan.Entry
     :return: None
     """
-    _sync_a_file( src, tgt, rsyncopts, 'HARDLINK' )
+    run = runs.get( run_id )
+    ( src_dir, tgt_dir ) = _run_fsitems( run, relpath )
+    entry = dirscan.Entry._make( entry )
+    src = _mk_new_fsitem( src_dir, entry.name )
+    tgt = _mk_new_fsitem( tgt_dir, entry.name )
+    registry = _hardlink_registry( run_id )
+    ( state, first ) = registry.claim( entry.inode,
+                                       os.path.join( relpath, entry.name ) )
+    if state == hardlink_registry.PENDING:
+        raise self.retry( countdown=min( 2 ** self.request.retries,
+                                         HARDLINK_MAX_WAIT ) )
+    with _log_summary( run, 'SYNCHARDLINK', src_dir, tgt_dir ) as summary:
+        if state == hardlink_registry.CLAIMED:
+            # later links need the target, not a tmp file
+            try:
+                synced = _sync_a_file( src, tgt, run, 'HARDLINK',
+                                       keeptmp=False, summary=summary )
+            except:
+                # ie: a soft time limit, the other links must not wait for
+                # the claim to go stale
+                registry.release( entry.inode )
+                raise
+            if synced:
+                registry.done( entry.inode, first )
+            else:
+                registry.release( entry.inode )
+            return
+        _link_to_first( src, tgt, os.path.join( run[ 'tgt_root' ], first ),
+                        summary )
+
+
+def _hardlink_registry( run_id ):
+    return hardlink_registry.Hardlink_Registry( rdb, run_id,
+        stale_secs=int( os.environ.get( 'PSYNCHARDTIMEOUT', 0 ) ) )
 
 
-def _sync_a_file( src, tgt, rsyncopts, ftype ):
+def _link_to_first( src, tgt, first_path, summary ):
+    """
+    Make tgt a hardlink to first_path (the first target link of the same
+    source inode), unless it already is
+    :param summary Log_Summary: see _log_summary
+    """
+    per_file = summary.per_file( str( src ) )
+    start = time.time()
+    if per_file:
+        logr.info( synctype = 'SYNCHARDLINK',
+                   msgtype  = 'start',
+                   src      = str( src ),
+                   tgt      = str( tgt ),
+                   size     = src.size,
+                   **summary.fields() )
+    action = 'None'
+    try:
+        tgt_st = copy_backend.lstat_or_none( tgt.absname )
+        if tgt_st is None \
+        or not os.path.samestat( tgt_st, os.lstat( first_path ) ):
+            copy_backend.replace_link( first_path, tgt.absname )
+            action = 'link'
+    except ( OSError ) as e:
+        logr.warning( synctype = 'SYNCHARDLINK',
+                      msgtype  = 'error',
+                      src      = str( src ),
+                      tgt      = str( tgt ),
+                      error    = 'OSError: {0}'.format( e ) )
+        summary.error()
+        return
+    summary.add( action, src.size, time.time() - start )
+    if per_file:
+        logr.info( synctype = 'SYNCHARDLINK',
+                   msgtype  = 'end',
+                   src      = str( src ),
+                   tgt      = str( tgt ),
+                   action   = action,
+                   **summary.fields() )
+
+
+def _log_summary( run, synctype, src_dir, tgt_dir ):
+    """
+    :return: Log_Summary for the file syncs of one task in dir src_dir,
+             per psyncopts[ 'file_log' ] and [ 'file_log_sample' ]
+    """
+    return log_summary.Log_Summary( logr, synctype, str( src_dir ),
+                                    str( tgt_dir ),
+                                    run[ 'psyncopts' ][ 'file_log' ],
+                                    run[ 'psyncopts' ][ 'file_log_sample' ] )
+
+
+def _sync_a_file( src, tgt, run, ftype, keeptmp=True, summary=None ):
     """
     Common code for syncing any file.  This function will be called by one of
     the sync_file or sync_hardlink Celery Task functions.
+    The copy backend is picked by the filesystem types of the src and tgt
+    mountpoints (see copy_backend).
     :param src FSItem: src file
     :param tgt FSItem: tgt file
-    :param rsyncopts dict: options passed to pylut.syncdir & pylut.syncfile
+    :param run dict: run options and paths (see run_registry)
     :param ftype string: file type that is being sync'd (ie: file or hardlink)
-    :return: None
+    :param keeptmp bool: leave the tmp file in the run's tmpdir
+    :param summary Log_Summary: (optional) where the sync is counted, its
+                                per_file() decides if start and end records
+                                are logged (default: always)
+    :return: True if tgt is in sync, False if the sync failed
     """
-    rsyncopts.update( tmpbase = os.path.join( tgt.mountpoint, psynctmpdir ),
-                      keeptmp = True,
+    # run is shared (cached), so add per call options to a copy
+    rsyncopts = dict( run[ 'rsyncopts' ],
+                      tmpbase = os.path.join( tgt.mountpoint, run[ 'tmpdir' ] ),
+                      keeptmp = keeptmp,
                     )
     synctype = 'SYNC' + ftype.upper()
-    logr.info( synctype = synctype,
-               msgtype  = 'start',
-               src      = str( src ),
-               tgt      = str( tgt ),
-               size     = src.size )
+    start = time.time()
+    if summary is None or summary.per_file( str( src ) ):
+        logr.info( synctype = synctype,
+                   msgtype  = 'start',
+                   src      = str( src ),
+                   tgt      = str( tgt ),
+                   size     = src.size,
+                   **( summary.fields() if summary else {} ) )
+    backend = copy_backend.for_mountpoints( src.mountpoint, tgt.mountpoint )
+    cache = _checksum_cache( run )
     try:
-        tmpfn, action_type = pylut.syncfile( src, tgt, **rsyncopts )
-    except ( pylut.PylutError ) as e:
+        tmpfn, action_type = backend.syncfile( src, tgt,
+            checksum=_inline_checksum( run ),
+            reread=run[ 'psyncopts' ][ 'verify_reread' ],
+            checksummer=cache.checksum,
+            **rsyncopts )
+    except ( copy_backend.Copy_Error ) as e:
         logr.warning( synctype = synctype,
                       msgtype  = 'error',
                       src      = str( src ),
                       tgt      = str( tgt ),
                       error    = str( e ) )
-        return
+        if summary is not None:
+            summary.error()
+        return False
+    _log_sync_end( synctype, src, tgt, rsyncopts, action_type, tmpfn.nlink,
+                   cache, summary, time.time() - start )
+    return True
+
+
+def _inline_checksum( run ):
+    """
+    :return: checksum algorithm for copy backends to hash copied data with
+             (see copy_backend.ALGORITHMS), None if no checksums are wanted
+    """
+    rsyncopts = run[ 'rsyncopts' ]
+    if rsyncopts[ 'post_checksums' ] or rsyncopts[ 'pre_checksums' ]:
+        return run[ 'psyncopts' ][ 'checksum_algo' ]
+    return None
+
+
+def _checksum_cache( run ):
+    """
+    :return: Checksum_Cache for the checksum algorithm of the run
+    """
+    return checksum_cache.Checksum_Cache( rdb, run[ 'psyncopts' ][ 'checksum_algo' ] )
+
+
+def _log_sync_end( synctype, src, tgt, rsyncopts, action_type, tmp_nlink,
+                   cache, summary=None, secs=0 ):
+    """
+    Log the end record of a file sync, with checksums as requested
+    Post checksums computed by the copy backend during the copy are used
+    as they are, otherwise both files are read again.  All checksums use
+    the algorithm of the run (cache.algo, see --checksum_algo), whatever the
+    copy backend.
+    Pre checksums come from cache, a target written by this sync is cached
+    with the checksum of the data written, so only the source is read.
+    The end record has the hit and miss counts of cache, for all
+    checksums of this sync.
+    :param action_type dict: as returned by the copy backend
+    :param tmp_nlink int: number of links of the tmp file
+    :param cache Checksum_Cache: checksums of the run
+    :param summary Log_Summary: (optional) count the sync in summary, the
+                                end record is only logged if
+                                summary.per_file(), a checksum mismatch is
+                                logged as a warning instead
+    :param secs float: duration of the sync, for summary
+    """
     msg_parts = {}
-    if tmpfn.nlink < 3 and rsyncopts[ 'pre_checksums' ]:
-        msg_parts.update( src_chksum = src.checksum(),
-                          tgt_chksum = tgt.checksum() )
+    if tmp_nlink < 3 and rsyncopts[ 'pre_checksums' ]:
+        if 'tgt_chksum' in action_type:
+            cache.put( tgt.absname, os.lstat( tgt.absname ),
+                       action_type[ 'tgt_chksum' ], written=True )
+        msg_parts.update( src_chksum = cache.checksum( src.absname ),
+                          tgt_chksum = cache.checksum( tgt.absname ) )
     sync_action = 'None'
     if action_type[ 'data_copy' ]:
         sync_action = 'data_copy'
         if rsyncopts[ 'post_checksums' ] and not rsyncopts[ 'pre_checksums' ]:
             # do post checksums only if pre_checksums haven't done it already
-            msg_parts.update( src_chksum = src.checksum(),
-                              tgt_chksum = tgt.checksum() )
+            if 'src_chksum' in action_type:
+                msg_parts.update( src_chksum = action_type[ 'src_chksum' ],
+                                  tgt_chksum = action_type[ 'tgt_chksum' ] )
+            else:
+                # the run's algorithm, not the one of FSItem.checksum
+                msg_parts.update(
+                    src_chksum = copy_backend.checksum( src.absname, cache.algo ),
+                    tgt_chksum = copy_backend.checksum( tgt.absname, cache.algo ) )
     elif action_type[ 'meta_update' ]:
         sync_action = 'meta_update'
+    if cache.hits or cache.misses:
+        msg_parts.update( chksum_hits = cache.hits,
+                          chksum_misses = cache.misses )
     msg_parts.update( synctype = synctype,
                       msgtype  = 'end',
                       src = str( src ),
                       tgt = str( tgt ),
                       action = str( sync_action ) )
+    if summary is not None:
+        summary.add( str( sync_action ), src.size, secs,
+                     cache.hits, cache.misses )
+        if not summary.per_file( str( src ) ):
+            if msg_parts.get( 'src_chksum' ) != msg_parts.get( 'tgt_chksum' ):
+                msg_parts.update( msgtype = 'error',
+                                  error   = 'Checksum mismatch' )
+                logr.warning( **msg_parts )
+            return
+        msg_parts.update( summary.fields() )
     logr.info( **msg_parts )
 
 
-def dir_scan( dirobj, psyncopts ):
+def _file_is_current( src, tgt, rsyncopts ):
+    """
+    Quick check (size, mtime, and perms / owner / group as requested) using
+    the stat data collected by dir_scan.
+    Hardlinks are never considered current, since a matching target says
+    nothing about whether it is linked to the rest of its link set.
+    :param src Entry: src file
+    :param tgt Entry: tgt file
+    :param rsyncopts dict: options passed to pylut.syncfile
+    :return: True if tgt already matches src, False otherwise
+    """
+    if src.nlink > 1:
+        return False
+    return dirscan.quick_check( src, tgt, rsyncopts )
+
+
+def dir_scan( dirobj, psyncopts, dirslice=None, stat_dirs=False ):
     """
-    Get directory contents
+    Get directory contents, sorted by name
+    Only regular files are stat'd (see dirscan.scan).  Listings too large to
+    sort in memory are sorted in runs spilled to temporary files, so memory
+    use is bounded regardless of directory size (see dirdiff.external_sort).
+    The whole directory is read before this function returns.
     :param dirobj FSItem: directory to scan
     :param psyncopts dict: options for adjusting psync behavior
-    :return: tuple of dicts ( dirs, files ) where keys=name and values=FSItem object
+    :param dirslice tuple: ( slice index, number of slices ), limit results to
+                           names in this slice, None means all names
+    :param stat_dirs bool: stat dirs too (see dirscan.scan)
+    :return: iterator over dirscan.Entry sorted by name, where ftype is
+             dirscan.DIR or dirscan.FILE (stat fields of DIR entries are 0
+             unless stat_dirs is set)
+    """
+    return dirdiff.external_sort(
+        _dir_entries( dirobj, psyncopts, dirslice, stat_dirs ) )
+
+
+def _dir_entries( dirobj, psyncopts, dirslice, stat_dirs ):
+    """
+    Generator over the dirs and files in dirobj, in directory order.
+    Entries that psync can't sync (too young, vanished, unknown type) are
+    logged and skipped.
+    Parameters and return values same as for dir_scan.
     """
-    dirs = {}
-    files = {}
     checkage = False
     if psyncopts[ 'minsecs' ] > 0:
         maxage = int( time.time() ) - psyncopts[ 'minsecs' ]
         checkage = True
-    # Unicode errors with scandir
-    # do Unicode errors go away with listdir?
-    for name in os.listdir( dirobj.absname ):
-        entry = _mk_new_fsitem( dirobj, name )
-        try:
-            if entry.is_dir():
-                dirs[ name ] = entry
-            elif entry.is_file():
-                if checkage and entry.ctime > maxage:
-                    logr.warning( synctype = 'dir_scan',
-                                  msgtype  = 'skipentry',
-                                  action   = 'InodeTooYoung',
-                                  src      = str( entry ) )
-                    continue
-                files[ name ] = entry
-            else:
+    for ( name, ftype, st ) in dirscan.scan( dirobj.absname, dirslice=dirslice,
+                                             stat_dirs=stat_dirs ):
+        if ftype == dirscan.DIR:
+            yield dirscan.Entry.from_stat( name, ftype, st )
+        elif ftype == dirscan.FILE:
+            if checkage and st.st_ctime > maxage:
                 logr.warning( synctype = 'dir_scan',
                               msgtype  = 'skipentry',
-                              action   = 'unknown file type',
-                              src      = str( entry ) )
-        except ( OSError ) as e:
-            # Any one of is_dir, is_file
-            # OSError: [Errno 2] No such file or directory
-            # have to ignore these, since no way to tell if FS is live or quiesced
-            if e.errno != 2:
-                raise e
+                              action   = 'InodeTooYoung',
+                              src      = os.path.join( dirobj.absname, name ) )
+                continue
+            yield dirscan.Entry.from_stat( name, ftype, st )
+        elif ftype == dirscan.VANISHED:
             logr.warning( 'Caught exception in psync.dir_scan',
                           synctype = 'dir_scan',
                           msgtype  = 'warning',
-                          action   = '{0}'.format( e ),
-                          src      = str( entry ) )
-    return ( dirs, files )
+                          action   = '{0}'.format( st ),
+                          src      = os.path.join( dirobj.absname, name ) )
+        else:
+            logr.warning( synctype = 'dir_scan',
+                          msgtype  = 'skipentry',
+                          action   = 'unknown file type',
+                          src      = os.path.join( dirobj.absname, name ) )
 
 
 def rm_file( path ):
@@ -295,10 +1102,11 @@ def rm_file( path ):
 
 
 def rm_dir( path, tmpbase ):
-    """ Move the directory out of the way to be deleted later
+    """ Move the directory out of the way to be deleted later (see purge_dir)
+    A random name is unique in tmpbase without asking the filesystem
+    (ie: for a Lustre FID).
     """
-    fid = pylut.path2fid( path )
-    tgt = os.path.join( tmpbase, fid )
+    tgt = os.path.join( tmpbase, uuid.uuid4().hex )
     logr.info( synctype = 'RMDIR',
                msgtype  = 'start',
                src      = path,
@@ -311,109 +1119,176 @@ def rm_dir( path, tmpbase ):
                tgt      = tgt )
 
 
-def file_sync( src, tgt, psyncopts, rsyncopts ):
+def file_sync( run_id, relpath, entry, publisher ):
     """
     Wrap details of file sync.
     Make tgt_path look identical to src_path.
-    :param src FSItem: src file
-    :param tgt FSItem: tgt file
-    :param psyncopts dict: options for adjusting psync behavior
-    :param rsyncopts dict: options passed to pylut.syncfile
+    :param run_id str: psync run (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entry Entry: src file (see dirscan.Entry)
+    :param publisher Task_Publisher: where to send the new task
     :return: None
     """
-    if src.nlink > 1:
-        sync_hardlink.apply_async( ( src, tgt, rsyncopts ) )
+    if entry.nlink > 1:
+        publisher.add( sync_hardlink, ( run_id, relpath, entry ) )
     else:
-        sync_file.apply_async( ( src, tgt, rsyncopts ) )
+        publisher.add( sync_file, ( run_id, relpath, entry ) )
 
 
-@app.task( base=Psync_Task )
-def schedule_final_dir_sync( secs=300 ):
+def files_sync( run_id, run, relpath, entries, publisher ):
     """
-    If all the regular syncs are done, enable all workers to start working on the
-    final sync_dir_meta tasks.
+    Sync many files, grouping small files into sync_file_batch tasks.
+    A batch is sent when it reaches psyncopts[ 'batch_count' ] files or
+    psyncopts[ 'batch_bytes' ] total size.  Hardlinks and files larger than
+    batch_bytes are always sent individually (see file_sync), files larger
+    than psyncopts[ 'chunk_threshold' ] are copied in chunks
+    (see sync_file_chunked).
+    :param run_id str: psync run (see run_registry)
+    :param run dict: run options and paths (see run_registry)
+    :param relpath str: parent dir, relative to the run's src and tgt roots
+    :param entries iterable: Entry for each src file (see dirscan.Entry)
+    :param publisher Task_Publisher: where to send new tasks
+    :return: None
     """
-    #TODO-get queue name from app.conf.CELERY_ROUTES
-    if dirs_and_files_are_done():
-        app.control.add_consumer( 'directories' )
-    else:
-        schedule_final_dir_sync.apply_async( args=( secs, ), countdown=secs )
-
-
-def dirs_and_files_are_done():
-    """
-    Return True if all dir and file sync actions are complete, False otherwise
-    """
-    rvparts = [ True ]
-    # Check queue lengths
-    qnames = [ app.conf.CELERY_DEFAULT_QUEUE ]
-    #    #TODO - get list of queues from CELERY_ROUTES
-    #    for x,y in app.conf.CELERY_ROUTES.iteritems():
-    #        q = y['queue']
-    #        if q != 'directories':
-    #            qnames.append( q )
-    qnames.extend( [ 'hardlinks' ] )
-    logr.info( 'qnames: {0}'.format( qnames ) )
-    total_len = sum( queue_lengths( qnames ) )
-    logr.info( 'total_len: {0}'.format( total_len ) )
-    if total_len != 0:
-        rvparts.append( False )
-    # Check for idle workers
-    taskcount = 0
-    for func in ( active_tasks, reserved_tasks ):
-        for name, count in func().iteritems():
-            if 'schedule_final_dir_sync' not in name:
-                taskcount += count
-    rvparts.append( taskcount == 0 )
-    return all( rvparts )
-
-
-def active_tasks():
-    """
-    Return count of active tasks by task name
-    :return dict: keys are task names, values are int (count of active tasks)
-    """
-    I = app.control.inspect()
-    data = {}
-    for w, tlist in I.active().iteritems():
-        for task in tlist:
-            name = task[ 'name' ]
-            if name not in data:
-                data[ name ] = 0
-            data[ name ] += 1
-    return data
-
-
-def reserved_tasks():
-    """
-    Return count of reserved tasks by task name
-    :return dict: keys are task names, values are int (count of active reserved)
-    """
-    I = app.control.inspect()
-    data = {}
-    for w, tlist in I.reserved().iteritems():
-        for task in tlist:
-            name = task[ 'name' ]
-            if name not in data:
-                data[ name ] = 0
-            data[ name ] += 1
-    return data
-
-
-def queue_lengths( qnames ):
-    """
-    Return lengths for each queue in qnames
-    :param qnames list of queue names
-    :return list: list of queue lengths, values match positions of queuenames in qnames
-    """
-    qlens = []
-    for q in qnames:
-        with app.connection_or_acquire() as conn:
-            qlens.append( 
-                conn.default_channel.queue_declare(
-                    queue=q, passive=True).message_count
-            )
-    return qlens
+    max_count = run[ 'psyncopts' ][ 'batch_count' ]
+    max_bytes = run[ 'psyncopts' ][ 'batch_bytes' ]
+    batch = []
+    batch_bytes = 0
+    chunk_threshold = run[ 'psyncopts' ][ 'chunk_threshold' ]
+    if not _can_chunk( run ):
+        chunk_threshold = 0
+    for entry in entries:
+        if 0 < chunk_threshold < entry.size and entry.nlink == 1:
+            publisher.add( sync_file_chunked, ( run_id, relpath, entry ) )
+            continue
+        if max_count < 2 or entry.nlink > 1 or entry.size > max_bytes:
+            file_sync( run_id, relpath, entry, publisher )
+            continue
+        batch.append( entry )
+        batch_bytes += entry.size
+        if len( batch ) >= max_count or batch_bytes >= max_bytes:
+            publisher.add( sync_file_batch, ( run_id, relpath, batch ) )
+            batch = []
+            batch_bytes = 0
+    if len( batch ) > 0:
+        publisher.add( sync_file_batch, ( run_id, relpath, batch ) )
+
+
+@app.task( base=Purge_Task )
+def purge_dir( run_id, relpath ):
+    """
+    Celery task, remove the contents of a dir below the root of a purge run
+    (the run's tmpdir or rmdir, see start_purge).
+    Subdirs are sent as purge_dir tasks and files in batches of
+    psyncopts[ 'batch_count' ] as purge_files tasks, the last batch is
+    removed by this task.  The directory itself is removed once everything
+    below it is (see purge_dir_done), so the tree is removed bottom-up and
+    in parallel.  The root of the run is emptied, not removed.
+    :param run_id str: purge run (see run_registry)
+    :param relpath str: dir, relative to the run's tgt root
+    :return: None
+    """
+    pending( run_id ).hold_dir( relpath )
+    run = runs.get( run_id )
+    path = os.path.join( run[ 'tgt_root' ], relpath )
+    logr.info( synctype = 'PURGEDIR',
+               msgtype  = 'start',
+               src      = path )
+    batch_count = run[ 'psyncopts' ][ 'batch_count' ]
+    names = []
+    with _publisher( run_id, relpath ) as publisher:
+        for ( name, ftype, st ) in dirscan.scan( path, stat_files=False ):
+            if ftype == dirscan.VANISHED:
+                continue
+            if ftype == dirscan.DIR:
+                publisher.add( purge_dir, ( run_id, os.path.join( relpath, name ) ) )
+                continue
+            names.append( name )
+            if len( names ) >= batch_count:
+                publisher.add( purge_files, ( run_id, relpath, names ) )
+                names = []
+    _purge_files( run, relpath, names )
+    logr.info( synctype = 'PURGEDIR',
+               msgtype  = 'end',
+               src      = path )
+
+
+@app.task( base=Purge_Task )
+def purge_files( run_id, relpath, names ):
+    """
+    Celery task, remove names (files, symlinks, etc.) from a dir of a
+    purge run
+    :param run_id str: purge run (see run_registry)
+    :param relpath str: dir, relative to the run's tgt root
+    :param names list: names of the non-directory entries to remove
+    :return: None
+    """
+    _purge_files( runs.get( run_id ), relpath, names )
+
+
+def _purge_files( run, relpath, names ):
+    """
+    Unlink names in relpath, no faster than psyncopts[ 'purge_rate' ] per
+    second.  Names that are already gone (ie: a redelivered task) are
+    skipped.
+    """
+    path = os.path.join( run[ 'tgt_root' ], relpath )
+    limit = throttle.Throttle( run[ 'psyncopts' ][ 'purge_rate' ] )
+    num_removed = 0
+    for name in names:
+        limit.wait()
+        try:
+            os.unlink( os.path.join( path, name ) )
+            num_removed += 1
+        except ( OSError ) as e:
+            if e.errno != errno.ENOENT:
+                logr.warning( synctype = 'PURGEFILE',
+                              msgtype  = 'error',
+                              src      = os.path.join( path, name ),
+                              error    = str( e ) )
+    logr.info( synctype    = 'PURGEFILES',
+               msgtype     = 'end',
+               src         = path,
+               num_removed = num_removed )
+
+
+def purge_dir_done( run_id, relpath ):
+    """
+    Everything below relpath is removed, remove relpath too, and so on up
+    the tree while it finishes parents.  The run is done when its root is.
+    :param run_id str: purge run (see run_registry)
+    :param relpath str: dir, relative to the run's tgt root
+    :return: None
+    """
+    run = runs.get( run_id )
+    while relpath != '':
+        path = os.path.join( run[ 'tgt_root' ], relpath )
+        try:
+            os.rmdir( path )
+        except ( OSError ) as e:
+            if e.errno != errno.ENOENT:
+                logr.warning( synctype = 'PURGEDIR',
+                              msgtype  = 'error',
+                              src      = path,
+                              error    = str( e ) )
+        relpath = os.path.dirname( relpath )
+        if pending( run_id ).release_dir( relpath ) != 0:
+            return
+    run_done( run_id )
+
+
+def run_done( run_id ):
+    """
+    Metadata of the run's root dir is set, all work of the run is done
+    :param run_id str: psync run (see run_registry)
+    :return: None
+    """
+    _hardlink_registry( run_id ).delete()
+    pending( run_id ).delete()
+    runs.done( run_id )
+    logr.info( synctype = 'RUN',
+               msgtype  = 'done',
+               run_id   = run_id )
 
 if __name__ == '__main__':
   raise UserWarning( "Cmdline invocation not supported" )
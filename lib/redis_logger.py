@@ -2,20 +2,172 @@ import redis_queue
 import time
 import functools
 import os
+import atexit
+import threading
+import logging
+import zlib
+import redis
 import cbor
+import log_spool
+import logschema
+
+# Records buffered before the flusher is woken up
+BUFFER_SIZE = 100
+
+# Max seconds a record waits in the buffer
+FLUSH_SECS = 1.0
+
+# Records buffered before logging calls flush themselves (and so wait for
+# redis), keeps memory bounded while redis is slow
+MAX_BUFFER = 100000
+
+# Seconds the flusher waits before trying again after a failed flush
+RETRY_SECS = 1.0
+
+# With a spool dir, a push that takes longer than SPOOL_SECS (the redis
+# socket timeout) fails and its records are spooled
+SPOOL_SECS = 5.0
+
+# Records replayed from the spool per pipeline, and pipelines per flush
+REPLAY_BATCH = 10000
+REPLAY_BATCHES = 10
+
+# Redis hash, records in the spool of each process ( '<host>:<pid>' )
+SPOOL_STATUS_KEY = 'psync_log_spool'
+
+logr = logging.getLogger( __name__ )
+
+# Severities (Redis_Logger.valid_names), one list each
+SEVERITIES = ( 'DEBUG', 'INFO', 'WARNING', 'ERROR' )
+
+
+def queue_name( base, sev, shard=0, shards=1 ):
+    """
+    :return: str, name of the redis list of severity sev, shard number shard
+             (ie: psync_log:INFO or, with shards, psync_log:INFO:3)
+    """
+    if shards > 1:
+        return '{0}:{1}:{2}'.format( base, sev, shard )
+    return '{0}:{1}'.format( base, sev )
+
+
+def log_queues( base, conns, shards=1 ):
+    """
+    Every queue records of base can be routed to
+    :param base str: queue_name given to Redis_Logger
+    :param conns list: redis.Redis connections the shards are spread over
+    :param shards int: queues per severity
+    :return: list of tuples ( severity, redis_queue.Redis_Queue )
+    """
+    return [ ( sev, redis_queue.Redis_Queue(
+                 queue_name( base, sev, i, shards ),
+                 conn=conns[ i % len( conns ) ] ) )
+             for sev in SEVERITIES for i in range( shards ) ]
+
 
 class Redis_Logger( object ):
+    """ Log records (CBOR encoded dicts) to redis lists, one per severity
+
+    Records are buffered in process and pushed by a background flusher
+    thread, with pipelined RPUSH, when BUFFER_SIZE records are buffered or
+    the oldest has waited FLUSH_SECS.  So logging calls do not wait for
+    redis, unless MAX_BUFFER records are waiting.
+    Records are not lost on a normal exit: flush() pushes the buffer
+    synchronously and is run at exit (atexit), and should be run wherever a
+    process ends without atexit (ie: celery worker_process_shutdown, see
+    psync).  A failed push puts the records back in the buffer, in order.
+    A forked child starts with an empty buffer (the parent flushes its own
+    records) and its own flusher.
+    Records go to the list of their severity (see queue_name), so readers
+    can sort them without decoding them.  With shards > 1 there are shards
+    lists per severity, spread over the redis servers in urls, and each
+    process pushes to one of them, picked by a hash of host and pid.
+    With a spool_dir, records that cannot be pushed (redis is down, or a
+    push takes longer than spool_secs) are appended to a local spool file
+    (see log_spool) instead, and so are all later records until the spool
+    is empty again, which keeps them in order.  The flusher replays the
+    spool to redis once pushes work again.  Logging calls then never wait
+    for redis and flush() does not raise.  The spool files of processes
+    that died are adopted by the next process on the host.  Records are
+    delivered at least once (a push that timed out may have reached redis).
+    The number of spooled records is spooled() and, while they are
+    replayed, the redis hash SPOOL_STATUS_KEY.
+    With compact, records are encoded in the compact format of logschema
+    (integer field codes, host ids, paths relative to the prefixes given to
+    add_prefixes).  New table entries are interned by the flusher, so
+    logging calls do not wait for redis for them either.
+    """
 
     valid_names = ( 'debug', 'info', 'warning', 'error', )
 
     def __init__( self, *a, **k ):
         """
-        Same args as for redis_queue.Redis_Queue()
+        Same args as for redis_queue.Redis_Queue(), queue_name is the base
+        name of the lists, plus the optional keyword args buffer_size,
+        flush_secs and max_buffer (default BUFFER_SIZE, FLUSH_SECS,
+        MAX_BUFFER), shards (lists per severity, default 1), urls (list
+        of redis urls to spread the shards over, default the one redis),
+        spool_dir (local dir for spool files, default None: no spooling),
+        spool_secs (default SPOOL_SECS) and compact (default False)
         """
+        self.buffer_size = k.pop( 'buffer_size', BUFFER_SIZE )
+        self.flush_secs = k.pop( 'flush_secs', FLUSH_SECS )
+        self.max_buffer = k.pop( 'max_buffer', MAX_BUFFER )
+        self.shards = max( k.pop( 'shards', 1 ), 1 )
+        urls = k.pop( 'urls', None )
+        self.spool_dir = k.pop( 'spool_dir', None )
+        spool_secs = k.pop( 'spool_secs', SPOOL_SECS )
+        compact = k.pop( 'compact', False )
+        conn_args = {}
+        if self.spool_dir:
+            conn_args = dict( socket_timeout=spool_secs,
+                              socket_connect_timeout=spool_secs )
+            k.update( conn_args )
         self.rq = redis_queue.Redis_Queue( *a, **k )
+        self.conns = [ self.rq.conn ]
+        if urls:
+            self.conns = [ redis.Redis.from_url( u, **conn_args )
+                           for u in urls ]
+        self.encoder = None
+        if compact:
+            self.encoder = logschema.Encoder( self.rq.conn,
+                                              self.rq.get_queue_name() )
+        self._routes = {}
+        self._pid = None
+        atexit.register( self.flush )
+
+    def add_prefixes( self, *paths ):
+        """
+        Log paths under paths relative to them (compact records only), once
+        the flusher interned them
+        """
+        if self.encoder and self.encoder.add_prefixes( *paths ):
+            self._start()
+            self._wakeup.set()
 
     def set_log_name( self, newname ):
         self.rq.set_queue_name( newname )
+        self._routes = {}
+
+    def queues( self ):
+        """
+        :return: list of tuples ( severity, redis_queue.Redis_Queue ), every
+                 list records can be pushed to (by any process)
+        """
+        return log_queues( self.rq.get_queue_name(), self.conns, self.shards )
+
+    def _route( self, sev ):
+        """
+        :return: redis_queue.Redis_Queue, where this process pushes records
+                 of severity sev
+        """
+        if sev not in self._routes:
+            shard = zlib.crc32( '{0}:{1}'.format(
+                os.uname()[1], os.getpid() ) ) % self.shards
+            self._routes[ sev ] = redis_queue.Redis_Queue(
+                queue_name( self.rq.get_queue_name(), sev, shard, self.shards ),
+                conn=self.conns[ shard % len( self.conns ) ] )
+        return self._routes[ sev ]
 
     def __getattr__( self, name ):
         """ Creates dynamic function named for typical logging actions
@@ -36,12 +188,160 @@ class Redis_Logger( object ):
 #        logstr = '{lvl} {ts} {hn} {msg}'.format( 
 #            lvl=loglvl.upper(), ts=ts, msg=msg, hn=hn )
 #        self.rq.qpush( [ logstr ] )
-        k.update( sev  = loglvl.upper(), 
+        sev = loglvl.upper()
+        k.update( sev  = sev, 
                   ts   = ts, 
                   host = hn, 
                   msg  = msg )
+        if self.encoder:
+            k = self.encoder.encode( k )
         logd = cbor.dumps( k )
-        self.rq.qpush( [ logd ] )
+        self._start()
+        with self._lock:
+            self._buffer.append( ( sev, logd ) )
+            num = len( self._buffer )
+        if num >= self.max_buffer and not self.spool_dir:
+            self.flush()
+        elif num >= self.buffer_size:
+            self._wakeup.set()
+
+    def _start( self ):
+        """
+        Set up the buffer and flusher thread, once per process
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._routes = {}
+        self._lock = threading.Lock()
+        # serializes pushes, so records reach redis in order
+        self._flush_lock = threading.Lock()
+        self._buffer = []
+        self._spool = None
+        self._retry_at = 0
+        if self.spool_dir and log_spool.orphans( self.spool_dir,
+                                                 self.rq.get_queue_name() ):
+            # leftovers of dead processes on this host
+            self._get_spool().adopt()
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread( target=self._flush_loop,
+                                          name='redis_logger_flusher' )
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_loop( self ):
+        while True:
+            self._wakeup.wait( self.flush_secs )
+            self._wakeup.clear()
+            try:
+                if self.encoder:
+                    self.encoder.intern_new()
+                self.flush()
+            except ( Exception ) as e:
+                time.sleep( RETRY_SECS )
+
+    def request_flush( self ):
+        """
+        Have the flusher push the buffer now, without waiting for it
+        (ie: at the end of a task)
+        """
+        if self._pid == os.getpid():
+            self._wakeup.set()
+
+    def pending( self ):
+        """
+        :return: int, number of records not pushed yet
+        """
+        if self._pid != os.getpid():
+            return 0
+        with self._lock:
+            return len( self._buffer )
+
+    def spooled( self ):
+        """
+        :return: int, number of records in the spool, waiting for redis
+        """
+        if self._pid != os.getpid() or self._spool is None:
+            return 0
+        return self._spool.pending()
+
+    def _get_spool( self ):
+        if self._spool is None:
+            self._spool = log_spool.Log_Spool( self.spool_dir,
+                                               self.rq.get_queue_name() )
+        return self._spool
+
+    def _push( self, records ):
+        """
+        Push records, one pipeline per severity
+        :param records list: tuples ( severity, CBOR encoded record )
+        :raises redis.RedisError: with attribute unpushed, the list of
+                                  records not pushed
+        """
+        by_sev = {}
+        for ( sev, logd ) in records:
+            by_sev.setdefault( sev, [] ).append( logd )
+        for sev in by_sev.keys():
+            try:
+                self._route( sev ).qpush_many( by_sev[ sev ] )
+            except ( Exception ) as e:
+                e.unpushed = [ r for r in records if r[0] in by_sev ]
+                raise
+            del by_sev[ sev ]
+
+    def _replay( self ):
+        """
+        Push spooled records back to redis, up to REPLAY_BATCHES batches
+        """
+        if time.time() < self._retry_at:
+            return
+        spool = self._spool
+        try:
+            for i in range( REPLAY_BATCHES ):
+                ( records, end ) = spool.read( REPLAY_BATCH )
+                if len( records ) < 1:
+                    break
+                self._push( records )
+                spool.ack( end, len( records ) )
+            status = '{0}:{1}'.format( os.uname()[1], os.getpid() )
+            if spool.pending() > 0:
+                self.rq.conn.hset( SPOOL_STATUS_KEY, status, spool.pending() )
+            else:
+                self.rq.conn.hdel( SPOOL_STATUS_KEY, status )
+                logr.warning( 'Log spool {0} replayed to redis'.format(
+                    spool.path ) )
+        except ( redis.RedisError ) as e:
+            self._retry_at = time.time() + RETRY_SECS
+
+    def flush( self ):
+        """
+        Push all buffered records, one pipeline per severity
+        :raises redis.RedisError: (without spool_dir) records not pushed yet
+                                  are kept for the next flush
+        """
+        if self._pid != os.getpid():
+            return
+        with self._flush_lock:
+            with self._lock:
+                ( records, self._buffer ) = ( self._buffer, [] )
+            if self._spool and self._spool.pending() > 0:
+                # behind the records spooled already
+                self._spool.write( [ logd for ( sev, logd ) in records ] )
+                self._replay()
+                return
+            try:
+                self._push( records )
+            except ( Exception ) as e:
+                unpushed = getattr( e, 'unpushed', records )
+                if not self.spool_dir or not isinstance( e, redis.RedisError ):
+                    with self._lock:
+                        self._buffer[ :0 ] = unpushed
+                    raise
+                spool = self._get_spool()
+                spool.write( [ logd for ( sev, logd ) in unpushed ] )
+                self._retry_at = time.time() + RETRY_SECS
+                logr.warning( 'Redis log push failed ({0}), spooling to '
+                              '{1}'.format( e, spool.path ) )
 
 if __name__ == '__main__':
     raise UserWarning( 'Cmdline not supported' )
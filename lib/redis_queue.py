@@ -1,5 +1,23 @@
 import redis
 
+# Suffix of the name of the inflight list of a queue (see qdrain)
+INFLIGHT_SUFFIX = ':inflight'
+
+# Atomically move up to ARGV[1] elements from the head of KEYS[1] to the
+# tail of KEYS[2] and return them (RPUSH in chunks, unpack() has a stack
+# limit)
+MOVE_SCRIPT = """
+local items = redis.call( 'LRANGE', KEYS[1], 0, tonumber( ARGV[1] ) - 1 )
+if #items > 0 then
+    redis.call( 'LTRIM', KEYS[1], #items, -1 )
+    for i = 1, #items, 1000 do
+        redis.call( 'RPUSH', KEYS[2],
+                    unpack( items, i, math.min( i + 999, #items ) ) )
+    end
+end
+return items
+"""
+
 class Redis_Queue( object ):
     """ Simplified access to a single Redis list
     """
@@ -11,13 +29,18 @@ class Redis_Queue( object ):
         Remaining args same as for redis.Redis() with the
         following exception:
 
-        Passing url= is equivalent to redis.Redis.from_url(...)
+        Passing url= is equivalent to redis.Redis.from_url(...), with the
+        remaining args
+        Passing conn= uses an existing redis.Redis connection
         """
-        if 'url' in k:
-            self.conn = redis.Redis.from_url( k[ 'url' ] )
+        if 'conn' in k:
+            self.conn = k[ 'conn' ]
+        elif 'url' in k:
+            self.conn = redis.Redis.from_url( k.pop( 'url' ), **k )
         else:
             self.conn = redis.Redis( **k )
         self.qname = queue_name
+        self._move = None
 
 
     @classmethod
@@ -43,19 +66,81 @@ class Redis_Queue( object ):
 
 
     def qpop( self, popcount=1 ):
-        element_list = self.conn.lrange( self.qname, 0, popcount - 1 )
-        self.conn.ltrim( self.qname, popcount, -1 )
+        """ Remove and return the first popcount elements, LRANGE and LTRIM
+            run as one MULTI/EXEC transaction, so concurrent pushes and pops
+            are not lost or returned twice
+        """
+        pipe = self.conn.pipeline()
+        pipe.lrange( self.qname, 0, popcount - 1 )
+        pipe.ltrim( self.qname, popcount, -1 )
+        ( element_list, trimmed ) = pipe.execute()
         return element_list
 
 
     def qpop_all( self ):
+        """ Remove and return all elements, in memory at once, see qdrain for
+            large queues
+        """
         size = self.qlen()
         return self.qpop( size )
 
 
+    def inflight_name( self ):
+        """ Name of the list holding the batch qdrain has handed out but that
+            is not acknowledged yet
+        """
+        return '{0}{1}'.format( self.qname, INFLIGHT_SUFFIX )
+
+
+    def qdrain( self, batch_size=1000, max_count=None ):
+        """ Generator, removes elements from the queue in batches of up to
+            batch_size and yields each batch (a list)
+
+        Each batch is moved atomically (one Lua script) from the queue to
+        the inflight list and only deleted from there (acknowledged) when
+        the next batch is requested, so the caller must have stored a batch
+        durably (ie: written and fsync'd) before asking for the next one.
+        A batch that was never acknowledged (the caller died or stopped
+        early) is yielded again, first, by the next qdrain, so elements are
+        delivered at least once.  Only one qdrain per queue at a time.
+        Memory use is bounded by batch_size, not by the queue length.
+        :param batch_size int: max elements per batch
+        :param max_count int: stop after about max_count elements (whole
+                              batches), default: until the queue is empty
+        """
+        inflight = self.inflight_name()
+        if self._move is None:
+            self._move = self.conn.register_script( MOVE_SCRIPT )
+        count = 0
+        batch = self.conn.lrange( inflight, 0, -1 )
+        while True:
+            if len( batch ) < 1:
+                batch = self._move( keys=[ self.qname, inflight ],
+                                    args=[ batch_size ] )
+                if len( batch ) < 1:
+                    return
+            yield batch
+            self.conn.delete( inflight )
+            count += len( batch )
+            if max_count is not None and count >= max_count:
+                return
+            batch = []
+
+
     def qpush( self, msglist ):
         self.conn.rpush( self.qname, *msglist )
 
 
+    def qpush_many( self, msglist, batch_size=1000 ):
+        """ Push msglist in one round trip, as pipelined RPUSHes of up to
+            batch_size messages (the pipeline is a MULTI/EXEC transaction,
+            so either all messages are pushed, in order, or none)
+        """
+        pipe = self.conn.pipeline()
+        for i in range( 0, len( msglist ), batch_size ):
+            pipe.rpush( self.qname, *msglist[ i:i + batch_size ] )
+        pipe.execute()
+
+
 if __name__ == '__main__':
     raise UserWarning( 'Command line not supported' )
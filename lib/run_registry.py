@@ -0,0 +1,173 @@
+import redis
+import time
+import uuid
+import cbor
+
+# Seconds a worker uses its cached copy of a run before fetching it again,
+# this is how long an option change (see update) takes to reach all workers
+CACHE_SECS = 30
+
+# Seconds a run is kept once it is done (for psync_status, psync_run_opts)
+DONE_SECS = 24 * 3600
+
+
+class Run_Registry( object ):
+    """ Options and paths of psync runs, stored in redis
+
+    A run is registered once (by start_psync) and tasks carry only the run id.
+    Each run is a redis hash 'psync_run:<run_id>' with fields:
+        psyncopts - cbor encoded dict, options for adjusting psync behavior
+        rsyncopts - cbor encoded dict, options passed to pylut.syncfile
+        tmpdir    - tmp dir, relative to the target mountpoint
+        rmdir     - rm dir, relative to the target mountpoint
+        src_root, src_mountpoint - top level source dir and its mountpoint
+        tgt_root, tgt_mountpoint - top level target dir and its mountpoint
+        created   - time the run was registered
+        version   - incremented on every update
+    Runs fetched with get() are cached in process memory for CACHE_SECS.
+    The hash of a run expires DONE_SECS after the run is done (see done).
+    """
+
+    key_prefix = 'psync_run:'
+
+    def __init__( self, **k ):
+        """
+        Same args as for redis.Redis() with the following exception:
+
+        Passing url= is equivalent to redis.Redis.from_url(...)
+        """
+        if 'url' in k:
+            self.conn = redis.Redis.from_url( k[ 'url' ] )
+        else:
+            self.conn = redis.Redis( **k )
+        self._cache = {}
+
+
+    @classmethod
+    def from_url( cls, url ):
+        return cls( url=url )
+
+
+    def _key( self, run_id ):
+        return '{0}{1}'.format( self.key_prefix, run_id )
+
+
+    def register( self, psyncopts, rsyncopts, tmpdir, rmdir,
+                  src_root, src_mountpoint, tgt_root, tgt_mountpoint ):
+        """
+        Create a new run
+        :param psyncopts dict: options for adjusting psync behavior
+        :param rsyncopts dict: options passed to pylut.syncdir & pylut.syncfile
+        :param tmpdir str: tmp dir, relative to the target mountpoint
+        :param rmdir str: rm dir, relative to the target mountpoint
+        :param src_root str: absolute path of the top level source dir
+        :param src_mountpoint str: mountpoint of src_root
+        :param tgt_root str: absolute path of the top level target dir
+        :param tgt_mountpoint str: mountpoint of tgt_root
+        :return: str, the new run id
+        """
+        run_id = uuid.uuid4().hex
+        self.conn.hmset( self._key( run_id ), {
+            'psyncopts':      cbor.dumps( psyncopts ),
+            'rsyncopts':      cbor.dumps( rsyncopts ),
+            'tmpdir':         tmpdir,
+            'rmdir':          rmdir,
+            'src_root':       src_root,
+            'src_mountpoint': src_mountpoint,
+            'tgt_root':       tgt_root,
+            'tgt_mountpoint': tgt_mountpoint,
+            'created':        int( time.time() ),
+            'version':        1,
+            } )
+        return run_id
+
+
+    def get( self, run_id, max_age=None ):
+        """
+        :param run_id str: run id from register()
+        :param max_age int: max seconds since a cached copy was fetched
+                            (default: CACHE_SECS)
+        :return: dict with keys psyncopts, rsyncopts, tmpdir, rmdir,
+                 src_root, src_mountpoint, tgt_root, tgt_mountpoint, created,
+                 version.  Callers must not modify it.
+        """
+        if max_age is None:
+            max_age = CACHE_SECS
+        now = time.time()
+        if run_id in self._cache:
+            ( fetched, run ) = self._cache[ run_id ]
+            if now - fetched < max_age:
+                return run
+        run = self.fetch( run_id )
+        self._cache[ run_id ] = ( now, run )
+        return run
+
+
+    def fetch( self, run_id ):
+        """
+        Same as get, but always read from redis (no cache)
+        """
+        data = self.conn.hgetall( self._key( run_id ) )
+        if len( data ) < 1:
+            raise UserWarning( "Unknown psync run '{0}'".format( run_id ) )
+        run = { 'psyncopts': cbor.loads( data[ 'psyncopts' ] ),
+                'rsyncopts': cbor.loads( data[ 'rsyncopts' ] ),
+                'created':   int( data[ 'created' ] ),
+                'version':   int( data[ 'version' ] ),
+              }
+        for k in ( 'tmpdir', 'rmdir', 'src_root', 'src_mountpoint',
+                   'tgt_root', 'tgt_mountpoint' ):
+            run[ k ] = data[ k ]
+        return run
+
+
+    def update( self, run_id, psyncopts=None, rsyncopts=None ):
+        """
+        Change options of an existing run, workers pick up the change within
+        CACHE_SECS.  Only the keys given are changed.
+        :param run_id str: run id from register()
+        :param psyncopts dict: psync options to change
+        :param rsyncopts dict: rsync options to change
+        :return: dict, the updated run (see get)
+        """
+        key = self._key( run_id )
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch( key )
+                    run = self.fetch( run_id )
+                    run[ 'psyncopts' ].update( psyncopts or {} )
+                    run[ 'rsyncopts' ].update( rsyncopts or {} )
+                    pipe.multi()
+                    pipe.hmset( key, {
+                        'psyncopts': cbor.dumps( run[ 'psyncopts' ] ),
+                        'rsyncopts': cbor.dumps( run[ 'rsyncopts' ] ),
+                        } )
+                    pipe.hincrby( key, 'version', 1 )
+                    pipe.execute()
+                    break
+                except ( redis.WatchError ) as e:
+                    continue
+        self._cache.pop( run_id, None )
+        return self.fetch( run_id )
+
+
+    def done( self, run_id ):
+        """
+        All work of the run is done, remove it after DONE_SECS
+        :param run_id str: run id from register()
+        """
+        self.conn.expire( self._key( run_id ), DONE_SECS )
+
+
+    def run_ids( self ):
+        """
+        :return: list of ids of all registered runs
+        """
+        n = len( self.key_prefix )
+        return [ k[ n: ] for k in
+                 self.conn.scan_iter( match=self.key_prefix + '*' ) ]
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,192 @@
+import sys
+import socket
+import collections
+
+# Number of messages held before they are published (and, if the broker
+# supports it, confirmed) as one batch
+BATCH_SIZE = 500
+
+# Max seconds to wait for the broker to confirm a batch
+CONFIRM_TIMEOUT = 60
+
+
+class Publish_Error( Exception ):
+    pass
+
+
+class Task_Publisher( object ):
+    """ Bulk enqueue of celery tasks
+
+    A single broker connection (from the app's connection pool) and a private
+    channel and producer are held for the life of the publisher, instead of
+    acquiring a producer for each apply_async.  Messages are buffered and
+    published back to back in batches of batch_size.  If the broker supports
+    publisher confirms (RabbitMQ), the private channel is put in confirm mode
+    and the confirms for a whole batch are collected at once, rather than
+    waiting for each message.
+
+    If a counter is given (see pending_counter), each batch is counted
+    (by task name) before it is published.  If publishing fails, the tasks
+    that were not sent (or were rejected by the broker) are uncounted again
+    before the error is raised.  Tasks whose confirms timed out stay counted,
+    the broker may have them.
+
+    Use as a context manager, so that the last (partial) batch is always
+    published:
+
+        with Task_Publisher( app ) as publisher:
+            publisher.add( task, args )
+    """
+
+    def __init__( self, app, batch_size=None, confirms=True, counter=None ):
+        """
+        :param app Celery: celery app used to acquire a connection
+        :param batch_size int: max messages buffered (default: BATCH_SIZE)
+        :param confirms bool: wait for publisher confirms, if supported
+        :param counter Pending_Counter: (optional) count tasks as pending
+        """
+        if batch_size is None:
+            batch_size = BATCH_SIZE
+        self.app = app
+        self.counter = counter
+        self.batch_size = max( batch_size, 1 )
+        self.pending = []
+        self.num_published = 0
+        # names of tasks whose queue was already declared on this channel
+        self._declared = set()
+        self.conn = app.pool.acquire( block=True )
+        try:
+            self.channel = self.conn.channel()
+            self.producer = app.amqp.TaskProducer( self.channel )
+            self.confirms = confirms and hasattr( self.channel, 'confirm_select' )
+            if self.confirms:
+                # delivery tag -> task name
+                self._unconfirmed = {}
+                # names of rejected tasks
+                self._nacked = []
+                self._next_tag = 0
+                self.channel.events[ 'basic_ack' ].add( self._on_ack )
+                self.channel.events[ 'basic_nack' ].add( self._on_nack )
+                self.channel.confirm_select()
+        except:
+            self.conn.release()
+            raise
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, exc_type, exc_value, tb ):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+
+    def add( self, task, args ):
+        """
+        Queue task( *args ), published once batch_size tasks are queued
+        :param task celery.Task: task to send
+        :param args tuple: task positional args
+        """
+        self.pending.append( ( task, args ) )
+        if len( self.pending ) >= self.batch_size:
+            self.flush()
+
+
+    def flush( self ):
+        """
+        Publish all queued tasks (and wait for their confirms)
+        """
+        if len( self.pending ) < 1:
+            return
+        batch = self.pending
+        self.pending = []
+        if self.counter is not None:
+            self.counter.incr(
+                collections.Counter( task.name for ( task, args ) in batch ) )
+        num_sent = 0
+        try:
+            for ( task, args ) in batch:
+                if task.name in self._declared:
+                    # queue is declared by the first publish only
+                    task.apply_async( args, producer=self.producer, declare=[] )
+                else:
+                    task.apply_async( args, producer=self.producer )
+                    self._declared.add( task.name )
+                num_sent += 1
+                if self.confirms:
+                    self._next_tag += 1
+                    self._unconfirmed[ self._next_tag ] = task.name
+            self.num_published += len( batch )
+            if self.confirms:
+                self._wait_for_confirms()
+        except:
+            exc_info = sys.exc_info()
+            unsent = [ task.name for ( task, args ) in batch[ num_sent: ] ]
+            if self.confirms:
+                unsent.extend( self._nacked )
+                self._nacked = []
+            self._uncount( unsent )
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+    def _uncount( self, names ):
+        """
+        Undo the counting of tasks that were not published
+        :param names list: task names
+        """
+        if self.counter is None or len( names ) < 1:
+            return
+        self.counter.incr( { name: -num for ( name, num )
+                             in collections.Counter( names ).iteritems() } )
+
+
+    def close( self ):
+        """
+        Release the connection, any unpublished tasks are discarded
+        """
+        if self.conn is None:
+            return
+        try:
+            self.channel.close()
+        finally:
+            self.conn.release()
+            self.conn = None
+
+
+    def _wait_for_confirms( self ):
+        try:
+            while len( self._unconfirmed ) > 0:
+                self.conn.drain_events( timeout=CONFIRM_TIMEOUT )
+        except ( socket.timeout ) as e:
+            raise Publish_Error( '{0} messages not confirmed after {1} secs'.format(
+                len( self._unconfirmed ), CONFIRM_TIMEOUT ) )
+        if len( self._nacked ) > 0:
+            raise Publish_Error( '{0} messages rejected by broker'.format(
+                len( self._nacked ) ) )
+
+
+    def _confirm( self, delivery_tag, multiple ):
+        """
+        :return: list of names of the tasks confirmed
+        """
+        if multiple:
+            tags = [ t for t in self._unconfirmed if t <= delivery_tag ]
+        else:
+            tags = [ delivery_tag ] if delivery_tag in self._unconfirmed else []
+        return [ self._unconfirmed.pop( t ) for t in tags ]
+
+
+    def _on_ack( self, delivery_tag, multiple ):
+        self._confirm( delivery_tag, multiple )
+
+
+    def _on_nack( self, delivery_tag, multiple, requeue ):
+        self._nacked.extend( self._confirm( delivery_tag, multiple ) )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,32 @@
+import time
+
+
+class Throttle( object ):
+    """ Limit the rate of some operation (ie: unlinks) in one process
+
+    Call wait() before each operation, it sleeps as needed to keep the
+    average rate at or below rate operations per second.
+    """
+
+    def __init__( self, rate ):
+        """
+        :param rate float: max operations per second, 0 for no limit
+        """
+        self.rate = rate
+        self.next_time = time.time()
+
+
+    def wait( self ):
+        if self.rate <= 0:
+            return
+        now = time.time()
+        if self.next_time > now:
+            time.sleep( self.next_time - now )
+        else:
+            # idle time does not add up to a burst later
+            self.next_time = now
+        self.next_time += 1.0 / self.rate
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
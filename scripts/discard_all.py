@@ -7,7 +7,7 @@ import psync
 # Otherwise, name the queues here
 import celery.bin.amqp
 amqp = celery.bin.amqp.amqp( app = psync.app )
-queuenames = [ 'celery', 'hardlinks', 'directories' ]
+queuenames = [ 'celery', 'purge' ]
 for q in queuenames:
     print( 'Queue: ' + q )
     print( amqp.run( 'queue.purge', q ) )
@@ -0,0 +1,94 @@
+#!/bin/env python
+
+import argparse
+import logging
+import os
+import signal
+import time
+import redis
+import redis_queue
+import redis_logger
+import log_collector
+import logschema
+
+
+def process_cmdline():
+    help_txt = """Collect the psync log records from redis continuously, into
+    per-severity segment files LOGBASE.<SEV>.<TIMESTAMP>.<SEQ>.cbor[.gz|.xz]
+    (ie: LOGBASE.INFO.20160712T101500.0001.cbor).  Segments are rotated by
+    size and age, the one being written has a '.part' suffix (the '.part'
+    segments of a collector that died are finished at start).  All severity
+    queues and shards are drained in parallel (see PSYNCLOGSHARDS and
+    PSYNCLOGURLS in config/bashrc), and the single queue of older psync
+    versions too.  Stop with
+    SIGTERM or SIGINT, the open segments are finished first.  The queue
+    length and drain rate are printed and published in redis (see
+    psync_status).
+    """
+    parser = argparse.ArgumentParser( epilog=help_txt )
+    parser.add_argument( 'logbase', metavar='LOGBASE' )
+    parser.add_argument( '--queue', '-q',
+        help='Redis log queue base name (default: %(default)s)' )
+    parser.add_argument( '--shards', type=int, metavar='N',
+        help='Queues per severity (default: PSYNCLOGSHARDS or 1)' )
+    parser.add_argument( '--urls', nargs='+', metavar='URL',
+        help='Redis servers the shards are on '
+             '(default: PSYNCLOGURLS or the psync redis)' )
+    parser.add_argument( '--compress', '-c',
+        choices=sorted( log_collector.COMPRESSORS ),
+        help='Compress segments (default: no compression)' )
+    parser.add_argument( '--max_bytes', type=int, metavar='N',
+        help='Rotate segments at N bytes (default: %(default)s)' )
+    parser.add_argument( '--max_secs', type=int, metavar='N',
+        help='Rotate segments after N seconds (default: %(default)s)' )
+    parser.add_argument( '--batch_size', type=int, metavar='N',
+        help='Remove up to N records from redis at a time, one fsync per '
+             'batch (default: %(default)s)' )
+    parser.add_argument( '--quiet', action='store_true',
+        help='Do not print the lag' )
+    default_options = {
+        'queue': 'psync_log',
+        'compress': None,
+        'max_bytes': log_collector.MAX_BYTES,
+        'max_secs': log_collector.MAX_SECS,
+        'batch_size': log_collector.BATCH_SIZE,
+        'quiet': False,
+        'shards': int( os.environ.get( 'PSYNCLOGSHARDS', 1 ) ),
+        'urls': os.environ.get( 'PSYNCLOGURLS', '' ).split(),
+    }
+    parser.set_defaults( **default_options )
+    return parser.parse_args()
+
+
+def report( data ):
+    print( '{ts} queued={qlen} rate={rate}/s eta={eta}s '
+           'collected={records}'.format( 
+               ts=time.strftime( '%Y-%m-%dT%H:%M:%S' ), **data ) )
+
+
+def run():
+    args = process_cmdline()
+    logging.basicConfig( level=logging.INFO,
+                         format='%(asctime)s %(levelname)s %(message)s' )
+    # Same redis as psync, without importing psync (and celery)
+    redisconf_fn = os.environ[ 'PSYNCREDISURLFILE' ]
+    redisconf_name = os.path.basename( redisconf_fn ).split( '.py' )[0]
+    redisconf = __import__( redisconf_name )
+    conn = redis.Redis.from_url( redisconf.BROKER_URL )
+    conns = [ redis.Redis.from_url( u ) for u in args.urls ] or [ conn ]
+    queues = redis_logger.log_queues( args.queue, conns, args.shards )
+    queues.append( ( None, redis_queue.Redis_Queue( args.queue, conn=conn ) ) )
+    collector = log_collector.Log_Collector( args.queue, queues, args.logbase,
+        batch_size  = args.batch_size,
+        max_bytes   = args.max_bytes,
+        max_secs    = args.max_secs,
+        compress    = args.compress,
+        status_conn = conn,
+        tables      = logschema.Tables( conn, args.queue ) )
+    for sig in ( signal.SIGTERM, signal.SIGINT ):
+        signal.signal( sig, lambda signum, frame: collector.stop() )
+    collector.run( None if args.quiet else report )
+
+
+if __name__ == '__main__':
+    run()
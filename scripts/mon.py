@@ -14,6 +14,14 @@ logging.basicConfig(
 )
 logr = logging.getLogger( __name__ )
 
+# Task names (without 'psync.') counted in each column of the report, rates
+# are tasks per second (a sync_file_batch or purge_files task counts once)
+DIR_TASKS = ( 'sync_dir', 'sync_dir_slice', 'sync_dir_meta_batch' )
+FILE_TASKS = ( 'sync_file', 'sync_file_batch', 'sync_hardlink',
+               'sync_file_chunked', 'sync_file_chunk', 'sync_file_chunked_done' )
+PURGE_TASKS = ( 'purge_dir', 'purge_files' )
+TASK_NAMES = DIR_TASKS + FILE_TASKS + PURGE_TASKS
+
 def process_cmdline():
     parser = argparse.ArgumentParser()
     parser.add_argument( '--filename', '-f', 
@@ -82,7 +90,8 @@ def update_worker_stats( db ):
             rate = 0
             elapsed = 0
             if prev_ts:
-                change = qty - prev[ worker ][ task ]
+                # a task may not have run on the worker before
+                change = qty - prev.get( worker, {} ).get( task, 0 )
                 elapsed = timestamp - prev_ts
                 rate = change * 1.0 / elapsed
             values.append( ( timestamp, worker, task, qty, change, elapsed, rate ) )
@@ -129,7 +138,7 @@ def get_iter_data( db, args ):
 #        # use last (earliest) timestamp to calc new value for args.seconds and 
 #        # proceed as normal using args.seconds
     report_rows = []
-    task_names = [ 'sync_dir', 'sync_file', 'sync_hardlink' ]
+    task_names = TASK_NAMES
     rates_by_taskname = { k:0 for k in task_names }
     # first and last, save qty's for calculating summary at the end
     first = { k:0 for k in task_names }
@@ -181,7 +190,7 @@ def get_totals( db ):
         min_ts = row[0]
         max_ts = row[1]
     stmt = 'SELECT * FROM stats WHERE timestamp IN (?,?) ORDER BY timestamp ASC'
-    task_names = [ 'sync_dir', 'sync_file', 'sync_hardlink' ]
+    task_names = TASK_NAMES
     raw_data = { min_ts: { k:0 for k in task_names },
                  max_ts: { k:0 for k in task_names } }
     for row in db.execute( stmt, ( min_ts, max_ts ) ):
@@ -200,20 +209,23 @@ def get_totals( db ):
 
 
 def print_report( rows, title=None ):
-    fmtstr = '{ts:19s}   {sync_dir:<10.1f}   {sync_file:<10.1f}   {sync_total:<10.1f}'
-    fmthdr =('{ts:19s}   {sync_dir:<10}' '   {sync_file:<10}' '   {sync_total:<10}' )
+    fmtstr = '{ts:19s}   {dir_rate:<10.1f}   {file_rate:<10.1f}   {purge_rate:<10.1f}   {total_rate:<10.1f}'
+    fmthdr =('{ts:19s}   {dir_rate:<10}' '   {file_rate:<10}' '   {purge_rate:<10}' '   {total_rate:<10}' )
     hdrs = { 'ts'        :'Timestamp', 
-             'sync_dir'  :'DirRate', 
-             'sync_file' :'FileRate', 
-             'sync_total':'TotalRate' }
+             'dir_rate'  :'DirRate', 
+             'file_rate' :'FileRate', 
+             'purge_rate':'PurgeRate', 
+             'total_rate':'TotalRate' }
     if title:
         print( title )
     print( fmthdr.format( **hdrs ) )
     for d in rows:
-        #combine sync_file and sync_hardlink counts
-        d[ 'sync_file' ] += d[ 'sync_hardlink' ]
+        #combine counts of the tasks of each column
+        d[ 'dir_rate' ] = sum( d[ t ] for t in DIR_TASKS )
+        d[ 'file_rate' ] = sum( d[ t ] for t in FILE_TASKS )
+        d[ 'purge_rate' ] = sum( d[ t ] for t in PURGE_TASKS )
         #create total count
-        d[ 'sync_total' ] = d[ 'sync_file' ] + d[ 'sync_dir' ]
+        d[ 'total_rate' ] = d[ 'dir_rate' ] + d[ 'file_rate' ] + d[ 'purge_rate' ]
         #convert timestamp to datetime
         d[ 'ts' ] = str( datetime.datetime.fromtimestamp( d[ 'ts' ] ) )
         print( fmtstr.format( **d ) )
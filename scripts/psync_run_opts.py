@@ -0,0 +1,86 @@
+from __future__ import print_function
+import psync
+import argparse
+import pprint
+import sys
+import time
+
+def process_cmdline():
+    help_txt = """
+    Without RUN_ID, list all registered runs.
+    Options can be changed while the run is active, workers pick up the change
+    within {0} seconds.
+    Example: --set pre_checksums=true --set batch_count=50
+    """.format( psync.run_registry.CACHE_SECS )
+    parser = argparse.ArgumentParser( epilog=help_txt )
+    parser.add_argument( 'run_id', metavar='RUN_ID', nargs='?' )
+    parser.add_argument( '--set', '-s', action='append', metavar='KEY=VALUE',
+        dest='settings', help='Change option KEY of the run. (can be repeated)' )
+    parser.set_defaults( settings=[] )
+    args = parser.parse_args()
+    if len( args.settings ) > 0 and args.run_id is None:
+        parser.error( 'RUN_ID is required with --set' )
+    return args
+
+
+def parse_value( val ):
+    """ Convert cmdline string to bool or int where possible
+    """
+    if val.lower() in ( 'true', 'yes' ):
+        return True
+    if val.lower() in ( 'false', 'no' ):
+        return False
+    try:
+        return int( val )
+    except ( ValueError ) as e:
+        return val
+
+
+def parse_settings( run, settings ):
+    """ Split KEY=VALUE settings into psyncopts and rsyncopts changes
+        A key found in both (ie: pre_checksums) is changed in both.
+    """
+    newopts = { 'psyncopts': {}, 'rsyncopts': {} }
+    for setting in settings:
+        ( key, sep, val ) = setting.partition( '=' )
+        if not sep:
+            sys.exit( "Invalid setting '{0}', expected KEY=VALUE".format( setting ) )
+        found = False
+        for optset in newopts:
+            if key in run[ optset ]:
+                newopts[ optset ][ key ] = parse_value( val )
+                found = True
+        if not found:
+            sys.exit( "Unknown option '{0}'".format( key ) )
+    return newopts
+
+
+def print_run( run_id, run ):
+    print( 'Run id:  {0}'.format( run_id ) )
+    print( 'Created: {0}'.format( time.ctime( run[ 'created' ] ) ) )
+    print( 'Version: {0}'.format( run[ 'version' ] ) )
+    print( 'Tmpdir:  {0}'.format( run[ 'tmpdir' ] ) )
+    print( 'Rmdir:   {0}'.format( run[ 'rmdir' ] ) )
+    print( 'Source:  {0}'.format( run[ 'src_root' ] ) )
+    print( 'Target:  {0}'.format( run[ 'tgt_root' ] ) )
+    for optset in ( 'psyncopts', 'rsyncopts' ):
+        print( '{0}:'.format( optset ) )
+        pprint.pprint( run[ optset ] )
+
+
+def run():
+    args = process_cmdline()
+    if args.run_id is None:
+        for run_id in psync.runs.run_ids():
+            print( '{0} {1}'.format(
+                run_id, time.ctime( psync.runs.fetch( run_id )[ 'created' ] ) ) )
+        return
+    run = psync.runs.fetch( args.run_id )
+    if len( args.settings ) > 0:
+        newopts = parse_settings( run, args.settings )
+        run = psync.runs.update( args.run_id, **newopts )
+    print_run( args.run_id, run )
+
+
+if __name__ == '__main__':
+    run()
@@ -1,8 +1,16 @@
 #!/bin/env python
 
+import os
+import time
 import psync
 import argparse
 import pprint
+import log_collector
+import redis_logger
+
+# Seconds added to the hard time limit before a task is taken for killed
+# (clocks of the workers may differ a bit)
+STUCK_GRACE_SECS = 300
 
 
 def inspect_workers():
@@ -38,7 +46,103 @@ def print_data( workers ):
     print( fmt.format( W='Totals:', A=total_active, V=total_reserved ) )
 
 
+def process_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'run_ids', metavar='RUN_ID', nargs='*',
+        help='Show pending task counts for these runs. (default: all runs)' )
+    parser.add_argument( '--workers', '-w', action='store_true',
+        help='Also show active and reserved tasks per worker. '
+             '(slow on large clusters, queries every worker)' )
+    hard_limit = os.environ.get( 'PSYNCHARDTIMEOUT' )
+    parser.add_argument( '--stuck_secs', type=int,
+        default=int( hard_limit ) + STUCK_GRACE_SECS if hard_limit else None,
+        help='Tasks running longer than this were killed (hard time limit, '
+             'lost worker process) and never return. '
+             '(default: PSYNCHARDTIMEOUT + {0} = %(default)s)'.format(
+                STUCK_GRACE_SECS ) )
+    parser.add_argument( '--release_stuck', action='store_true',
+        help='Release stuck tasks, so their directories (and the run) can '
+             'finish.  Stuck tasks are logged as errors.' )
+    args = parser.parse_args()
+    if args.release_stuck and args.stuck_secs is None:
+        parser.error( '--release_stuck needs --stuck_secs (or PSYNCHARDTIMEOUT)' )
+    return args
+
+
+def print_pending( run_ids, stuck_secs ):
+    """ Exact pending (enqueued or running) task counts per run, read from
+        the counters kept in redis
+    """
+    fmt = '{R:32} {N:16} {C:>10}'
+    print( fmt.format( R='Run', N='Task', C='Pending' ) )
+    for run_id in run_ids:
+        counter = psync.pending( run_id )
+        counts = counter.counts()
+        for name in sorted( counts ):
+            print( fmt.format( R=run_id, N=name, C=counts[ name ] ) )
+        # directories whose metadata is not set yet
+        print( fmt.format( R=run_id, N='(dirs)', C=counter.num_dirs() ) )
+        # killed tasks, counted until released (see --release_stuck)
+        if stuck_secs is not None:
+            print( fmt.format( R=run_id, N='(stuck)',
+                               C=len( counter.stuck( stuck_secs ) ) ) )
+    print( '' )
+
+
+def release_stuck( run_ids, stuck_secs ):
+    """ Release the tasks that were killed, see psync.release_stuck
+    """
+    fmt = '{R:32} {N:24} {S:24} {H}'
+    print( fmt.format( R='Run', N='Released task', S='Started', H='Worker' ) )
+    for run_id in run_ids:
+        for t in psync.release_stuck( run_id, stuck_secs ):
+            print( fmt.format( R=run_id, N=t[ 'name' ],
+                               S=time.ctime( t[ 'started' ] ),
+                               H='{0}:{1}'.format( t[ 'host' ], t[ 'pid' ] ) ) )
+    print( '' )
+
+
+def print_log_lag():
+    """ Log records waiting in redis, and how fast the log collectors (see
+        log_collector) are draining them
+    """
+    fmt = '{Q:16} {L:>10} {R:>10} {E:>10} {H}'
+    print( fmt.format( Q='Log queue', L='Queued', R='Rec/s', E='ETA secs',
+                       H='Collector' ) )
+    collectors = log_collector.collector_status( psync.rdb )
+    qname = psync.logr.rq.get_queue_name()
+    if qname not in collectors:
+        queues = psync.logr.queues() + [ ( None, psync.logr.rq ) ]
+        qlen = sum( rq.qlen() for ( sev, rq ) in queues )
+        print( fmt.format( Q=qname, L=qlen, R='-', E='-', H='(none)' ) )
+    for name in sorted( collectors ):
+        d = collectors[ name ]
+        print( fmt.format( Q=name, L=d.get( 'qlen' ), R=d.get( 'rate' ),
+                           E=d.get( 'eta' ),
+                           H='{0}:{1}'.format( d.get( 'host' ), d.get( 'pid' ) ) ) )
+    print( '' )
+    # records worker processes spooled while redis was unreachable, and
+    # are still replaying (see redis_logger)
+    spooled = psync.logr.rq.conn.hgetall( redis_logger.SPOOL_STATUS_KEY )
+    if spooled:
+        fmt = '{P:32} {N:>10}'
+        print( fmt.format( P='Spooling process', N='Spooled' ) )
+        for k in sorted( spooled ):
+            print( fmt.format( P=k, N=spooled[ k ] ) )
+        print( '' )
+
+
 def run():
+    args = process_cmdline()
+    run_ids = args.run_ids
+    if len( run_ids ) < 1:
+        run_ids = psync.runs.run_ids()
+    if args.release_stuck:
+        release_stuck( run_ids, args.stuck_secs )
+    print_pending( run_ids, args.stuck_secs )
+    print_log_lag()
+    if not args.workers:
+        return
     data = inspect_workers()
     if len( data ) > 0:
         print_data( data )
@@ -8,6 +8,8 @@ import argparse
 import os
 import stat
 import fsitem
+import copy_backend
+import log_summary
 
 def process_cmdline():
     help_txt = """Note: TGT must already exist.
@@ -34,6 +36,47 @@ def process_cmdline():
              'Normally, only size and mtime are used to determine if the source '
              'file has changed.'
         )
+    pgroup.add_argument( '--batch_count', type=int, metavar='N',
+        help='Send small files to workers in batches of up to N files. '
+             'Use 1 to disable batching. (default: %(default)s)'
+        )
+    pgroup.add_argument( '--batch_bytes', type=int, metavar='N',
+        help='Limit the total size of a batch of small files to N bytes. '
+             'Files larger than N are always sent individually. '
+             '(default: %(default)s)'
+        )
+    pgroup.add_argument( '--slice_entries', type=int, metavar='N',
+        help='Split directories with more than N entries into slices that '
+             'are synced in parallel. Use 0 to disable. (default: %(default)s)'
+        )
+    pgroup.add_argument( '--chunk_threshold', type=int, metavar='N',
+        help='Copy files larger than N bytes in chunks, spread over many '
+             'workers (not Lustre to Lustre, where files are copied whole '
+             'to keep their stripe layout). Use 0 to disable. '
+             '(default: %(default)s)'
+        )
+    pgroup.add_argument( '--chunk_bytes', type=int, metavar='N',
+        help='Size of a chunk of a chunked file copy. (default: %(default)s)'
+        )
+    pgroup.add_argument( '--checksum_algo', choices=sorted( copy_backend.ALGORITHMS ),
+        help='Checksum algorithm for pre and post checksums. Post checksums '
+             'are computed while files are copied (pylut, used on Lustre, '
+             'reads the files again). (default: %(default)s)'
+        )
+    pgroup.add_argument( '--verify_reread', action='store_true',
+        help='Compute the target checksum by reading the target back after '
+             'the copy, instead of from the data written. (default: %(default)s)'
+        )
+    pgroup.add_argument( '--file_log', choices=log_summary.MODES,
+        help="Log records for file syncs: 'all' logs a start and end record "
+             "per file, 'summary' logs one summary record (counts, bytes, "
+             "durations) per directory and task instead. Warnings and errors "
+             "are always logged. (default: %(default)s)"
+        )
+    pgroup.add_argument( '--file_log_sample', type=int, metavar='N',
+        help="With --file_log summary, also log the records of 1 in N "
+             "files. Use 0 for none. (default: %(default)s)"
+        )
     rgroup = parser.add_argument_group( title='Rsync options' )
     rgroup.add_argument( '--syncowner', '-o', action='store_true',
         help='Sync file owner (default: %(default)s).'
@@ -55,6 +98,15 @@ def process_cmdline():
         'pre_checksums': False,
         'post_checksums': True,
         'minsecs': 0,
+        'batch_count': 100,
+        'batch_bytes': 67108864,
+        'slice_entries': 500000,
+        'chunk_threshold': 17179869184,
+        'chunk_bytes': 1073741824,
+        'checksum_algo': 'md5',
+        'verify_reread': False,
+        'file_log': 'all',
+        'file_log_sample': 0,
     }
     parser.set_defaults( **default_options )
     args = parser.parse_args()
@@ -87,15 +139,28 @@ def run():
                 var, dn ) )
 
     psyncopts = {}
-    for k in ( 'minsecs', 'pre_checksums' ):
+    for k in ( 'minsecs', 'pre_checksums', 'batch_count', 'batch_bytes',
+               'slice_entries', 'chunk_threshold', 'chunk_bytes',
+               'checksum_algo', 'verify_reread', 'file_log',
+               'file_log_sample' ):
         psyncopts[ k ] = getattr( args, k )
     rsyncopts = {}
     for k in ( 'syncowner', 'syncgroup', 'syncperms', 'synctimes', 
                'pre_checksums', 'post_checksums' ):
         rsyncopts[ k ] = getattr( args, k )
-    # Seed the process
-    psync.sync_dir.apply_async( ( src, tgt, psyncopts, rsyncopts ) )
-    psync.schedule_final_dir_sync.apply_async( args=( 300, ), countdown=300 )
+    # Register the run, tasks carry only the run id and paths relative to
+    # src and tgt
+    run_id = psync.runs.register( psyncopts, rsyncopts,
+                                  tmpdir=os.environ[ 'PSYNCTMPDIR' ],
+                                  rmdir=os.environ[ 'PSYNCRMDIR' ],
+                                  src_root=src.absname,
+                                  src_mountpoint=src.mountpoint,
+                                  tgt_root=tgt.absname,
+                                  tgt_mountpoint=tgt.mountpoint )
+    print( 'Run id: {0}'.format( run_id ) )
+    # Seed the process, the run is done (RUN done is logged) when the
+    # metadata of the top level dir is set, see psync.run_done
+    psync.apply_counted( psync.sync_dir, ( run_id, '' ) )
 
 if __name__ == '__main__':
     run()
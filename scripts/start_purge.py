@@ -0,0 +1,86 @@
+#!/bin/env python
+
+import psync
+import argparse
+import os
+import fsitem
+
+
+def process_cmdline():
+    help_txt = """Remove the contents of PSYNCRMDIR (and with --tmpdir, of
+    PSYNCTMPDIR) on the filesystem holding TGT, using the psync workers.
+    Purge tasks go to the 'purge' queue, which is only read by purger
+    workers (see 'psyncd start_purger'), so the purge runs next to active
+    syncs without taking over the worker pool.
+    """
+    parser = argparse.ArgumentParser( epilog=help_txt )
+    parser.add_argument( 'tgt_dir', metavar='TGT' )
+    parser.add_argument( '--tmpdir', action='store_true',
+        help='Also purge PSYNCTMPDIR. Refused while a sync run to the same '
+             'filesystem has pending work, since hardlinks are made from '
+             'the files in it. (default: %(default)s)'
+        )
+    parser.add_argument( '--force', action='store_true',
+        help='Purge PSYNCTMPDIR even if sync runs have pending work.'
+        )
+    parser.add_argument( '--batch_count', type=int, metavar='N',
+        help='Remove files in batches of up to N files per task. '
+             '(default: %(default)s)'
+        )
+    parser.add_argument( '--purge_rate', type=int, metavar='N',
+        help='Max files removed per second by each task, 0 for no limit. '
+             'Can be changed while the purge runs (see psync_run_opts). '
+             '(default: %(default)s)'
+        )
+    default_options = {
+        'tmpdir': False,
+        'force': False,
+        'batch_count': 1000,
+        'purge_rate': 1000,
+    }
+    parser.set_defaults( **default_options )
+    return parser.parse_args()
+
+
+def active_syncs( mountpoint ):
+    """
+    :return: list of ids of sync runs to mountpoint with pending work
+    """
+    active = []
+    for run_id in psync.runs.run_ids():
+        run = psync.runs.fetch( run_id )
+        if run[ 'tgt_mountpoint' ] != mountpoint \
+        or run[ 'psyncopts' ].get( 'purge' ):
+            continue
+        if psync.pending( run_id ).counts().get( 'work', 0 ) > 0:
+            active.append( run_id )
+    return active
+
+
+def run():
+    args = process_cmdline()
+    tgt = fsitem.FSItem( args.tgt_dir )
+    roots = [ os.environ[ 'PSYNCRMDIR' ] ]
+    if args.tmpdir:
+        active = active_syncs( tgt.mountpoint )
+        if len( active ) > 0 and not args.force:
+            raise UserWarning( 'Sync runs with pending work: {0}'.format(
+                ', '.join( active ) ) )
+        roots.append( os.environ[ 'PSYNCTMPDIR' ] )
+    psyncopts = { 'purge': True,
+                  'batch_count': args.batch_count,
+                  'purge_rate': args.purge_rate }
+    for leaf in roots:
+        root = os.path.join( tgt.mountpoint, leaf )
+        run_id = psync.runs.register( psyncopts, {},
+                                      tmpdir=os.environ[ 'PSYNCTMPDIR' ],
+                                      rmdir=os.environ[ 'PSYNCRMDIR' ],
+                                      src_root=root,
+                                      src_mountpoint=tgt.mountpoint,
+                                      tgt_root=root,
+                                      tgt_mountpoint=tgt.mountpoint )
+        print( 'Run id: {0} ({1})'.format( run_id, root ) )
+        psync.apply_counted( psync.purge_dir, ( run_id, '' ) )
+
+if __name__ == '__main__':
+    run()
@@ -2,6 +2,7 @@ import psync
 import argparse
 import os
 import cbor
+import logschema
 
 
 parser = argparse.ArgumentParser( 
@@ -13,38 +14,81 @@ parser.add_argument( '--delete', '-d', action='store_true',
 parser.add_argument( '--logbase', '-l',
     help="""Write logs to LOGBASE.<TYPE> where <TYPE> is
     the log type (ie: INFO, WARNING, ERROR, etc).  Implies --delete.""" )
+parser.add_argument( '--batch_size', '-b', type=int,
+    help="""With --delete, remove messages from redis in batches of
+    BATCH_SIZE, each batch is written (and fsync'd) to the log files before
+    it is removed for good (default: %(default)s)""" )
 parser.set_defaults( 
     verbose=False,
-    delete=False
+    delete=False,
+    batch_size=1000
 )
 args = parser.parse_args()
 if args.logbase:
     args.delete = True
 
-rq = psync.logr.rq
+# Per severity queues (and shards), plus the single queue older versions
+# logged to, whose records are decoded for their severity
+queues = psync.logr.queues() + [ ( None, psync.logr.rq ) ]
 msg_count = 0
+logmsgs = dict( DEBUG=[], INFO=[], WARNING=[], ERROR=[] )
+logfiles = {}
+# Tables of compact records, written ahead of the records that use them
+tables = logschema.Tables( psync.logr.rq.conn, psync.logr.rq.get_queue_name() )
+tables_written = {}
+decoder = logschema.Decoder()
 
-# How to get logs
-func = rq.qlist
-if args.delete:
-    func = rq.qpop_all
 
-# Get logs
-logmsgs = dict( DEBUG=[], INFO=[], WARNING=[], ERROR=[] )
-for m in func():
-    msgdict = cbor.loads( m )
-    logmsgs[ msgdict[ 'sev' ] ].append( m )
-    if args.verbose:
-        print( msgdict )
-
-# Process logs
-for k, msglist in logmsgs.iteritems():
-    size = len( msglist )
-    if size > 0 and args.logbase:
-        fn = '{0}.{1}'.format( args.logbase, k )
-        with open( fn, 'ab' ) as f:
+def get_logfile( sev ):
+    if sev not in logfiles:
+        fn = '{0}.{1}'.format( args.logbase, sev )
+        logfiles[ sev ] = open( fn, 'ab' )
+    return logfiles[ sev ]
+
+
+def process_batch( sev, msglist ):
+    """ Sort msglist by severity, append to the log files (if --logbase) and
+        make sure they are on disk before the batch is acknowledged
+    """
+    for k in logmsgs:
+        logmsgs[ k ] = []
+    if sev and not args.verbose:
+        # already sorted, no need to decode
+        logmsgs[ sev ] = msglist
+    else:
+        if args.verbose:
+            decoder.decode( logschema.table_record( *tables.current() ) )
+        for m in msglist:
+            msgdict = cbor.loads( m )
+            logmsgs[ logschema.severity( msgdict ) ].append( m )
+            if args.verbose:
+                print( decoder.decode( msgdict ) )
+    if not args.logbase:
+        return
+    for k, msglist in logmsgs.iteritems():
+        if len( msglist ) > 0:
+            f = get_logfile( k )
+            head = tables.new_entries( tables_written.setdefault( k, {} ) )
+            if head:
+                f.write( head )
             f.writelines( msglist )
-    msg_count += size
+            f.flush()
+            os.fsync( f.fileno() )
+
+
+# Get logs
+for ( sev, rq ) in queues:
+    if args.delete:
+        # only what is queued now, so a busy queue does not keep us here
+        for batch in rq.qdrain( args.batch_size, max_count=rq.qlen() ):
+            process_batch( sev, batch )
+            msg_count += len( batch )
+    else:
+        batch = rq.qlist()
+        process_batch( sev, batch )
+        msg_count += len( batch )
+for f in logfiles.itervalues():
+    f.close()
 
 # Print summary information
 action = 'Retrieved'
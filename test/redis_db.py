@@ -0,0 +1,16 @@
+import os
+import pytest
+import redis
+
+# Redis for the tests that need one, a scratch db (it is flushed)
+URL = os.environ.get( 'PSYNCTESTREDISURL', 'redis://localhost:6379/15' )
+
+
+@pytest.fixture
+def rdb():
+    conn = redis.Redis.from_url( URL )
+    try:
+        conn.flushdb()
+    except ( redis.ConnectionError ) as e:
+        pytest.skip( 'No redis at {0}'.format( URL ) )
+    return conn
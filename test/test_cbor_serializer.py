@@ -0,0 +1,18 @@
+import kombu.serialization
+import cbor_serializer
+import dirscan
+
+
+def test_roundtrip_task_args():
+    cbor_serializer.register()
+    entry = dirscan.Entry( 'bad\xffname', dirscan.FILE,
+                           10, 1400000000, 0o100644, 1000, 1000, 1, 42 )
+    args = ( 'run1', 'a/b', [ entry ] )
+    ( ctype, cenc, data ) = kombu.serialization.dumps(
+        { 'args': args }, serializer=cbor_serializer.NAME )
+    assert ctype == cbor_serializer.CONTENT_TYPE
+    body = kombu.serialization.loads( data, ctype, cenc,
+                                      accept=[ cbor_serializer.CONTENT_TYPE ] )
+    ( run_id, relpath, entries ) = body[ 'args' ]
+    assert ( run_id, relpath ) == ( 'run1', 'a/b' )
+    assert dirscan.Entry._make( entries[0] ) == entry
@@ -0,0 +1,62 @@
+import os
+import copy_backend
+import checksum_cache
+from redis_db import rdb
+
+
+def test_pack_unpack( tmpdir ):
+    f = tmpdir.join( 'f' )
+    f.write( 'some data' )
+    st = os.lstat( str( f ) )
+    digest = copy_backend.checksum( str( f ) )
+    value = checksum_cache.pack( st, digest )
+    assert checksum_cache.unpack( value, st ) == digest
+    assert checksum_cache.unpack( None, st ) is None
+    # any change of the identity invalidates the cached digest
+    f.write( 'other data' )
+    os.utime( str( f ), ( st.st_atime, st.st_mtime ) )
+    assert checksum_cache.unpack( value, os.lstat( str( f ) ) ) is None
+
+
+def _file( tmpdir, data ):
+    f = tmpdir.join( 'f' )
+    f.write( data )
+    return str( f )
+
+
+def test_checksum_hit_and_miss( rdb, tmpdir, monkeypatch ):
+    monkeypatch.setattr( checksum_cache, 'RACY_SECS', 0 )
+    path = _file( tmpdir, 'some data' )
+    cache = checksum_cache.Checksum_Cache( rdb )
+    digest = copy_backend.checksum( path )
+    assert cache.checksum( path ) == digest
+    assert ( cache.hits, cache.misses ) == ( 0, 1 )
+    assert cache.get( path, os.lstat( path ) ) == digest
+    assert cache.checksum( path ) == digest
+    assert ( cache.hits, cache.misses ) == ( 1, 1 )
+    # a changed file misses
+    tmpdir.join( 'f' ).write( 'other data' )
+    assert cache.checksum( path ) == copy_backend.checksum( path )
+    assert ( cache.hits, cache.misses ) == ( 1, 2 )
+
+
+def test_put_racy_file( rdb, tmpdir ):
+    path = _file( tmpdir, 'some data' )
+    st = os.lstat( path )
+    digest = copy_backend.checksum( path )
+    cache = checksum_cache.Checksum_Cache( rdb )
+    # just changed, not cached unless the caller wrote the data itself
+    cache.put( path, st, digest )
+    assert cache.get( path, st ) is None
+    cache.put( path, st, digest, written=True )
+    assert cache.get( path, st ) == digest
+
+
+def test_unknown_mountpoint_is_not_cached( rdb, tmpdir, monkeypatch ):
+    monkeypatch.setattr( checksum_cache, '_mount_table', {} )
+    path = _file( tmpdir, 'some data' )
+    st = os.lstat( path )
+    cache = checksum_cache.Checksum_Cache( rdb )
+    cache.put( path, st, copy_backend.checksum( path ), written=True )
+    assert cache.get( path, st ) is None
+    assert rdb.keys( cache.key_prefix + '*' ) == []
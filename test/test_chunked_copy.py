@@ -0,0 +1,78 @@
+import os
+import stat
+import hashlib
+import pytest
+import chunked_copy
+import copy_backend
+import dirscan
+
+OPTS = dict( synctimes=True, syncperms=True, syncowner=False, syncgroup=False )
+
+
+def _src( tmpdir, data ):
+    src = tmpdir.join( 'src' )
+    src.write( data, mode='wb' )
+    os.utime( str( src ), ( 1000000000, 1000000000 ) )
+    entry = dirscan.Entry.from_stat( 'src', dirscan.FILE, os.lstat( str( src ) ) )
+    return ( src, entry )
+
+
+def test_chunk_ranges():
+    assert chunked_copy.chunk_ranges( 10, 4 ) == [ ( 0, 4 ), ( 4, 4 ), ( 8, 2 ) ]
+    assert chunked_copy.chunk_ranges( 8, 4 ) == [ ( 0, 4 ), ( 4, 4 ) ]
+
+
+def test_chunks_in_any_order( tmpdir ):
+    data = os.urandom( 100000 )
+    ( src, entry ) = _src( tmpdir, data )
+    tmp = str( tmpdir.join( 'tmp' ) )
+    tgt = str( tmpdir.join( 'tgt' ) )
+    chunked_copy.create( tmp, entry.size )
+    assert os.path.getsize( tmp ) == entry.size
+    for ( offset, length ) in reversed( chunked_copy.chunk_ranges( entry.size, 30000 ) ):
+        checksums = chunked_copy.copy_chunk( str( src ), tmp, offset, length,
+                                             checksum='md5', reread=True )
+        expected = hashlib.md5( data[ offset:offset + length ] ).hexdigest()
+        assert checksums == ( expected, expected )
+    action_type = chunked_copy.finish( str( src ), tmp, tgt, entry, OPTS )
+    assert action_type == { 'data_copy': True, 'meta_update': False }
+    assert open( tgt, 'rb' ).read() == data
+    assert os.lstat( tgt ).st_mtime == 1000000000
+    assert not os.path.exists( tmp )
+
+
+def test_short_chunk_fails( tmpdir ):
+    ( src, entry ) = _src( tmpdir, 'x' * 10 )
+    tmp = str( tmpdir.join( 'tmp' ) )
+    chunked_copy.create( tmp, 20 )
+    with pytest.raises( IOError ):
+        chunked_copy.copy_chunk( str( src ), tmp, 5, 10 )
+
+
+def test_finish_detects_changed_source( tmpdir ):
+    ( src, entry ) = _src( tmpdir, 'x' * 10 )
+    tmp = str( tmpdir.join( 'tmp' ) )
+    chunked_copy.create( tmp, entry.size )
+    chunked_copy.copy_chunk( str( src ), tmp, 0, entry.size )
+    src.write( 'y' * 11 )
+    with pytest.raises( copy_backend.Copy_Error ):
+        chunked_copy.finish( str( src ), tmp, str( tmpdir.join( 'tgt' ) ),
+                             entry, OPTS )
+
+
+def test_finish_without_syncperms_sets_mode( tmpdir ):
+    ( src, entry ) = _src( tmpdir, 'x' * 10 )
+    src.chmod( 0o644 )
+    tmp = str( tmpdir.join( 'tmp' ) )
+    tgt = str( tmpdir.join( 'tgt' ) )
+    chunked_copy.create( tmp, entry.size )
+    chunked_copy.copy_chunk( str( src ), tmp, 0, entry.size )
+    umask = os.umask( 0o022 )
+    try:
+        copy_backend._umask = None
+        chunked_copy.finish( str( src ), tmp, tgt, entry,
+                             dict( OPTS, syncperms=False ) )
+    finally:
+        os.umask( umask )
+        copy_backend._umask = None
+    assert stat.S_IMODE( os.lstat( tgt ).st_mode ) == 0o644
@@ -0,0 +1,109 @@
+import os
+import stat
+import hashlib
+import pytest
+import copy_backend
+
+OPTS = dict( synctimes=True, syncperms=True, syncowner=True, syncgroup=True,
+             keeptmp=True )
+
+
+def _setup( tmpdir, data='x' * 100000 ):
+    src = tmpdir.join( 'src' )
+    src.write( data )
+    src.chmod( 0o640 )
+    os.utime( str( src ), ( 1000000000, 1000000000 ) )
+    tmpbase = tmpdir.mkdir( 'tmp' )
+    return ( src, tmpdir.join( 'tgt' ), str( tmpbase ) )
+
+
+@pytest.mark.parametrize( 'method', list( copy_backend.METHODS ) )
+def test_native_copies_data_and_meta( tmpdir, method ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir )
+    backend = copy_backend.Native_Copy( methods=[ method ] )
+    ( tmpfn, action_type ) = backend.syncfile( src, tgt, tmpbase, **OPTS )
+    assert action_type == { 'data_copy': True, 'meta_update': True }
+    assert tgt.read() == src.read()
+    st = os.lstat( str( tgt ) )
+    assert stat.S_IMODE( st.st_mode ) == 0o640
+    assert st.st_mtime == 1000000000
+    # tgt is a hardlink of the kept tmp file, no partial files are left
+    assert tmpfn.nlink == 2
+    assert os.listdir( tmpbase ) == [ os.path.basename( tmpfn.absname ) ]
+
+
+def test_native_resync_reports_meta_update_only( tmpdir ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir )
+    backend = copy_backend.Native_Copy()
+    backend.syncfile( src, tgt, tmpbase, **OPTS )
+    ( tmpfn, action_type ) = backend.syncfile( src, tgt, tmpbase, **OPTS )
+    assert action_type == { 'data_copy': False, 'meta_update': False }
+    src.chmod( 0o600 )
+    ( tmpfn, action_type ) = backend.syncfile( src, tgt, tmpbase, **OPTS )
+    assert action_type == { 'data_copy': False, 'meta_update': True }
+    assert stat.S_IMODE( os.lstat( str( tgt ) ).st_mode ) == 0o600
+
+
+def test_native_without_keeptmp( tmpdir ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir, data='' )
+    backend = copy_backend.Native_Copy()
+    backend.syncfile( src, tgt, tmpbase, **dict( OPTS, keeptmp=False ) )
+    assert tgt.read() == ''
+    assert os.listdir( tmpbase ) == []
+
+
+def test_native_error( tmpdir ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir )
+    with pytest.raises( copy_backend.Copy_Error ):
+        copy_backend.Native_Copy().syncfile( tmpdir.join( 'nosuchfile' ),
+                                             tgt, tmpbase, **OPTS )
+
+
+def test_fstype_and_selection( tmpdir ):
+    table = { '/': 'ext4', '/mnt/lus': 'lustre', '/mnt/lus/sub dir': 'nfs' }
+    assert copy_backend.fstype( '/mnt/lus/a/b', table ) == 'lustre'
+    assert copy_backend.fstype( '/mnt/lus/sub dir/x', table ) == 'nfs'
+    assert copy_backend.fstype( '/tmp', table ) == 'ext4'
+    assert copy_backend.fstype( str( tmpdir ) ) is not None
+    assert copy_backend.mountpoint( '/mnt/lus/a/b', table ) == '/mnt/lus'
+    assert copy_backend.mountpoint( '/tmp', table ) == '/'
+    backend = copy_backend.for_fstypes( 'ext4', 'lustre' )
+    assert backend.name == 'native'
+
+
+@pytest.mark.parametrize( 'reread', [ False, True ] )
+def test_native_inline_checksums( tmpdir, reread ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir )
+    backend = copy_backend.Native_Copy()
+    ( tmpfn, action_type ) = backend.syncfile( src, tgt, tmpbase,
+        checksum='sha1', reread=reread, **OPTS )
+    expected = hashlib.sha1( src.read() ).hexdigest()
+    assert action_type[ 'src_chksum' ] == expected
+    assert action_type[ 'tgt_chksum' ] == expected
+    # no data copied, nothing to hash
+    ( tmpfn, action_type ) = backend.syncfile( src, tgt, tmpbase,
+        checksum='sha1', reread=reread, **OPTS )
+    assert 'src_chksum' not in action_type
+
+
+def test_checksum_range( tmpdir ):
+    f = tmpdir.join( 'f' )
+    f.write( 'abcdefgh' )
+    assert copy_backend.checksum( str( f ), 'md5', 2, 3 ) == \
+           hashlib.md5( 'cde' ).hexdigest()
+
+
+def test_native_new_file_mode_without_syncperms( tmpdir ):
+    ( src, tgt, tmpbase ) = _setup( tmpdir )
+    src.chmod( 0o4755 )
+    umask = os.umask( 0o022 )
+    try:
+        copy_backend._umask = None
+        copy_backend.Native_Copy().syncfile( src, tgt, tmpbase )
+        assert stat.S_IMODE( os.lstat( str( tgt ) ).st_mode ) == 0o755
+        copy_backend._umask = None
+        os.umask( 0o077 )
+        assert copy_backend.new_file_mode( os.lstat( str( src ) ) ) == 0o700
+    finally:
+        os.umask( umask )
+        copy_backend._umask = None
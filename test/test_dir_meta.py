@@ -0,0 +1,55 @@
+import os
+import stat
+import dir_meta
+import dirscan
+
+ALL = dict.fromkeys( dir_meta.SYNC_KEYS, True )
+
+
+def _dir_entry( path ):
+    return dirscan.Entry.from_stat( path.basename, dirscan.DIR,
+                                    os.lstat( str( path ) ) )
+
+
+def test_scan_stat_dirs( tmpdir ):
+    tmpdir.mkdir( 'adir' )
+    counters = {}
+    ( name, ftype, st ) = list( dirscan.scan( str( tmpdir ), counters,
+                                              stat_dirs=True ) )[0]
+    assert ftype == dirscan.DIR
+    assert st.st_ino == os.lstat( str( tmpdir.join( 'adir' ) ) ).st_ino
+    assert counters == { 'entries': 1, 'stats': 1 }
+
+
+def test_apply_sets_perms_and_times( tmpdir ):
+    src = tmpdir.mkdir( 'src' )
+    src.chmod( 0o750 )
+    os.utime( str( src ), ( 1000000000, 1000000000 ) )
+    tgt = tmpdir.mkdir( 'tgt' )
+    dir_meta.apply( str( tgt ), _dir_entry( src ), ALL, atime=1200000000 )
+    st = os.lstat( str( tgt ) )
+    assert stat.S_IMODE( st.st_mode ) == 0o750
+    assert ( st.st_atime, st.st_mtime ) == ( 1200000000, 1000000000 )
+    assert ( st.st_uid, st.st_gid ) == ( os.getuid(), os.getgid() )
+
+
+def test_apply_only_selected( tmpdir ):
+    src = tmpdir.mkdir( 'src' )
+    src.chmod( 0o700 )
+    os.utime( str( src ), ( 1000000000, 1000000000 ) )
+    tgt = tmpdir.mkdir( 'tgt' )
+    tgt.chmod( 0o755 )
+    opts = dict( ALL, syncperms=False )
+    dir_meta.apply( str( tgt ), _dir_entry( src ), opts )
+    st = os.lstat( str( tgt ) )
+    assert stat.S_IMODE( st.st_mode ) == 0o755
+    assert st.st_mtime == 1000000000
+    assert not dir_meta.wanted( dict.fromkeys( dir_meta.SYNC_KEYS, False ) )
+
+
+def test_apply_keeps_subsecond_mtime( tmpdir ):
+    src = tmpdir.mkdir( 'src' )
+    os.utime( str( src ), ( 1000000000, 1000000000.5 ) )
+    tgt = tmpdir.mkdir( 'tgt' )
+    dir_meta.apply( str( tgt ), _dir_entry( src ), ALL )
+    assert os.lstat( str( tgt ) ).st_mtime == 1000000000.5
@@ -0,0 +1,32 @@
+import random
+import dirdiff
+
+
+def _mk_listing( names ):
+    return [ ( n, 'file', None ) for n in names ]
+
+
+def test_external_sort_spills_and_merges( tmpdir ):
+    names = [ 'n{0:06d}'.format( i ) for i in range( 1000 ) ]
+    shuffled = names[:]
+    random.shuffle( shuffled )
+    result = list( dirdiff.external_sort( _mk_listing( shuffled ),
+                                          run_size=64, tmpdir=str( tmpdir ) ) )
+    assert [ r[0] for r in result ] == names
+
+
+def test_external_sort_in_memory():
+    assert list( dirdiff.external_sort( _mk_listing( [ 'b', 'a' ] ) ) ) == \
+           _mk_listing( [ 'a', 'b' ] )
+    assert list( dirdiff.external_sort( [] ) ) == []
+
+
+def test_merge_join_matches_set_arithmetic():
+    src = set( 'n{0}'.format( random.randint( 0, 500 ) ) for i in range( 300 ) )
+    tgt = set( 'n{0}'.format( random.randint( 0, 500 ) ) for i in range( 300 ) )
+    joined = list( dirdiff.merge_join( _mk_listing( sorted( src ) ),
+                                       _mk_listing( sorted( tgt ) ) ) )
+    assert set( n for n, s, t in joined if s and not t ) == src - tgt
+    assert set( n for n, s, t in joined if t and not s ) == tgt - src
+    assert set( n for n, s, t in joined if s and t ) == src & tgt
+    assert [ n for n, s, t in joined ] == sorted( src | tgt )
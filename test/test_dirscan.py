@@ -0,0 +1,89 @@
+import os
+import dirscan
+
+
+def test_scan_classifies_without_stat_for_dirs( tmpdir ):
+    tmpdir.mkdir( 'adir' )
+    tmpdir.join( 'afile' ).write( 'data' )
+    tmpdir.join( 'alink' ).mksymlinkto( 'afile' )
+    counters = {}
+    entries = { n: ( t, st ) for n, t, st in dirscan.scan( str( tmpdir ), counters ) }
+    assert entries[ 'adir' ] == ( dirscan.DIR, None )
+    assert entries[ 'afile' ][0] == dirscan.FILE
+    assert entries[ 'afile' ][1].st_size == 4
+    assert entries[ 'alink' ] == ( dirscan.OTHER, None )
+    assert counters == { 'entries': 3, 'stats': 1 }
+    counters = {}
+    entries = { n: ( t, st ) for n, t, st in
+                dirscan.scan( str( tmpdir ), counters, stat_files=False ) }
+    assert entries[ 'afile' ] == ( dirscan.FILE, None )
+    assert counters == { 'entries': 3, 'stats': 0 }
+
+
+def test_scan_stat_matches_lstat( tmpdir ):
+    f = tmpdir.join( 'afile' )
+    f.write( 'x' * 10 )
+    ( name, ftype, st ) = list( dirscan.scan( str( tmpdir ) ) )[0]
+    expected = os.lstat( str( f ) )
+    assert ( st.st_ino, st.st_size, st.st_mtime ) == \
+           ( expected.st_ino, expected.st_size, expected.st_mtime )
+
+
+def _entry( path ):
+    return dirscan.Entry.from_stat( path.basename, dirscan.FILE,
+                                    os.lstat( str( path ) ) )
+
+
+def _quick_check_opts( **k ):
+    opts = dict( syncperms=True, syncowner=True, syncgroup=True )
+    opts.update( k )
+    return opts
+
+
+def test_quick_check( tmpdir ):
+    src = tmpdir.join( 'src' )
+    tgt = tmpdir.join( 'tgt' )
+    src.write( 'abc' )
+    tgt.write( 'xyz' )
+    src_st = os.lstat( str( src ) )
+    src_e = _entry( src )
+    os.utime( str( tgt ), ( src_st.st_atime, src_st.st_mtime ) )
+    os.chmod( str( tgt ), src_st.st_mode )
+    assert dirscan.quick_check( src_e, _entry( tgt ), _quick_check_opts() )
+    # size differs
+    tgt.write( 'xyzz' )
+    os.utime( str( tgt ), ( src_st.st_atime, src_st.st_mtime ) )
+    assert not dirscan.quick_check( src_e, _entry( tgt ), _quick_check_opts() )
+    # mtime differs
+    tgt.write( 'xyz' )
+    os.utime( str( tgt ), ( src_st.st_atime, src_st.st_mtime - 10 ) )
+    assert not dirscan.quick_check( src_e, _entry( tgt ), _quick_check_opts() )
+    # perms differ, only matters if syncperms
+    os.utime( str( tgt ), ( src_st.st_atime, src_st.st_mtime ) )
+    os.chmod( str( tgt ), 0o600 if src_st.st_mode & 0o777 != 0o600 else 0o644 )
+    tgt_e = _entry( tgt )
+    assert not dirscan.quick_check( src_e, tgt_e, _quick_check_opts() )
+    assert dirscan.quick_check( src_e, tgt_e, _quick_check_opts( syncperms=False ) )
+
+
+def test_scan_slices_partition_entries( tmpdir ):
+    names = set( 'f{0}'.format( i ) for i in range( 50 ) )
+    for n in names:
+        tmpdir.join( n ).write( '' )
+    found = []
+    for i in range( 4 ):
+        found.extend( n for n, t, st in dirscan.scan( str( tmpdir ), dirslice=( i, 4 ) ) )
+    assert len( found ) == len( names )
+    assert set( found ) == names
+    assert dirscan.count( str( tmpdir ) ) == len( names )
+
+
+def test_entry_from_stat( tmpdir ):
+    f = tmpdir.join( 'afile' )
+    f.write( 'x' * 10 )
+    st = os.lstat( str( f ) )
+    e = dirscan.Entry.from_stat( 'afile', dirscan.FILE, st )
+    assert ( e.name, e.size, e.mtime, e.mode, e.nlink, e.inode ) == \
+           ( 'afile', 10, st.st_mtime, st.st_mode, 1, st.st_ino )
+    assert dirscan.Entry.from_stat( 'adir', dirscan.DIR ).size == 0
+    assert e.__slots__ == ()
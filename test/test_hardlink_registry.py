@@ -0,0 +1,69 @@
+import time
+import cbor
+import hardlink_registry
+from hardlink_registry import CLAIMED, PENDING, DONE
+from redis_db import rdb
+
+
+def _registry( conn, stale_secs=60 ):
+    return hardlink_registry.Hardlink_Registry( conn, 'run1', stale_secs=stale_secs )
+
+
+def test_first_claim_wins( rdb ):
+    reg = _registry( rdb )
+    assert reg.claim( 10, 'd/a' ) == ( CLAIMED, 'd/a' )
+    assert reg.claim( 10, 'd/b' ) == ( PENDING, 'd/a' )
+    reg.done( 10, 'd/a' )
+    assert reg.claim( 10, 'd/b' ) == ( DONE, 'd/a' )
+    # other inodes are independent
+    assert reg.claim( 11, 'd/c' ) == ( CLAIMED, 'd/c' )
+
+
+def test_release_lets_the_next_link_claim( rdb ):
+    reg = _registry( rdb )
+    reg.claim( 10, 'd/a' )
+    reg.release( 10 )
+    assert reg.claim( 10, 'd/b' ) == ( CLAIMED, 'd/b' )
+    reg.delete()
+    assert not rdb.exists( reg.key )
+
+
+def test_stale_claim_is_taken_over( rdb ):
+    reg = _registry( rdb )
+    rdb.hset( reg.key, 10, cbor.dumps( [ PENDING, 'd/a', time.time() - 120 ] ) )
+    assert reg.claim( 10, 'd/b' ) == ( CLAIMED, 'd/b' )
+    assert reg.claim( 10, 'd/c' ) == ( PENDING, 'd/b' )
+
+
+class _Racing_Conn( object ):
+    """ Another worker finishes the inode between WATCH and EXEC, once
+    """
+    def __init__( self, conn, key ):
+        self.conn = conn
+        self.key = key
+        self.raced = False
+
+    def __getattr__( self, name ):
+        return getattr( self.conn, name )
+
+    def pipeline( self ):
+        pipe = self.conn.pipeline()
+        hget = pipe.hget
+        def racing_hget( *a ):
+            rv = hget( *a )
+            if not self.raced:
+                self.raced = True
+                self.conn.hset( self.key, 10,
+                                cbor.dumps( [ DONE, 'd/x', time.time() ] ) )
+            return rv
+        pipe.hget = racing_hget
+        return pipe
+
+
+def test_takeover_retries_after_a_concurrent_change( rdb ):
+    reg = _registry( rdb )
+    rdb.hset( reg.key, 10, cbor.dumps( [ PENDING, 'd/a', time.time() - 120 ] ) )
+    reg.conn = _Racing_Conn( rdb, reg.key )
+    # the stale claim was done meanwhile, the takeover must not overwrite it
+    assert reg.claim( 10, 'd/b' ) == ( DONE, 'd/x' )
+    assert reg.conn.raced
@@ -0,0 +1,160 @@
+import os
+import io
+import errno
+import glob
+import zlib
+import cbor
+import pytest
+import redis_queue
+import log_collector
+
+
+def read_records( data ):
+    f = io.BytesIO( data )
+    recs = []
+    while f.tell() < len( data ):
+        recs.append( cbor.load( f ) )
+    return recs
+
+
+def records( num ):
+    return [ cbor.dumps( { 'sev': 'INFO', 'n': i } ) for i in range( num ) ]
+
+
+def test_segment_rotation( tmpdir ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    w = log_collector.Segment_Writer( logbase, 'INFO', max_bytes=50 )
+    w.write( records( 5 ) )
+    w.sync()
+    assert glob.glob( logbase + '.INFO.*.cbor' ) == []
+    assert len( glob.glob( logbase + '.INFO.*.part' ) ) == 1
+    assert w.rotate_due()
+    first = w.close()
+    w.write( records( 2 ) )
+    second = w.close()
+    assert first != second
+    assert sorted( glob.glob( logbase + '.INFO.*.cbor' ) ) == [ first, second ]
+    data = open( first, 'rb' ).read() + open( second, 'rb' ).read()
+    assert [ r[ 'n' ] for r in read_records( data ) ] == [ 0, 1, 2, 3, 4, 0, 1 ]
+
+
+def test_segment_gzip( tmpdir ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    w = log_collector.Segment_Writer( logbase, 'INFO', compress='gzip' )
+    w.write( records( 3 ) )
+    w.sync()
+    # readable up to the last sync, before the segment is finished
+    part = glob.glob( logbase + '.INFO.*.cbor.gz.part' )[0]
+    d = zlib.decompressobj( 31 )
+    assert len( read_records( d.decompress( open( part, 'rb' ).read() ) ) ) == 3
+    w.write( records( 2 ) )
+    path = w.close()
+    assert not os.path.exists( part )
+    data = zlib.decompress( open( path, 'rb' ).read(), 31 )
+    assert [ r[ 'n' ] for r in read_records( data ) ] == [ 0, 1, 2, 0, 1 ]
+
+
+def test_collector_batches( tmpdir ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    rq = redis_queue.Redis_Queue( 'psync_log', url='redis://127.0.0.1:1/0' )
+    c = log_collector.Log_Collector( 'psync_log', [ ( 'INFO', rq ) ], logbase )
+    c.process_batch( 'INFO', records( 3 ) )
+    # severity from the records, for a queue of mixed severities
+    c.process_batch( None, [ cbor.dumps( { 'sev': 'ERROR', 'n': 7 } ) ] )
+    paths = sorted( c.rotate( force=True ) )
+    assert [ os.path.basename( p ).split( '.' )[1] for p in paths ] == \
+        [ 'ERROR', 'INFO' ]
+    assert c.num_records == 4
+    data = open( paths[1], 'rb' ).read()
+    assert [ r[ 'n' ] for r in read_records( data ) ] == [ 0, 1, 2 ]
+
+
+def test_recover_plain_part( tmpdir ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    w = log_collector.Segment_Writer( logbase, 'INFO' )
+    w.write( records( 3 ) )
+    w.sync()
+    # the collector dies while writing the next batch
+    w.f.write( records( 1 )[0][:4] )
+    w.f.flush()
+    part = w.path + log_collector.PART_SUFFIX
+    assert log_collector.recover( logbase ) == [ w.path ]
+    assert not os.path.exists( part )
+    data = open( w.path, 'rb' ).read()
+    assert [ r[ 'n' ] for r in read_records( data ) ] == [ 0, 1, 2 ]
+
+
+def test_recover_gzip_part( tmpdir ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    w = log_collector.Segment_Writer( logbase, 'INFO', compress='gzip' )
+    w.write( records( 3 ) )
+    w.sync()
+    w.write( records( 2 ) )
+    w.f.flush()
+    assert log_collector.recover( logbase ) == [ w.path ]
+    data = zlib.decompress( open( w.path, 'rb' ).read(), 31 )
+    assert [ r[ 'n' ] for r in read_records( data ) ][ :3 ] == [ 0, 1, 2 ]
+    assert glob.glob( logbase + '.*' ) == [ w.path ]
+    # a new segment does not take the name of a recovered one
+    w2 = log_collector.Segment_Writer( logbase, 'INFO', compress='gzip' )
+    w2.seq = w.seq - 1
+    w2.opened = w.opened
+    w2.write( records( 1 ) )
+    assert w2.path != w.path
+
+
+class _Queue( object ):
+    conn = None
+
+    def __init__( self, batches=None ):
+        self.batches = batches
+
+    def qdrain( self, batch_size, max_count ):
+        if self.batches is None:
+            yield records( 1 )
+        elif self.batches:
+            yield self.batches.pop( 0 )
+
+    def get_queue_name( self ):
+        return 'psync_log:INFO'
+
+
+def test_collector_stops_on_write_error( tmpdir ):
+    logbase = str( tmpdir.join( 'missing', 'psync' ) )
+    c = log_collector.Log_Collector( 'psync_log', [ ( 'INFO', _Queue() ) ],
+                                     logbase, poll_secs=0 )
+    c.drain( 'INFO', c.queues[0][1] )
+    assert c.stopped
+    assert isinstance( c.error, IOError )
+
+
+@pytest.mark.parametrize( 'compress', [ None, 'gzip' ] )
+def test_write_error_leaves_no_partial_batch( tmpdir, monkeypatch, compress ):
+    logbase = str( tmpdir.join( 'psync' ) )
+    first = records( 3 )
+    second = [ cbor.dumps( { 'sev': 'INFO', 'n': i } ) for i in range( 3, 6 ) ]
+    c = log_collector.Log_Collector( 'psync_log',
+            [ ( 'INFO', _Queue( [ first, second ] ) ) ], logbase, poll_secs=0,
+            compress=compress )
+    c.status = lambda: {}
+    write = log_collector.Segment_Writer._write
+    def failing_write( self, data ):
+        if self.synced > 0:
+            # the disk fills up half way through the second batch
+            write( self, data[ :len( data ) // 2 ] )
+            raise IOError( errno.ENOSPC, os.strerror( errno.ENOSPC ) )
+        write( self, data )
+    monkeypatch.setattr( log_collector.Segment_Writer, '_write', failing_write )
+    with pytest.raises( UserWarning ):
+        c.run()
+    assert isinstance( c.error, IOError )
+    # the segment with the partial batch is not finished, recover() does
+    assert [ p for p in glob.glob( logbase + '.INFO.*' )
+             if not p.endswith( log_collector.PART_SUFFIX ) ] == []
+    monkeypatch.undo()
+    paths = log_collector.recover( logbase )
+    assert len( paths ) == 1
+    data = open( paths[0], 'rb' ).read()
+    if compress:
+        data = zlib.decompress( data, 31 )
+    assert [ r[ 'n' ] for r in read_records( data ) ] == [ 0, 1, 2 ]
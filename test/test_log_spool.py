@@ -0,0 +1,38 @@
+import os
+import cbor
+import log_spool
+
+
+def records( num, sev='INFO' ):
+    return [ cbor.dumps( { 'sev': sev, 'n': i } ) for i in range( num ) ]
+
+
+def test_write_read_ack( tmpdir ):
+    spool = log_spool.Log_Spool( str( tmpdir ), 'psync_log' )
+    spool.write( records( 3 ) )
+    spool.write( records( 1, 'ERROR' ) )
+    assert spool.pending() == 4
+    ( recs, end ) = spool.read( 2 )
+    assert recs == list( zip( [ 'INFO', 'INFO' ], records( 2 ) ) )
+    spool.ack( end, len( recs ) )
+    assert spool.pending() == 2
+    ( recs, end ) = spool.read( 10 )
+    assert [ sev for ( sev, r ) in recs ] == [ 'INFO', 'ERROR' ]
+    spool.ack( end, len( recs ) )
+    assert spool.pending() == 0
+    assert os.path.getsize( spool.path ) == 0
+    assert spool.read( 10 ) == ( [], 0 )
+
+
+def test_adopt( tmpdir ):
+    # pid 2**22 + 1 is above the kernel's pid_max, so not a live process
+    dead = tmpdir.join( 'psync_log.{0}.{1}.spool'.format(
+        os.uname()[1], 2**22 + 1 ) )
+    dead.write( ''.join( records( 2 ) ), mode='wb' )
+    assert log_spool.orphans( str( tmpdir ), 'psync_log' ) == [ str( dead ) ]
+    spool = log_spool.Log_Spool( str( tmpdir ), 'psync_log' )
+    spool.write( records( 1, 'ERROR' ) )
+    assert spool.adopt() == 1
+    assert not dead.check()
+    assert spool.pending() == 3
+    assert log_spool.orphans( str( tmpdir ), 'psync_log' ) == []
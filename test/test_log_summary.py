@@ -0,0 +1,44 @@
+import log_summary
+
+
+class Records( object ):
+    """ Collects records logged with info() """
+    def __init__( self ):
+        self.records = []
+
+    def info( self, **k ):
+        self.records.append( k )
+
+
+def test_summary_record():
+    logr = Records()
+    with log_summary.Log_Summary( logr, 'SYNCFILE', '/src/d', '/tgt/d',
+                                  log_summary.SUMMARY ) as summary:
+        summary.add( 'data_copy', 100, 0.5 )
+        summary.add( 'data_copy', 50, 1.5 )
+        summary.add( 'None', 10, 0.25 )
+        summary.error()
+        assert not summary.per_file( '/src/d/f' )
+    assert len( logr.records ) == 1
+    rec = logr.records[0]
+    assert ( rec[ 'msgtype' ], rec[ 'num_files' ], rec[ 'num_errors' ] ) == \
+           ( 'summary', 3, 1 )
+    assert rec[ 'actions' ] == { 'data_copy': 2, 'None': 1 }
+    assert ( rec[ 'bytes' ], rec[ 'secs' ], rec[ 'max_secs' ] ) == \
+           ( 150, 2.25, 1.5 )
+
+
+def test_all_mode_and_sampling():
+    logr = Records()
+    with log_summary.Log_Summary( logr, 'SYNCFILE', '/src/d', '/tgt/d' ) as summary:
+        summary.add( 'data_copy', 100, 0.5 )
+        assert summary.per_file( '/src/d/f' )
+        assert summary.fields() == {}
+    assert logr.records == []
+    summary = log_summary.Log_Summary( logr, 'SYNCFILE', '/src/d', '/tgt/d',
+                                       log_summary.SUMMARY, sample=10 )
+    paths = [ '/src/d/f{0}'.format( i ) for i in range( 1000 ) ]
+    chosen = [ p for p in paths if summary.per_file( p ) ]
+    assert 50 < len( chosen ) < 150
+    assert chosen == [ p for p in paths if summary.per_file( p ) ]
+    assert summary.fields() == { 'sampled': True }
@@ -0,0 +1,86 @@
+import gzip
+import cbor
+import redis
+import logschema
+from redis_db import rdb
+
+# nothing listens here, interning fails and values are kept as they are
+DOWN_URL = 'redis://127.0.0.1:1/0'
+
+REC = dict( sev='INFO', ts=1468300000, host='cn01', msg='',
+            synctype='SYNCFILE', msgtype='end', action='data_copy',
+            src='/src/root/a/b', tgt='/tgt/root/a/b', size=10,
+            custom='kept' )
+
+
+def encoder():
+    e = logschema.Encoder( redis.Redis.from_url( DOWN_URL ), 'psync_log' )
+    # as if interned
+    e.prefixes = [ ( '/src/root', 1 ), ( '/tgt/root', 2 ) ]
+    e.hosts._ids[ 'cn01' ] = 7
+    return e
+
+
+def tables():
+    return logschema.table_record( { 7: 'cn01' },
+                                   { 1: '/src/root', 2: '/tgt/root' } )
+
+
+def test_encode_decode():
+    rec = encoder().encode( REC )
+    assert rec[ logschema.FIELD_VERSION ] == logschema.VERSION
+    assert rec[ 7 ] == [ 1, '/a/b' ]
+    assert rec[ 3 ] == 7
+    assert rec[ 'custom' ] == 'kept'
+    assert len( cbor.dumps( rec ) ) < len( cbor.dumps( REC ) )
+    assert logschema.severity( rec ) == 'INFO'
+    d = logschema.Decoder()
+    assert d.decode( tables() ) is None
+    assert d.decode( rec ) == REC
+    # old format records are returned as they are
+    assert d.decode( REC ) == REC
+
+
+def test_no_prefix_or_redis():
+    e = encoder()
+    rec = e.encode( dict( REC, src='/src/rootless/x', host='cn02' ) )
+    # not under a prefix ('/src/root' is not a dir of it), host not interned
+    assert ( rec[ 7 ], rec[ 3 ] ) == ( '/src/rootless/x', 'cn02' )
+    d = logschema.Decoder()
+    d.decode( tables() )
+    assert d.decode( rec ) == dict( REC, src='/src/rootless/x', host='cn02' )
+
+
+def test_read_log_both_formats( tmpdir ):
+    path = str( tmpdir.join( 'psync.INFO.cbor.gz' ) )
+    f = gzip.open( path, 'wb' )
+    f.write( cbor.dumps( REC ) )
+    f.write( cbor.dumps( tables() ) )
+    f.write( cbor.dumps( encoder().encode( REC ) ) )
+    f.close()
+    assert list( logschema.read_log( path ) ) == [ REC, REC ]
+
+
+def test_new_values_interned_later():
+    e = logschema.Encoder( redis.Redis.from_url( DOWN_URL ), 'psync_log' )
+    assert e.add_prefixes( '/src/root/' )
+    rec = e.encode( REC )
+    # not interned yet, kept as they are and queued for intern_new
+    assert ( rec[ 7 ], rec[ 3 ] ) == ( '/src/root/a/b', 'cn01' )
+    assert e.intern_new() == 2
+    assert e.prefixes == []
+
+
+def test_intern_new( rdb ):
+    e = logschema.Encoder( rdb, 'psync_log' )
+    e.add_prefixes( '/src/root', '/tgt/root' )
+    e.encode( REC )
+    assert e.intern_new() == 0
+    assert not e.add_prefixes( '/src/root' )
+    rec = e.encode( REC )
+    assert isinstance( rec[ 3 ], int )
+    assert rec[ 7 ][ 1 ] == '/a/b'
+    t = logschema.Tables( rdb, 'psync_log' )
+    d = logschema.Decoder()
+    d.decode( cbor.loads( t.new_entries( {} ) ) )
+    assert d.decode( rec ) == REC
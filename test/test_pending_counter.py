@@ -0,0 +1,41 @@
+import pending_counter
+from redis_db import rdb
+
+
+def test_task_is_uncounted_once( rdb ):
+    parent = pending_counter.Pending_Counter( rdb, 'run1', parent='a' )
+    parent.incr( { 'psync.sync_file': 2 } )
+    counter = pending_counter.Pending_Counter( rdb, 'run1' )
+    counter.start( 't1', 'psync.sync_file', [ 'run1', 'a' ] )
+    counter.start( 't2', 'psync.sync_file', [ 'run1', 'a' ] )
+    assert counter.decr( 'psync.sync_file', 'a', 't1' ) == ( 1, 1 )
+    # returned already
+    assert counter.decr( 'psync.sync_file', 'a', 't1' ) is None
+    assert counter.decr( 'psync.sync_file', 'a', 't2' ) == ( 0, 0 )
+    assert counter.num_dirs() == 0
+    assert counter.running() == {}
+
+
+def test_killed_task_is_stuck_until_released( rdb ):
+    parent = pending_counter.Pending_Counter( rdb, 'run1', parent='' )
+    parent.incr( { 'psync.sync_dir': 1 } )
+    counter = pending_counter.Pending_Counter( rdb, 'run1' )
+    counter.start( 't1', 'psync.sync_dir', [ 'run1', '' ] )
+    # ... and the worker process is killed, the task never returns
+    assert counter.stuck( 3600 ) == {}
+    stuck = counter.stuck( -1 )
+    assert stuck.keys() == [ 't1' ]
+    assert stuck[ 't1' ][ 'name' ] == 'psync.sync_dir'
+    assert stuck[ 't1' ][ 'args' ] == [ 'run1', '' ]
+    assert counter.forget( 't1' )
+    assert not counter.forget( 't1' )
+    assert counter.decr( 'psync.sync_dir', '' ) == ( 0, 0 )
+    assert counter.counts() == { 'sync_dir': 0, 'work': 0 }
+    assert counter.num_dirs() == 0
+
+
+def test_queued_retry_is_not_stuck( rdb ):
+    counter = pending_counter.Pending_Counter( rdb, 'run1' )
+    counter.start( 't1', 'psync.sync_hardlink', [ 'run1', 'a' ], queued=True )
+    assert counter.running()[ 't1' ][ 'started' ] is None
+    assert counter.stuck( -1 ) == {}
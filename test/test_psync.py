@@ -5,6 +5,7 @@ import fsitem
 import psync
 import time
 import cbor
+import logschema
 import parse_worker_errlog
 from runcmd import runcmd, Run_Cmd_Error
 
@@ -17,11 +18,35 @@ rsyncopts = dict( syncowner = True,
                 )
 
 psyncopts = dict( minsecs = 0,
-                  pre_checksums = False
+                  pre_checksums = False,
+                  batch_count = 100,
+                  batch_bytes = 67108864,
+                  slice_entries = 500000,
+                  chunk_threshold = 17179869184,
+                  chunk_bytes = 1073741824,
+                  checksum_algo = 'md5',
+                  verify_reread = False,
+                  file_log = 'all',
+                  file_log_sample = 0
                 )
 
 max_waitfor = 60
 
+
+def start_sync( src, tgt, popts=psyncopts, ropts=rsyncopts ):
+    """
+    Register a new psync run and seed it with the top level dir
+    """
+    run_id = psync.runs.register( popts, ropts,
+                                  tmpdir=os.environ[ 'PSYNCTMPDIR' ],
+                                  rmdir=os.environ[ 'PSYNCRMDIR' ],
+                                  src_root=src.absname,
+                                  src_mountpoint=src.mountpoint,
+                                  tgt_root=tgt.absname,
+                                  tgt_mountpoint=tgt.mountpoint )
+    psync.apply_counted( psync.sync_dir, ( run_id, '' ) )
+    return run_id
+
 def _truncate( fn ):
     with open( str( fn ), 'wb' ) as fh:
         pass
@@ -94,10 +119,9 @@ def get_redis_logs():
         dict( DEBUG=[], INFO=[], WARNING=[], ERROR=[] )
     """
     logmsgs = dict( DEBUG=[], INFO=[], WARNING=[], ERROR=[] )
-    rq = psync.logr.rq
-    for m in rq.qpop_all():
-        msgdict = cbor.loads( m )
-        logmsgs[ msgdict[ 'sev' ] ].append( m )
+    for ( sev, rq ) in psync.logr.queues():
+        for batch in rq.qdrain():
+            logmsgs[ sev ].extend( batch )
     return logmsgs
 
 
@@ -163,18 +187,7 @@ def cleanup():
     """
     get_worker_errors( cleanup=True )
     get_task_errors( cleanup=True )
-    reset_worker_queues()
-
 
-def reset_worker_queues():
-    """
-    Set workers to consume from their normal, default queues
-    """
-    # psync workers consume from 'directories' only at the tail end of a sync
-    # unset this before starting a new psync test
-    results = psync.app.control.cancel_consumer( 'directories', reply=True )
-    pprint.pprint( results )
-    
 
 def in_sync( src, tgt ):
     """
@@ -211,8 +224,7 @@ def test_sync_no_hardlinks( testdir ):
     # run psync from testdir.source to testdir.target
     src = fsitem.FSItem( testdir.config.SOURCE_DIR )
     tgt = fsitem.FSItem( testdir.config.DEST_DIR )
-    psync.sync_dir.delay( src, tgt, psyncopts, rsyncopts )
-    psync.schedule_final_dir_sync.apply_async( args=( 10, ), countdown=10 )
+    start_sync( src, tgt )
     assert wait_for( psync_is_complete, max_seconds=max_waitfor )
     assert error_free_sync()
     # clear any cached meta data
@@ -230,8 +242,48 @@ def test_full_sync( testdir ):
     # run psync from testdir.source to testdir.target
     src = fsitem.FSItem( testdir.config.SOURCE_DIR )
     tgt = fsitem.FSItem( testdir.config.DEST_DIR )
-    psync.sync_dir.delay( src, tgt, psyncopts, rsyncopts )
-    psync.schedule_final_dir_sync.apply_async( args=( 10, ), countdown=10 )
+    run_id = start_sync( src, tgt )
+    assert wait_for( psync_is_complete, max_seconds=max_waitfor )
+    assert error_free_sync()
+    # every counted task was uncounted
+    assert all( v == 0 for v in psync.pending( run_id ).counts().values() )
+    # every directory got its metadata set
+    assert psync.pending( run_id ).num_dirs() == 0
+    # clear any cached meta data
+    src.update()
+    tgt.update()
+    # verify source matches target
+    assert in_sync( src, tgt )
+
+
+
+def test_sync_no_batching( testdir ):
+    cleanup()
+    testdir.reset_config()
+    testdir.reset()
+    # send every file as an individual sync_file task
+    opts = dict( psyncopts, batch_count = 1 )
+    src = fsitem.FSItem( testdir.config.SOURCE_DIR )
+    tgt = fsitem.FSItem( testdir.config.DEST_DIR )
+    start_sync( src, tgt, opts )
+    assert wait_for( psync_is_complete, max_seconds=max_waitfor )
+    assert error_free_sync()
+    # clear any cached meta data
+    src.update()
+    tgt.update()
+    # verify source matches target
+    assert in_sync( src, tgt )
+
+
+def test_sync_sliced_dirs( testdir ):
+    cleanup()
+    testdir.reset_config()
+    testdir.reset()
+    # split every directory into slices
+    opts = dict( psyncopts, slice_entries = 2 )
+    src = fsitem.FSItem( testdir.config.SOURCE_DIR )
+    tgt = fsitem.FSItem( testdir.config.DEST_DIR )
+    start_sync( src, tgt, opts )
     assert wait_for( psync_is_complete, max_seconds=max_waitfor )
     assert error_free_sync()
     # clear any cached meta data
@@ -240,3 +292,47 @@ def test_full_sync( testdir ):
     # verify source matches target
     assert in_sync( src, tgt )
 
+
+def test_sync_chunked_files( testdir ):
+    cleanup()
+    testdir.reset_config()
+    testdir.reset()
+    # copy every non-empty file in chunks of (at most) 3 bytes
+    opts = dict( psyncopts, chunk_threshold = 1, chunk_bytes = 3 )
+    src = fsitem.FSItem( testdir.config.SOURCE_DIR )
+    tgt = fsitem.FSItem( testdir.config.DEST_DIR )
+    start_sync( src, tgt, opts )
+    assert wait_for( psync_is_complete, max_seconds=max_waitfor )
+    assert error_free_sync()
+    # clear any cached meta data
+    src.update()
+    tgt.update()
+    # verify source matches target
+    assert in_sync( src, tgt )
+
+
+def test_sync_file_log_summary( testdir ):
+    cleanup()
+    testdir.reset_config()
+    testdir.reset()
+    opts = dict( psyncopts, file_log = 'summary' )
+    src = fsitem.FSItem( testdir.config.SOURCE_DIR )
+    tgt = fsitem.FSItem( testdir.config.DEST_DIR )
+    start_sync( src, tgt, opts )
+    assert wait_for( psync_is_complete, max_seconds=max_waitfor )
+    # log records are pushed by the workers' flushers, shortly after
+    time.sleep( 2 )
+    logmsgs = get_redis_logs()
+    assert len( logmsgs[ 'WARNING' ] ) + len( logmsgs[ 'ERROR' ] ) == 0
+    # compact records (see logschema), with the tables from redis
+    decoder = logschema.Decoder()
+    tables = logschema.Tables( psync.logr.rq.conn,
+                               psync.logr.rq.get_queue_name() )
+    decoder.decode( logschema.table_record( *tables.current() ) )
+    records = [ decoder.decode( cbor.loads( m ) ) for m in logmsgs[ 'INFO' ] ]
+    file_records = [ r for r in records if r.get( 'synctype' ) == 'SYNCFILE' ]
+    assert len( file_records ) > 0
+    assert all( r[ 'msgtype' ] == 'summary' for r in file_records )
+    src.update()
+    tgt.update()
+    assert in_sync( src, tgt )
@@ -0,0 +1,70 @@
+import pytest
+import redis
+import cbor
+import redis_logger
+
+# nothing listens here, every push fails
+DOWN_URL = 'redis://127.0.0.1:1/0'
+
+
+def test_records_are_kept_while_redis_is_down():
+    logr = redis_logger.Redis_Logger( url=DOWN_URL, queue_name='psync_log',
+                                      flush_secs=3600 )
+    for i in range( 3 ):
+        logr.info( synctype='SYNCFILE', msgtype='end', n=i )
+    assert logr.pending() == 3
+    with pytest.raises( redis.ConnectionError ):
+        logr.flush()
+    assert logr.pending() == 3
+    assert [ ( sev, cbor.loads( r )[ 'n' ] ) for ( sev, r ) in logr._buffer ] \
+        == [ ( 'INFO', 0 ), ( 'INFO', 1 ), ( 'INFO', 2 ) ]
+    # nothing to push at exit
+    del logr._buffer[:]
+
+
+def test_unknown_level():
+    logr = redis_logger.Redis_Logger( url=DOWN_URL, queue_name='psync_log' )
+    with pytest.raises( AttributeError ):
+        logr.notice( 'x' )
+
+
+def test_queues():
+    logr = redis_logger.Redis_Logger( url=DOWN_URL, queue_name='psync_log' )
+    assert [ ( sev, rq.get_queue_name() ) for ( sev, rq ) in logr.queues() ] \
+        == [ ( 'DEBUG', 'psync_log:DEBUG' ), ( 'INFO', 'psync_log:INFO' ),
+             ( 'WARNING', 'psync_log:WARNING' ), ( 'ERROR', 'psync_log:ERROR' ) ]
+    assert logr._route( 'INFO' ).get_queue_name() == 'psync_log:INFO'
+
+
+def test_sharded_queues():
+    urls = [ DOWN_URL, 'redis://127.0.0.1:2/0' ]
+    logr = redis_logger.Redis_Logger( url=DOWN_URL, queue_name='psync_log',
+                                      shards=4, urls=urls )
+    queues = logr.queues()
+    assert len( queues ) == 16
+    info = [ rq for ( sev, rq ) in queues if sev == 'INFO' ]
+    assert [ rq.get_queue_name() for rq in info ] == \
+        [ 'psync_log:INFO:{0}'.format( i ) for i in range( 4 ) ]
+    # shards alternate between the redis servers
+    ports = [ rq.conn.connection_pool.connection_kwargs[ 'port' ] for rq in info ]
+    assert ports == [ 1, 2, 1, 2 ]
+    # one shard per process, the same for every severity
+    shard = logr._route( 'INFO' ).get_queue_name().split( ':' )[-1]
+    assert logr._route( 'ERROR' ).get_queue_name() == \
+        'psync_log:ERROR:{0}'.format( shard )
+
+
+def test_spool_while_redis_is_down( tmpdir ):
+    logr = redis_logger.Redis_Logger( url=DOWN_URL, queue_name='psync_log',
+                                      flush_secs=3600, spool_dir=str( tmpdir ) )
+    for i in range( 3 ):
+        logr.info( synctype='SYNCFILE', msgtype='end', n=i )
+    logr.flush()
+    assert ( logr.pending(), logr.spooled() ) == ( 0, 3 )
+    # later records queue up behind the spooled ones
+    logr.error( synctype='SYNCFILE', msgtype='error', n=3 )
+    logr.flush()
+    assert logr.spooled() == 4
+    ( recs, end ) = logr._spool.read( 10 )
+    assert [ ( sev, cbor.loads( r )[ 'n' ] ) for ( sev, r ) in recs ] == \
+        [ ( 'INFO', 0 ), ( 'INFO', 1 ), ( 'INFO', 2 ), ( 'ERROR', 3 ) ]
@@ -0,0 +1,89 @@
+import celery
+import task_publisher
+
+
+def _mk_app():
+    app = celery.Celery( 'test_task_publisher', broker='memory://' )
+    app.conf.update( CELERY_TASK_SERIALIZER='pickle',
+                     CELERY_ACCEPT_CONTENT=[ 'pickle' ] )
+
+    @app.task
+    def noop( i ):
+        pass
+    return ( app, noop )
+
+
+def _queued( app, qname='celery' ):
+    with app.connection() as conn:
+        q = conn.SimpleQueue( qname )
+        size = q.qsize()
+        q.close()
+    return size
+
+
+def test_publisher_batches_and_flushes_on_exit():
+    ( app, noop ) = _mk_app()
+    with task_publisher.Task_Publisher( app, batch_size=3 ) as publisher:
+        for i in range( 7 ):
+            publisher.add( noop, ( i, ) )
+        # two full batches sent, last one still buffered
+        assert publisher.num_published == 6
+        assert len( publisher.pending ) == 1
+    assert publisher.num_published == 7
+    assert publisher.conn is None
+    assert _queued( app ) == 7
+
+
+def test_publisher_discards_pending_on_error():
+    ( app, noop ) = _mk_app()
+    try:
+        with task_publisher.Task_Publisher( app, batch_size=10 ) as publisher:
+            publisher.add( noop, ( 1, ) )
+            raise ValueError( 'boom' )
+    except ( ValueError ) as e:
+        pass
+    assert publisher.num_published == 0
+    assert publisher.conn is None
+
+
+class _Counter( object ):
+    def __init__( self ):
+        self.counts = {}
+
+    def incr( self, counts ):
+        for ( name, num ) in counts.items():
+            self.counts[ name ] = self.counts.get( name, 0 ) + num
+
+
+def test_publisher_counts_before_publish():
+    ( app, noop ) = _mk_app()
+    counter = _Counter()
+    with task_publisher.Task_Publisher( app, batch_size=2, counter=counter ) as publisher:
+        for i in range( 3 ):
+            publisher.add( noop, ( i, ) )
+        assert counter.counts == { noop.name: 2 }
+    assert counter.counts == { noop.name: 3 }
+
+
+def test_publisher_uncounts_unpublished_tasks( monkeypatch ):
+    ( app, noop ) = _mk_app()
+    counter = _Counter()
+    sent = []
+    def apply_async( args, **k ):
+        if len( sent ) >= 2:
+            raise IOError( 'broker gone' )
+        sent.append( args )
+    monkeypatch.setattr( noop, 'apply_async', apply_async )
+    publisher = task_publisher.Task_Publisher( app, batch_size=10, counter=counter )
+    try:
+        for i in range( 5 ):
+            publisher.add( noop, ( i, ) )
+        try:
+            publisher.flush()
+            assert False, 'flush did not raise'
+        except ( IOError ) as e:
+            pass
+    finally:
+        publisher.close()
+    assert len( sent ) == 2
+    assert counter.counts == { noop.name: 2 }
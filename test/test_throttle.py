@@ -0,0 +1,18 @@
+import time
+import throttle
+
+
+def test_throttle_rate():
+    t = throttle.Throttle( 100 )
+    start = time.time()
+    for i in range( 21 ):
+        t.wait()
+    assert time.time() - start >= 0.19
+
+
+def test_throttle_unlimited():
+    t = throttle.Throttle( 0 )
+    start = time.time()
+    for i in range( 1000 ):
+        t.wait()
+    assert time.time() - start < 0.5